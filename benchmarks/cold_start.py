@@ -0,0 +1,135 @@
+"""
+Measures the import time and cold start of every Lambda entry point.
+
+Each run starts a fresh interpreter, imports the modules an entry point loads
+before handling its first event and builds the AWS clients it uses, the same
+work a cold Lambda container does. Nothing is sent to AWS.
+
+  python benchmarks/cold_start.py --runs 10
+  python benchmarks/cold_start.py --importtime handler.producer
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules imported and AWS clients built before each entry point handles its
+# first event. The consumer imports services.channels on its first batch.
+ENTRY_POINTS = {
+  'handler.producer': (['handler'], ['dynamodb', 'sqs']),
+  'handler.producer_batch': (['handler'], ['dynamodb', 'sqs']),
+  'handler.consumer': (['handler', 'services.channels'], ['dynamodb']),
+  'handler_notification.*': (['handler_notification'], ['dynamodb']),
+  'handler_log.listLog': (['handler_log'], ['dynamodb']),
+}
+
+HEAVY_MODULES = ['boto3', 'requests', 'sendgrid', 'aiohttp', 'dotenv']
+
+CHILD = '''
+import importlib, json, sys, time
+sys.path.insert(0, {root!r})
+started = time.perf_counter()
+for name in {modules!r}:
+  importlib.import_module(name)
+imported = time.perf_counter()
+clients = None
+try:
+  from services import aws
+  for name in {clients!r}:
+    getattr(aws, name)()
+  clients = time.perf_counter() - imported
+except ImportError:
+  pass
+print(json.dumps({{
+  'import_ms': (imported - started) * 1000,
+  'clients_ms': clients * 1000 if clients is not None else None,
+  'loaded': [name for name in {heavy!r} if name in sys.modules],
+}}))
+'''
+
+
+def child_env():
+  env = dict(os.environ)
+  env.setdefault('NOTIFICATION_TABLE', 'notification-table-benchmark')
+  env.setdefault('LOG_TABLE', 'log-table-benchmark')
+  env.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+  env.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+  env.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+  env.pop('IS_OFFLINE', None)
+  return env
+
+
+def run_once(entry_point, importtime=False):
+  modules, clients = ENTRY_POINTS[entry_point]
+  code = CHILD.format(root=ROOT, modules=modules, clients=clients, heavy=HEAVY_MODULES)
+  command = [sys.executable] + (['-X', 'importtime'] if importtime else []) + ['-c', code]
+
+  started = time.perf_counter()
+  completed = subprocess.run(command, cwd=ROOT, env=child_env(), capture_output=True, text=True)
+  wall_ms = (time.perf_counter() - started) * 1000
+  if completed.returncode != 0:
+    raise RuntimeError(f'{entry_point} failed to start:\n{completed.stderr}')
+
+  result = json.loads(completed.stdout.strip().splitlines()[-1])
+  result['wall_ms'] = wall_ms
+  result['importtime'] = completed.stderr if importtime else None
+  return result
+
+
+def top_imports(importtime, count=15):
+  """
+  :return: The modules with the highest cumulative import time, in microseconds.
+  """
+  rows = []
+  for line in importtime.splitlines():
+    if not line.startswith('import time:') or 'cumulative' in line:
+      continue
+    self_us, cumulative_us, name = line[len('import time:'):].split('|', 2)
+    rows.append((int(cumulative_us), name.strip()))
+  return sorted(rows, reverse=True)[:count]
+
+
+def median(values):
+  values = [value for value in values if value is not None]
+  return statistics.median(values) if values else None
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('entry_points', nargs='*', default=list(ENTRY_POINTS), help='Entry points to measure')
+  parser.add_argument('--runs', type=int, default=5, help='Fresh interpreters started per entry point')
+  parser.add_argument('--importtime', action='store_true', help='Print the slowest imports of each entry point')
+  parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+  args = parser.parse_args()
+
+  results = {}
+  for entry_point in args.entry_points:
+    runs = [run_once(entry_point) for _ in range(args.runs)]
+    results[entry_point] = {
+      'wall_ms': median([run['wall_ms'] for run in runs]),
+      'import_ms': median([run['import_ms'] for run in runs]),
+      'clients_ms': median([run['clients_ms'] for run in runs]),
+      'loaded': runs[-1]['loaded'],
+    }
+    if args.importtime:
+      results[entry_point]['top_imports'] = top_imports(run_once(entry_point, importtime=True)['importtime'])
+
+  if args.json:
+    print(json.dumps(results, indent=2))
+    return
+
+  print(f'{"entry point":<26} {"wall ms":>9} {"import ms":>10} {"clients ms":>11}  heavy modules loaded')
+  for entry_point, result in results.items():
+    clients = f'{result["clients_ms"]:.1f}' if result['clients_ms'] is not None else 'n/a'
+    print(f'{entry_point:<26} {result["wall_ms"]:>9.1f} {result["import_ms"]:>10.1f} {clients:>11}  {", ".join(result["loaded"]) or "-"}')
+    for cumulative_us, name in result.get('top_imports', []):
+      print(f'{"":<28}{cumulative_us / 1000:>8.1f} ms  {name}')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,291 @@
+"""
+In-memory stand-ins for DynamoDB, SQS and the provider HTTP endpoints, used to
+run the real handlers offline. They implement only the calls the handlers
+make and count every call, so a run can report AWS and provider calls per
+message.
+"""
+import collections
+import random
+import threading
+import time
+import types
+import uuid
+
+
+class CallCounter:
+  def __init__(self):
+    self.calls = collections.Counter()
+    self._lock = threading.Lock()
+
+  def count(self, operation):
+    with self._lock:
+      self.calls[operation] += 1
+
+  def total(self):
+    with self._lock:
+      return sum(self.calls.values())
+
+  def reset(self):
+    with self._lock:
+      self.calls.clear()
+
+
+class FakeTable:
+  def __init__(self, name, key_names, counter, latency=0.0):
+    """
+    :param name: The table name.
+    :param key_names: The attribute names of the primary key.
+    :param counter: The CallCounter shared by the fake resource.
+    :param latency: Seconds every call sleeps, to model the network round trip.
+    """
+    self.name = name
+    self.key_names = key_names
+    self.items = collections.OrderedDict()
+    self._counter = counter
+    self._latency = latency
+    self._lock = threading.Lock()
+
+  def _call(self, operation):
+    self._counter.count(f'dynamodb.{operation}')
+    if self._latency:
+      time.sleep(self._latency)
+
+  def _key(self, item):
+    return tuple(item[name] for name in self.key_names)
+
+  def load(self):
+    self._call('DescribeTable')
+
+  def get_item(self, Key, **kwargs):
+    self._call('GetItem')
+    with self._lock:
+      item = self.items.get(self._key(Key))
+    return {'Item': dict(item)} if item is not None else {}
+
+  def put_item(self, Item, **kwargs):
+    self._call('PutItem')
+    with self._lock:
+      self.items[self._key(Item)] = dict(Item)
+    return {}
+
+  def delete_item(self, Key, **kwargs):
+    self._call('DeleteItem')
+    with self._lock:
+      self.items.pop(self._key(Key), None)
+    return {}
+
+  def scan(self, Limit=None, ExclusiveStartKey=None, **kwargs):
+    self._call('Scan')
+    with self._lock:
+      items = list(self.items.values())
+    if ExclusiveStartKey:
+      keys = [self._key(item) for item in items]
+      items = items[keys.index(self._key(ExclusiveStartKey)) + 1:]
+    page = items[:Limit] if Limit else items
+    response = {'Items': [dict(item) for item in page]}
+    if Limit and len(items) > Limit:
+      response['LastEvaluatedKey'] = {name: page[-1][name] for name in self.key_names}
+    return response
+
+  def read(self, key):
+    with self._lock:
+      item = self.items.get(self._key(key))
+    return dict(item) if item is not None else None
+
+  def write(self, item):
+    with self._lock:
+      self.items[self._key(item)] = dict(item)
+
+  def remove(self, key):
+    with self._lock:
+      self.items.pop(self._key(key), None)
+
+
+class FakeDynamoResource:
+  def __init__(self, latency=0.0):
+    self.counter = CallCounter()
+    self.tables = {}
+    self._latency = latency
+    self._lock = threading.Lock()
+    # The handlers reach the low-level client through resource.meta.client.
+    self.meta = types.SimpleNamespace(client=self)
+
+  def create_table(self, name, key_names):
+    self.tables[name] = FakeTable(name, key_names, self.counter, self._latency)
+    return self.tables[name]
+
+  def Table(self, name):
+    return self.tables[name]
+
+  def batch_write_item(self, RequestItems, **kwargs):
+    self.counter.count('dynamodb.BatchWriteItem')
+    if self._latency:
+      time.sleep(self._latency)
+    for name, requests in RequestItems.items():
+      for request in requests:
+        if 'PutRequest' in request:
+          self.tables[name].write(request['PutRequest']['Item'])
+        else:
+          self.tables[name].remove(request['DeleteRequest']['Key'])
+    return {'UnprocessedItems': {}}
+
+  def transact_write_items(self, TransactItems, **kwargs):
+    """
+    Models the Put actions of the delivery claims: a put is cancelled when the
+    item exists, unless it is a claim in the :sending state that expired
+    before :now. Items are given and returned in the typed format of the
+    low-level client.
+    """
+    from botocore.exceptions import ClientError
+
+    self.counter.count('dynamodb.TransactWriteItems')
+    if self._latency:
+      time.sleep(self._latency)
+    with self._lock:
+      reasons, puts = [], []
+      for action in TransactItems:
+        put = action['Put']
+        table = self.tables[put['TableName']]
+        item = {name: untyped(value) for name, value in put['Item'].items()}
+        values = {name: untyped(value) for name, value in put.get('ExpressionAttributeValues', {}).items()}
+        current = table.read(item)
+        expired = current is not None and current.get('state') == values.get(':sending') and current.get('expires_at', 0) < values.get(':now', 0)
+        if current is not None and not expired:
+          reasons.append({'Code': 'ConditionalCheckFailed', 'Item': {name: typed(value) for name, value in current.items()}})
+        else:
+          reasons.append({'Code': 'None'})
+          puts.append((table, item))
+
+      if len(puts) < len(TransactItems):
+        raise ClientError({
+          'Error': {'Code': 'TransactionCanceledException', 'Message': 'Transaction cancelled'},
+          'CancellationReasons': reasons,
+        }, 'TransactWriteItems')
+      for table, item in puts:
+        table.write(item)
+    return {}
+
+
+def typed(value):
+  return {'N': str(value)} if isinstance(value, (int, float)) else {'S': value}
+
+
+def untyped(value):
+  return int(value['N']) if 'N' in value else value['S']
+
+
+class FakeSQS:
+  def __init__(self, latency=0.0, max_wait=0.05):
+    """
+    :param latency: Seconds every call sleeps.
+    :param max_wait: The longest a receive_message call on an empty queue
+                     waits, whatever its WaitTimeSeconds, to keep runs short.
+    """
+    self.counter = CallCounter()
+    self.messages = collections.defaultdict(collections.deque)
+    self.in_flight = collections.defaultdict(dict)
+    self._latency = latency
+    self._max_wait = max_wait
+    self._lock = threading.Lock()
+
+  def _call(self, operation):
+    self.counter.count(f'sqs.{operation}')
+    if self._latency:
+      time.sleep(self._latency)
+
+  def _store(self, queue_url, entry):
+    message_id = str(uuid.uuid4())
+    with self._lock:
+      self.messages[queue_url].append({
+        'MessageId': message_id,
+        'ReceiptHandle': message_id,
+        'Body': entry['MessageBody'],
+        'MessageAttributes': entry.get('MessageAttributes', {}),
+        'Attributes': {'SentTimestamp': str(int(time.time() * 1000)), 'ApproximateReceiveCount': '0'},
+      })
+    return message_id
+
+  def pending(self, queue_url):
+    with self._lock:
+      return len(self.messages[queue_url]) + len(self.in_flight[queue_url])
+
+  def send_message(self, QueueUrl, MessageBody, MessageAttributes=None, **kwargs):
+    self._call('SendMessage')
+    return {'MessageId': self._store(QueueUrl, {'MessageBody': MessageBody, 'MessageAttributes': MessageAttributes or {}})}
+
+  def send_message_batch(self, QueueUrl, Entries):
+    self._call('SendMessageBatch')
+    return {'Successful': [{'Id': entry['Id'], 'MessageId': self._store(QueueUrl, entry)} for entry in Entries], 'Failed': []}
+
+  def receive_message(self, QueueUrl, MaxNumberOfMessages=1, WaitTimeSeconds=0, **kwargs):
+    self._call('ReceiveMessage')
+    received = []
+    with self._lock:
+      queue = self.messages[QueueUrl]
+      while queue and len(received) < MaxNumberOfMessages:
+        message = queue.popleft()
+        message['ReceiptHandle'] = str(uuid.uuid4())
+        attributes = message['Attributes']
+        attributes['ApproximateReceiveCount'] = str(int(attributes['ApproximateReceiveCount']) + 1)
+        self.in_flight[QueueUrl][message['ReceiptHandle']] = message
+        received.append(dict(message))
+    if not received and WaitTimeSeconds:
+      time.sleep(min(WaitTimeSeconds, self._max_wait))
+    return {'Messages': received} if received else {}
+
+  def delete_message_batch(self, QueueUrl, Entries):
+    self._call('DeleteMessageBatch')
+    with self._lock:
+      for entry in Entries:
+        self.in_flight[QueueUrl].pop(entry['ReceiptHandle'], None)
+    return {'Successful': [{'Id': entry['Id']} for entry in Entries], 'Failed': []}
+
+  def change_message_visibility_batch(self, QueueUrl, Entries):
+    self._call('ChangeMessageVisibilityBatch')
+    with self._lock:
+      for entry in Entries:
+        # Only a zero timeout is modeled: the message is visible again.
+        if entry['VisibilityTimeout'] == 0 and entry['ReceiptHandle'] in self.in_flight[QueueUrl]:
+          self.messages[QueueUrl].append(self.in_flight[QueueUrl].pop(entry['ReceiptHandle']))
+    return {'Successful': [{'Id': entry['Id']} for entry in Entries], 'Failed': []}
+
+
+class FakeResponse:
+  def __init__(self, status_code, reason='', text=''):
+    self.status_code = status_code
+    self.reason = reason
+    self.text = text
+    self.headers = {}
+
+  def raise_for_status(self):
+    if self.status_code >= 400:
+      import requests
+      raise requests.exceptions.HTTPError(f'{self.status_code} {self.reason}', response=self)
+
+
+class FakeProviderSession:
+  def __init__(self, name, latency=0.05, error_rate=0.0, status_code=200, seed=None):
+    """
+    Replaces the pooled requests Session of a provider.
+    :param name: The provider name, used in the call counter.
+    :param latency: Seconds every request takes.
+    :param error_rate: The fraction of requests answered with a 503.
+    :param status_code: The status code of successful requests.
+    """
+    self.name = name
+    self.counter = CallCounter()
+    self.latency = latency
+    self.error_rate = error_rate
+    self.status_code = status_code
+    self._random = random.Random(seed)
+    self._lock = threading.Lock()
+
+  def post(self, url, headers=None, json=None, timeout=None):
+    self.counter.count(f'{self.name}.post')
+    if self.latency:
+      time.sleep(self.latency)
+    with self._lock:
+      failed = self._random.random() < self.error_rate
+    if failed:
+      return FakeResponse(503, 'Service Unavailable', 'Service Unavailable')
+    return FakeResponse(self.status_code, 'OK')
@@ -0,0 +1,164 @@
+"""
+Compares the JSON backends of services.codec on the payloads the handlers
+encode and decode: SQS record bodies, notification snapshots, batch
+requests and responses, and a page of logs with DynamoDB Decimal values.
+
+The "json" rows call the standard library the way the handlers used to, with
+only a Decimal hook added. The "codec" rows go through services.codec with
+each backend it can load here; orjson rows are skipped when it isn't
+installed.
+
+  python benchmarks/json_codec.py --seconds 0.5 --log-items 1000
+"""
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import time
+import uuid
+from decimal import Decimal
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def load_codec(backend):
+  """
+  Loads a separate copy of services.codec with JSON_CODEC set to backend.
+  :return: The module, or None when the backend isn't available.
+  """
+  previous = os.environ.get('JSON_CODEC')
+  os.environ['JSON_CODEC'] = backend
+  try:
+    spec = importlib.util.spec_from_file_location(f'codec_{backend}', os.path.join(ROOT, 'services', 'codec.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+  finally:
+    if previous is None:
+      os.environ.pop('JSON_CODEC', None)
+    else:
+      os.environ['JSON_CODEC'] = previous
+  return module if module.BACKEND == backend else None
+
+
+def message_body(i):
+  return {
+    'email': f'user{i}@example.com',
+    'cellphone': f'55279{i:08d}',
+    'email_fields': {'name': f'Usuário {i}', 'link': f'https://example.com/{i}'},
+    'whatsapp_fields': {'name': f'Usuário {i}'},
+  }
+
+
+def notification():
+  return {
+    'notification_id': str(uuid.uuid4()),
+    'updated_at': '2022-09-01T13:00:00.000000+00:00',
+    'title': 'Boas-vindas',
+    'send_email': True,
+    'send_whatsapp': True,
+    'email_id': 'd-8a1f0c2b3e4d4f5a9b6c7d8e9f0a1b2c',
+    'email_fields': ['name', 'link'],
+    'template_name': 'boas_vindas',
+    'whatsapp_fields': ['name'],
+  }
+
+
+def log_page(count):
+  """
+  A listLog response body, as read from DynamoDB: numbers come back as
+  Decimal.
+  """
+  return {
+    'detail': 'Logs retrieved successfully',
+    'result': [
+      {
+        'log_id': str(uuid.uuid4()),
+        'user': 'LUMA',
+        'created_at': f'2022-09-01T13:{i // 60 % 60:02d}:{i % 60:02d}',
+        'log_date': '2022-09-01',
+        'status': '200',
+        'notification_id': 'b1946ac9-2f4c-4c8e-9d1a-3f6e5b7a8c9d',
+        'notification_title': 'Boas-vindas',
+        'message': f'Message d-8a1f0c2b3e4d4f5a9b6c7d8e9f0a1b2c sent to (user{i}@example.com,full_name)',
+        'type': 'email',
+        'to_user': f'user{i}@example.com',
+        'expires_at': Decimal(1662037200 + i),
+      }
+      for i in range(count)
+    ],
+    'cursor': 'eyJkYXkiOiIyMDIyLTA5LTAxIn0',
+  }
+
+
+def batch_response(count):
+  return {
+    'detail': f'Batch 1234: {count} accepted, 0 rejected',
+    'result': [{'index': i, 'accepted': True, 'detail': f'Message {uuid.uuid4()} accepted!'} for i in range(count)],
+  }
+
+
+def json_dumps(value):
+  def default(value):
+    if isinstance(value, Decimal):
+      return int(value) if value == value.to_integral_value() else float(value)
+    raise TypeError(type(value).__name__)
+  return json.dumps(value, default=default)
+
+
+def measure(function, value, seconds):
+  """
+  :return: The microseconds per call, over repeated runs of about seconds.
+  """
+  calls, elapsed = 0, 0.0
+  number = 1
+  while elapsed < seconds:
+    started = time.perf_counter()
+    for _ in range(number):
+      function(value)
+    elapsed += time.perf_counter() - started
+    calls += number
+    number *= 2
+  return elapsed / calls * 1e6
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--seconds', type=float, default=0.5, help='Time spent per payload and backend')
+  parser.add_argument('--log-items', type=int, default=1000, help='Logs in the listLog page')
+  parser.add_argument('--batch-size', type=int, default=100, help='Bodies in the producer_batch request')
+  args = parser.parse_args()
+
+  backends = [('json', json_dumps, json.loads)]
+  for backend in ('stdlib', 'orjson'):
+    codec = load_codec(backend)
+    if codec is None:
+      print(f'codec {backend} is not available, skipped')
+    else:
+      backends.append((f'codec {backend}', codec.dumps, codec.loads))
+
+  body = json.dumps(message_body(1))
+  snapshot = json.dumps(notification(), separators=(',', ':'))
+  batch = json.dumps([message_body(i) for i in range(args.batch_size)])
+  payloads = [
+    ('loads record body', 'loads', body),
+    ('loads notification snapshot', 'loads', snapshot),
+    (f'loads batch request x{args.batch_size}', 'loads', batch),
+    ('dumps record body', 'dumps', message_body(1)),
+    (f'dumps batch response x{args.batch_size}', 'dumps', batch_response(args.batch_size)),
+    (f'dumps listLog page x{args.log_items}', 'dumps', log_page(args.log_items)),
+  ]
+
+  print(f'{"payload":<34} {"backend":<14} {"us/op":>10} {"speedup":>8}')
+  for name, operation, value in payloads:
+    baseline = None
+    for backend, dumps, loads in backends:
+      function = dumps if operation == 'dumps' else loads
+      micros = measure(function, value, args.seconds)
+      baseline = baseline or micros
+      print(f'{name:<34} {backend:<14} {micros:>10.2f} {baseline / micros:>7.2f}x')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,364 @@
+"""
+Offline throughput benchmark for the producer and consumer.
+
+Drives the real handler functions with synthetic events against the
+in-memory stand-ins of benchmarks/fakes.py: DynamoDB and SQS are kept in
+memory, and SendGrid and Botmaker answer from fake sessions with a configurable
+latency and error rate. Every run is appended to benchmarks/results/ with the
+current commit and compared with the previous run of the same scenario.
+
+  python benchmarks/throughput.py
+  python benchmarks/throughput.py --workers 10 --provider-latency 0.1 --batch-sizes 1 10
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import uuid
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS = os.path.join(ROOT, 'benchmarks', 'results', 'throughput.jsonl')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fakes
+
+NOTIFICATION_TABLE = 'notification-table-benchmark'
+LOG_TABLE = 'log-table-benchmark'
+DELIVERY_TABLE = 'delivery-table-benchmark'
+QUEUE_URL = 'https://sqs.us-east-1.amazonaws.com/000000000000/benchmark-jobs'
+QUEUE_ARN = 'arn:aws:sqs:us-east-1:000000000000:benchmark-jobs'
+
+
+def configure(args):
+  """
+  Sets the environment read by the handler modules at import time. It must
+  run before the handlers are imported.
+  """
+  os.environ.update({
+    'NOTIFICATION_TABLE': NOTIFICATION_TABLE,
+    'LOG_TABLE': LOG_TABLE,
+    'DELIVERY_TABLE': DELIVERY_TABLE,
+    'QUEUE_URL': QUEUE_URL,
+    'SENDGRID_API_KEY': 'benchmark',
+    'BOTMAKER_API_KEY': 'benchmark',
+    'CONSUMER_MAX_WORKERS': str(args.workers),
+    'DISPATCH_MODE': 'threads',
+    'SENDGRID_COALESCE': 'true' if args.coalesce else 'false',
+    'SENDGRID_RATE_LIMIT': '0',
+    'BOTMAKER_RATE_LIMIT': '0',
+  })
+  os.environ.pop('IS_OFFLINE', None)
+
+
+def install_fakes(args):
+  from services import aws, http
+  from services.metrics import metrics
+
+  # The handlers still collect their metrics, but the EMF lines would bury
+  # the report.
+  metrics._stream = open(os.devnull, 'w')
+
+  dynamodb = fakes.FakeDynamoResource(latency=args.aws_latency)
+  dynamodb.create_table(NOTIFICATION_TABLE, ['notification_id'])
+  dynamodb.create_table(LOG_TABLE, ['log_id'])
+  dynamodb.create_table(DELIVERY_TABLE, ['delivery_id'])
+  sqs = fakes.FakeSQS(latency=args.aws_latency)
+  aws.set_client('dynamodb', dynamodb)
+  aws.set_client('sqs', sqs)
+
+  providers = {
+    name: fakes.FakeProviderSession(name, latency=args.provider_latency, error_rate=args.error_rate, status_code=status_code, seed=args.seed)
+    for name, status_code in (('sendgrid', 202), ('botmaker', 200))
+  }
+  http._sessions.update(providers)
+  os.register_at_fork(after_in_child=reset_pools)
+  return dynamodb, sqs, providers
+
+
+def seed_notifications(dynamodb, count):
+  from services.notification import version
+
+  notifications = []
+  for i in range(count):
+    notification = {
+      'notification_id': str(uuid.uuid4()),
+      'updated_at': version(),
+      'title': f'Benchmark {i}',
+      'send_email': True,
+      'send_whatsapp': True,
+      'email_id': f'd-benchmark{i}',
+      'email_fields': ['name', 'link'],
+      'template_name': f'benchmark_{i}',
+      'whatsapp_fields': ['name'],
+    }
+    dynamodb.Table(NOTIFICATION_TABLE).write(notification)
+    notifications.append(notification)
+  return notifications
+
+
+def message_body(i):
+  return {
+    'email': f'user{i}@example.com',
+    'cellphone': f'55279{i:08d}',
+    'email_fields': {'name': f'User {i}', 'link': f'https://example.com/{i}'},
+    'whatsapp_fields': {'name': f'User {i}'},
+  }
+
+
+def sqs_event(handler, notifications, batch_size, offset, snapshot=True):
+  """
+  Builds an SQS event with the message attributes the producer sends.
+  """
+  records = []
+  for i in range(batch_size):
+    message_id = str(uuid.uuid4())
+    attributes = handler.message_attributes(notifications[(offset + i) % len(notifications)])
+    if not snapshot:
+      del attributes['notification_snapshot']
+    records.append({
+      'messageId': message_id,
+      'receiptHandle': message_id,
+      'body': json.dumps(message_body(offset + i)),
+      'attributes': {'ApproximateReceiveCount': '1', 'SentTimestamp': str(int(time.time() * 1000))},
+      'messageAttributes': {
+        name: {'stringValue': attribute['StringValue'], 'dataType': attribute['DataType']}
+        for name, attribute in attributes.items()
+      },
+      'eventSource': 'aws:sqs',
+      'eventSourceARN': QUEUE_ARN,
+    })
+  return {'Records': records}
+
+
+def percentile(values, fraction):
+  values = sorted(values)
+  return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def reset_counters(dynamodb, sqs, providers):
+  dynamodb.counter.reset()
+  sqs.counter.reset()
+  for session in providers.values():
+    session.counter.reset()
+
+
+def call_counts(dynamodb, sqs, providers):
+  calls = dict(dynamodb.counter.calls)
+  calls.update(sqs.counter.calls)
+  for session in providers.values():
+    calls.update(session.counter.calls)
+  return calls
+
+
+def summarize(name, messages, elapsed, latencies, calls, failures):
+  aws_calls = sum(count for operation, count in calls.items() if operation.startswith(('dynamodb.', 'sqs.')))
+  provider_calls = sum(count for operation, count in calls.items() if operation.endswith('.post'))
+  return {
+    'scenario': name,
+    'messages': messages,
+    'messages_per_sec': messages / elapsed if elapsed else 0,
+    'p50_ms': percentile(latencies, 0.5) * 1000,
+    'p99_ms': percentile(latencies, 0.99) * 1000,
+    'aws_calls_per_message': aws_calls / messages,
+    'provider_calls_per_message': provider_calls / messages,
+    'failed_messages': failures,
+    'calls': calls,
+  }
+
+
+def bench_consumer(handler, fake, notifications, batch_size, messages, snapshot=True):
+  reset_counters(*fake)
+  latencies, failures, offset = [], 0, 0
+  started = time.perf_counter()
+  while offset < messages:
+    event = sqs_event(handler, notifications, min(batch_size, messages - offset), offset, snapshot)
+    batch_started = time.perf_counter()
+    response = handler.consumer(event, None)
+    batch_elapsed = time.perf_counter() - batch_started
+    # Every record of a batch is acknowledged when the invocation returns.
+    latencies.extend([batch_elapsed] * len(event['Records']))
+    failures += len(response['batchItemFailures'])
+    offset += len(event['Records'])
+  elapsed = time.perf_counter() - started
+  name = f'consumer batch={batch_size} templates={len(notifications)}' + ('' if snapshot else ' no-snapshot')
+  return summarize(name, messages, elapsed, latencies, call_counts(*fake), failures)
+
+
+def bench_producer(handler, fake, notification_ids, messages):
+  reset_counters(*fake)
+  latencies, failures = [], 0
+  started = time.perf_counter()
+  for i in range(messages):
+    event = {'body': json.dumps(message_body(i)), 'pathParameters': {'id': notification_ids[i % len(notification_ids)]}}
+    call_started = time.perf_counter()
+    response = handler.producer(event, None)
+    latencies.append(time.perf_counter() - call_started)
+    failures += response['statusCode'] != 200
+  elapsed = time.perf_counter() - started
+  name = f'producer templates={len(notification_ids)}'
+  return summarize(name, messages, elapsed, latencies, call_counts(*fake), failures)
+
+
+def bench_producer_batch(handler, fake, notification_ids, batch_size, messages):
+  reset_counters(*fake)
+  latencies, failures, offset = [], 0, 0
+  started = time.perf_counter()
+  while offset < messages:
+    size = min(batch_size, messages - offset)
+    event = {
+      'body': json.dumps([message_body(offset + i) for i in range(size)]),
+      'pathParameters': {'id': notification_ids[offset % len(notification_ids)]},
+    }
+    call_started = time.perf_counter()
+    response = handler.producer_batch(event, None)
+    latencies.extend([time.perf_counter() - call_started] * size)
+    failures += sum(1 for item in json.loads(response['body'])['result'] if not item['accepted'])
+    offset += size
+  elapsed = time.perf_counter() - started
+  name = f'producer_batch batch={batch_size} templates={len(notification_ids)}'
+  return summarize(name, messages, elapsed, latencies, call_counts(*fake), failures)
+
+
+def reset_pools():
+  """
+  The earlier scenarios ran the handler in this process, so its thread pools
+  were started here. A forked child gets the pools without their threads and
+  would wait on them forever; it starts its own instead. A deployed worker
+  never runs the handler in the parent, so it doesn't need this.
+  """
+  from services import channels
+  from services.dispatch import Dispatcher
+
+  if isinstance(channels.dispatcher, Dispatcher):
+    channels.dispatcher = Dispatcher(max_workers=int(os.environ['CONSUMER_MAX_WORKERS']), channel_limits=channels.CHANNEL_LIMITS)
+
+
+def bench_worker(handler, fake, notifications, processes, messages):
+  """
+  Runs the standalone worker against the fake queue until every message was
+  processed. With a process pool, the calls the consumer makes in the
+  children aren't counted, only the receives, deletes and visibility changes
+  of the poller.
+  """
+  import threading
+  import worker
+
+  dynamodb, sqs, providers = fake
+  for i in range(messages):
+    event = sqs_event(handler, notifications, 1, i)
+    record = event['Records'][0]
+    attributes = {name: {'StringValue': value['stringValue'], 'DataType': value['dataType']} for name, value in record['messageAttributes'].items()}
+    sqs._store(QUEUE_URL, {'MessageBody': record['body'], 'MessageAttributes': attributes})
+
+  reset_counters(*fake)
+  runner = worker.Worker(sqs, {'high': QUEUE_URL}, processes=processes, wait_seconds=1, shutdown_timeout=5)
+  thread = threading.Thread(target=runner.run)
+  started = time.perf_counter()
+  thread.start()
+  while runner.processed + runner.failed < messages:
+    time.sleep(0.01)
+  elapsed = time.perf_counter() - started
+  runner.stop()
+  thread.join()
+
+  # Batches aren't timed one by one here, so every message reports the mean.
+  latencies = [elapsed / messages * min(processes or 1, messages)] * messages
+  name = f'worker processes={processes} templates={len(notifications)}'
+  return summarize(name, messages, elapsed, latencies, call_counts(*fake), runner.failed)
+
+
+def git_commit():
+  try:
+    return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def previous_results():
+  previous = {}
+  if os.path.exists(RESULTS):
+    with open(RESULTS) as results:
+      for line in results:
+        run = json.loads(line)
+        previous[(run['config'], run['scenario'])] = run
+  return previous
+
+
+def store(results, config):
+  os.makedirs(os.path.dirname(RESULTS), exist_ok=True)
+  commit, now = git_commit(), datetime.now().strftime('%FT%T')
+  with open(RESULTS, 'a') as output:
+    for result in results:
+      output.write(json.dumps(dict(result, config=config, commit=commit, created_at=now)) + '\n')
+
+
+def report(results, previous, config, threshold):
+  print(f'{"scenario":<44} {"msg/s":>9} {"p50 ms":>8} {"p99 ms":>8} {"aws/msg":>8} {"prov/msg":>9} {"failed":>7}  change')
+  regressions = 0
+  for result in results:
+    change = ''
+    before = previous.get((config, result['scenario']))
+    if before and before['messages_per_sec']:
+      delta = result['messages_per_sec'] / before['messages_per_sec'] - 1
+      change = f'{delta:+.1%} vs {before.get("commit") or "previous"}'
+      if delta < -threshold:
+        change += '  REGRESSION'
+        regressions += 1
+    print(f'{result["scenario"]:<44} {result["messages_per_sec"]:>9.1f} {result["p50_ms"]:>8.1f} {result["p99_ms"]:>8.1f} '
+          f'{result["aws_calls_per_message"]:>8.2f} {result["provider_calls_per_message"]:>9.2f} {result["failed_messages"]:>7}  {change}')
+  return regressions
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--messages', type=int, default=200, help='Messages per scenario')
+  parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 10], help='SQS batch sizes sent to the consumer')
+  parser.add_argument('--templates', type=int, nargs='+', default=[1, 5], help='Number of notifications the messages are spread over')
+  parser.add_argument('--workers', type=int, default=10, help='CONSUMER_MAX_WORKERS')
+  parser.add_argument('--worker-processes', type=int, nargs='*', default=[2], help='Process pools of the standalone worker scenarios')
+  parser.add_argument('--no-snapshot', dest='snapshot', action='store_false', help='Send consumer records without the notification snapshot')
+  parser.add_argument('--no-coalesce', dest='coalesce', action='store_false', help='Send one SendGrid request per recipient')
+  parser.add_argument('--provider-latency', type=float, default=0.05, help='Seconds every provider request takes')
+  parser.add_argument('--aws-latency', type=float, default=0.005, help='Seconds every AWS call takes')
+  parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of provider requests answered with a 503')
+  parser.add_argument('--seed', type=int, default=1)
+  parser.add_argument('--threshold', type=float, default=0.1, help='Throughput drop reported as a regression')
+  parser.add_argument('--no-store', dest='store', action='store_false', help="Don't append the results to benchmarks/results")
+  args = parser.parse_args()
+
+  configure(args)
+  fake = install_fakes(args)
+  import handler
+  from services.notification import cache
+
+  config = (f'workers={args.workers} coalesce={args.coalesce} provider_latency={args.provider_latency} '
+            f'aws_latency={args.aws_latency} error_rate={args.error_rate}')
+  results = []
+  for templates in args.templates:
+    notifications = seed_notifications(fake[0], templates)
+    notification_ids = [notification['notification_id'] for notification in notifications]
+    cache.clear()
+    results.append(bench_producer(handler, fake, notification_ids, args.messages))
+    for batch_size in args.batch_sizes:
+      cache.clear()
+      results.append(bench_producer_batch(handler, fake, notification_ids, batch_size, args.messages))
+    for batch_size in args.batch_sizes:
+      cache.clear()
+      results.append(bench_consumer(handler, fake, notifications, batch_size, args.messages, args.snapshot))
+    for processes in args.worker_processes:
+      cache.clear()
+      results.append(bench_worker(handler, fake, notifications, processes, args.messages))
+
+  print(config)
+  regressions = report(results, previous_results(), config, args.threshold)
+  if args.store:
+    store(results, config)
+  sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+  main()
@@ -1,36 +1,53 @@
-import imp
-import json
 import logging
 import os
-import boto3
-from services.mail import Sendgrid
-from services.whatsapp import Botmaker
-from services.notification import Notifications
-from services.log import Log
-from utils import validate_notification_sqs
+import time
+from services import aws, codec
+from services.handlers import lookup_notification, message_attributes, request_priority, table_exists
+from services.idempotency import BUSY, CLAIMED, DeliveryStore, delivery_key
+from services.lanes import BULK, HIGH, queue_url, resolve_lane
+from services.notification import Notifications, cache as notification_cache, from_snapshot, is_newer
+from services.log import LogBuffer
+from services.metrics import metrics
+from services.profiling import profiled
+from services.queue import Queue, queue_url_from_arn
+from services.schedule import MAX_DELAY_SECONDS, Schedule, delay_seconds, parse_send_at
+from services.validation import validator_for
+from utils import validate_notification_body
 from datetime import datetime
 
 logger = logging.getLogger(__name__)
 
 
-QUEUE_URL = os.getenv('QUEUE_URL')
-SQS = boto3.client('sqs')
 NOTIFICATION_TABLE = os.environ['NOTIFICATION_TABLE']
 LOG_TABLE = os.environ['LOG_TABLE']
+DELIVERY_TABLE = os.environ.get('DELIVERY_TABLE')
+SCHEDULE_TABLE = os.environ.get('SCHEDULE_TABLE')
+# A snapshot is trusted no longer than a cached definition, so an update or a
+# delete made through another container reaches the consumer as soon as it
+# would with the cache alone.
+SNAPSHOT_MAX_AGE = min(float(os.environ.get('NOTIFICATION_SNAPSHOT_MAX_AGE', notification_cache.ttl)), notification_cache.ttl)
 IS_OFFLINE = os.environ.get('IS_OFFLINE')
 
 if IS_OFFLINE:
     logger.setLevel(logging.DEBUG)
-    client = boto3.resource(
-        'dynamodb',
-        region_name='localhost',
-        endpoint_url='http://localhost:8000'
-    )
-else:
-    client = boto3.resource('dynamodb')
 
 
+@profiled
+@metrics.flush_after
 def producer(event, context):
+    log = LogBuffer(aws.dynamodb())
+    log_exists = table_exists(log, LOG_TABLE)
+    if not log_exists:
+        logger.info('500 table log does not exists')
+        return
+
+    try:
+        return produce(event, log)
+    finally:
+        log.flush()
+
+
+def produce(event, log):
     now = datetime.now()
     status_code = 200
     message = ''
@@ -38,33 +55,54 @@ def producer(event, context):
     pathParameters = event.get('pathParameters')
     if not body:
         log.add_log("LUMA", now, 400, "No body was found", "api_call", "", "", "")
-        return {'statusCode': 400, 'body': json.dumps({'message': 'No body was found'})}
+        return {'statusCode': 400, 'body': codec.dumps({'message': 'No body was found'})}
 
     if not pathParameters:
         log.add_log("LUMA", now, 400, "No notification Id was provided", "api_call", "", "", "")
-        return {'statusCode': 400, 'body': json.dumps({'message': 'No notification Id was provided'})}
+        return {'statusCode': 400, 'body': codec.dumps({'message': 'No notification Id was provided'})}
 
-    log = Log(client)
-    log_exists = log.exists(LOG_TABLE)
-    if not log_exists:
-        logger.info(f'500 table log does not exists')
-        return
+    try:
+        send_at = request_send_at(event)
+    except ValueError as e:
+        log.add_log("LUMA", now, 400, str(e), "api_call", "", "", "")
+        return {'statusCode': 400, 'body': codec.dumps({'detail': str(e)})}
 
-    is_valid, message = validate_notification_sqs(pathParameters['id'], json.loads(body))
+    try:
+        item = codec.loads(body)
+    except ValueError as e:
+        log.add_log("LUMA", now, 400, f"Body is not valid JSON: {e}", "api_call", "", "", "")
+        return {'statusCode': 400, 'body': codec.dumps({'detail': f'Body is not valid JSON: {e}'})}
+
+    notification_id = pathParameters['id']
+    is_valid, message, notification = lookup_and_validate(notification_id, item)
     if not is_valid:
         log.add_log("LUMA", now, 400, message, "api_call", "", "", "")
-        return {'statusCode': 400, 'body': json.dumps({'detail': message})}
+        return {'statusCode': 400, 'body': codec.dumps({'detail': message})}
+
+    try:
+        lane = resolve_lane(request_priority(event), notification, HIGH)
+    except ValueError as e:
+        log.add_log("LUMA", now, 400, str(e), "api_call", "", "", "")
+        return {'statusCode': 400, 'body': codec.dumps({'detail': str(e)})}
 
     try:
-        message_attrs = {
-            'notification_id': {'StringValue': pathParameters['id'], 'DataType': 'String'}
-        }
-        SQS.send_message(
-            QueueUrl=QUEUE_URL,
-            MessageBody=event['body'],
-            MessageAttributes=message_attrs,
-        )
-        message = f'Message {pathParameters["id"]} accepted!'
+        message_attrs = message_attributes(notification, lane, send_at)
+        delay = delay_seconds(send_at) if send_at else 0
+        if delay > MAX_DELAY_SECONDS:
+            entry = {'Id': '0', 'MessageBody': event['body'], 'MessageAttributes': message_attrs}
+            accepted, message = schedule_entries([entry], send_at, lane)['0']
+            status_code = 200 if accepted else 500
+            if accepted:
+                message = f'Message {notification_id} {message}'
+        else:
+            with metrics.timer('sqs_enqueue', Template=notification_id):
+                aws.sqs().send_message(
+                    QueueUrl=queue_url(lane),
+                    MessageBody=event['body'],
+                    MessageAttributes=message_attrs,
+                    DelaySeconds=delay,
+                )
+            message = f'Message {notification_id} accepted!'
     except Exception as e:
         logger.exception('Sending message to SQS queue failed!')
 
@@ -72,54 +110,390 @@ def producer(event, context):
         status_code = 500
 
     log.add_log("LUMA", now, status_code, message, "api_call", "", "", "")
-    return {'statusCode': status_code, 'body': json.dumps({'detail': message})}
+    return {'statusCode': status_code, 'body': codec.dumps({'detail': message})}
+
+
+def request_send_at(event):
+    """
+    :return: The aware datetime of the send_at query parameter, or None when
+             the message is sent right away. Raises ValueError when invalid.
+    """
+    value = (event.get('queryStringParameters') or {}).get('send_at')
+    return parse_send_at(value) if value else None
+
+
+def schedule_entries(entries, send_at, lane):
+    """
+    Stores SendMessageBatch entries in the schedule table, to be enqueued by
+    the sweeper to the lane's queue at send_at.
+    :return: A dict that maps every entry Id to an (accepted, message) tuple.
+    """
+    schedule = Schedule(aws.dynamodb())
+    if not SCHEDULE_TABLE or not schedule.exists(SCHEDULE_TABLE):
+        return {entry['Id']: (False, 'Scheduled sends are not available') for entry in entries}
+
+    # The snapshot is dropped: the message would reach the consumer long
+    # after the snapshot was taken, so the consumer reads the notification.
+    messages = [
+        (entry['MessageBody'], {name: attr for name, attr in entry['MessageAttributes'].items() if name != 'notification_snapshot'})
+        for entry in entries
+    ]
+    with metrics.timer('schedule_store') as stage:
+        job_ids = schedule.add_jobs(send_at, messages, lane)
+        stage.count = len(entries)
+        failed = job_ids.count(None)
+        if failed:
+            stage.error, stage.failed = 'UnprocessedItems', failed
+
+    scheduled = f'scheduled for {send_at.strftime("%Y-%m-%dT%H:%M:%SZ")}'
+    return {
+        entry['Id']: (True, scheduled) if job_id else (False, "Couldn't schedule the message")
+        for entry, job_id in zip(entries, job_ids)
+    }
+
+
+def lookup_and_validate(notification_id, body):
+    """
+    Loads a notification and validates a message body against it, timing
+    each stage.
+    :return: A tuple with a success flag, a message and the notification.
+    """
+    found, message, notification = lookup_notification(notification_id)
+    if not found:
+        return False, message, notification
+
+    with metrics.timer('validation', Template=notification_id) as stage:
+        is_valid, message = validate_notification_body(notification, body)
+        if not is_valid:
+            stage.error = 'InvalidBody'
+    return is_valid, message, notification
+
+
+@metrics.flush_after
+def producer_batch(event, context):
+    log = LogBuffer(aws.dynamodb())
+    log_exists = table_exists(log, LOG_TABLE)
+    if not log_exists:
+        logger.info('500 table log does not exists')
+        return
+
+    try:
+        return produce_batch(event, log)
+    finally:
+        log.flush()
+
+
+def produce_batch(event, log):
+    """
+    Validates a list of message bodies against one notification and enqueues
+    the valid ones with SendMessageBatch.
+    :return: A response with the accept/reject result of every item.
+    """
+    now = datetime.now()
+    body = event.get('body')
+    pathParameters = event.get('pathParameters')
+    if not body:
+        log.add_log("LUMA", now, 400, "No body was found", "api_call", "", "", "")
+        return {'statusCode': 400, 'body': codec.dumps({'detail': 'No body was found'})}
+
+    if not pathParameters:
+        log.add_log("LUMA", now, 400, "No notification Id was provided", "api_call", "", "", "")
+        return {'statusCode': 400, 'body': codec.dumps({'detail': 'No notification Id was provided'})}
+
+    try:
+        send_at = request_send_at(event)
+    except ValueError as e:
+        log.add_log("LUMA", now, 400, str(e), "api_call", "", "", "")
+        return {'statusCode': 400, 'body': codec.dumps({'detail': str(e)})}
+
+    try:
+        items = codec.loads(body)
+    except ValueError as e:
+        log.add_log("LUMA", now, 400, f"Body is not valid JSON: {e}", "api_call", "", "", "")
+        return {'statusCode': 400, 'body': codec.dumps({'detail': f'Body is not valid JSON: {e}'})}
+
+    if not isinstance(items, list) or not items:
+        log.add_log("LUMA", now, 400, "Body must be a non-empty list of messages", "api_call", "", "", "")
+        return {'statusCode': 400, 'body': codec.dumps({'detail': 'Body must be a non-empty list of messages'})}
+
+    notification_id = pathParameters['id']
+    found, message, notification = lookup_notification(notification_id)
+    if not found:
+        log.add_log("LUMA", now, 400, message, "api_call", "", "", "")
+        return {'statusCode': 400, 'body': codec.dumps({'detail': message})}
+
+    try:
+        lane = resolve_lane(request_priority(event), notification, BULK)
+    except ValueError as e:
+        log.add_log("LUMA", now, 400, str(e), "api_call", "", "", "")
+        return {'statusCode': 400, 'body': codec.dumps({'detail': str(e)})}
+
+    results = []
+    entries = []
+    attributes = message_attributes(notification, lane, send_at)
+    validator = validator_for(notification)
+    with metrics.timer('validation', Template=notification_id) as stage:
+        for index, item in enumerate(items):
+            is_valid, message = validator.validate(item)
+            results.append({'index': index, 'accepted': is_valid, 'detail': message})
+            if is_valid:
+                entries.append({
+                    'Id': str(index),
+                    'MessageBody': codec.dumps(item),
+                    'MessageAttributes': attributes,
+                })
+        stage.count = len(items)
+        if len(entries) < len(items):
+            stage.error, stage.failed = 'InvalidBody', len(items) - len(entries)
+
+    delay = delay_seconds(send_at) if send_at else 0
+    if delay > MAX_DELAY_SECONDS:
+        sent = schedule_entries(entries, send_at, lane)
+    else:
+        if delay:
+            entries = [dict(entry, DelaySeconds=delay) for entry in entries]
+        with metrics.timer('sqs_enqueue', Template=notification_id) as stage:
+            sent = Queue(aws.sqs(), queue_url(lane)).send_messages(entries)
+            stage.count = len(entries)
+            rejected = sum(1 for accepted, _ in sent.values() if not accepted)
+            if rejected:
+                stage.error, stage.failed = 'BatchEntryFailed', rejected
+    for entry in entries:
+        accepted, message = sent.get(entry['Id'], (False, 'No response from queue'))
+        result = results[int(entry['Id'])]
+        result['accepted'] = accepted
+        result['detail'] = message
 
+    accepted_count = sum(1 for result in results if result['accepted'])
+    message = f'Batch {notification_id}: {accepted_count} accepted, {len(results) - accepted_count} rejected'
+    log.add_log("LUMA", now, 200, message, "api_call", "", notification_id, notification["title"])
+    return {'statusCode': 200, 'body': codec.dumps({'detail': message, 'result': results})}
 
+
+@profiled
+@metrics.flush_after
 def consumer(event, context):
+    """
+    Processes a batch of SQS records and reports the records that failed, so
+    only those are redelivered by the queue.
+    """
+    notifications = Notifications(aws.dynamodb())
+    notifications_exists = table_exists(notifications, NOTIFICATION_TABLE)
+    if not notifications_exists:
+        logger.info('500 table notification does not exists')
+        return batch_response(record['messageId'] for record in event['Records'])
+
+    log = LogBuffer(aws.dynamodb())
+    log_exists = table_exists(log, LOG_TABLE)
+    if not log_exists:
+        logger.info('500 table log does not exists')
+        return batch_response(record['messageId'] for record in event['Records'])
+
+    store = None
+    if DELIVERY_TABLE:
+        store = DeliveryStore(aws.dynamodb())
+        if not table_exists(store, DELIVERY_TABLE):
+            logger.info('500 table delivery does not exists')
+            return batch_response(record['messageId'] for record in event['Records'])
+
+    try:
+        failed = consume(event, context, notifications, log, store)
+    finally:
+        log.flush()
+
+    logger.info(f'Notification cache stats: {notification_cache.stats()}')
+    return batch_response(failed)
+
+
+def batch_response(message_ids):
+    return {'batchItemFailures': [{'itemIdentifier': message_id} for message_id in message_ids]}
+
+
+def consume(event, context, notifications, log, store=None):
+    """
+    Sends every record of the batch. With a delivery store, the channels
+    already delivered for a record are skipped, and the records with a channel
+    another invocation is sending are failed to be retried later. A channel
+    rejected for good by its provider, with a 4xx other than 408 or 429, is
+    logged and not retried.
+    :return: The message ids of the records to retry, in batch order.
+    """
+    from services import channels
+
+    failed = set()
+    deliveries = []
     for record in event['Records']:
-        now = datetime.now()
-        body = json.loads(record["body"])
-        notification_id = record["messageAttributes"]["notification_id"]["stringValue"]
-
-        notifications = Notifications(client)
-        notifications_exists = notifications.exists(NOTIFICATION_TABLE)
-        if not notifications_exists:
-            logger.info(f'500 table notification does not exists')
-            return
-
-        log = Log(client)
-        log_exists = log.exists(LOG_TABLE)
-        if not log_exists:
-            logger.info(f'500 table log does not exists')
-            return
-
-        status_code, message, notification = notifications.get_notification_by_id(notification_id)
-        send_email = notification["send_email"]
-        send_whatsapp = notification["send_whatsapp"]
-
-        if status_code == 200:
-            if send_email:
-                to_emails = [(body["email"], "full_name"),]
-
-                sendgrid = Sendgrid()
-                status_code, message = sendgrid.send_template_email(notification["email_id"], to_emails, body["email_fields"])
-
-                log.add_log("LUMA", now, status_code, message,"email", notification["email_id"], notification.notification_id, notification.title)
-
-            if send_whatsapp:
-                cellphone = body["cellphone"]
-
-                payload = {
-                    "chatPlatform": "whatsapp",
-                    "chatChannelNumber": "5527996989507",
-                    "platformContactId": cellphone,
-                    "ruleNameOrId": notification["template_name"],
-                    "params": body["whatsapp_fields"]
-                }
-
-                whatsapp = Botmaker()
-                status_code, message = whatsapp.send_message(payload)
-
-                log.add_log("LUMA", now, status_code, message, "whatsapp", cellphone, notification.notification_id, notification.title)
+        record_queue_age(record)
+        try:
+            notification, body, now = read_record(record, notifications)
+        except Exception:
+            logger.exception(f'Reading message {record.get("messageId")} failed!')
+            notification = None
+
+        if notification is None:
+            failed.add(record['messageId'])
         else:
-            logger.error(f"Couldn't find the notification {notification_id} to send. Here is the error message: {message}")
+            deliveries.extend(channels.build_deliveries(record, notification, body, now))
+
+    def completed(delivery):
+        # Logged as soon as it is sent, so a timeout later in the batch only
+        # loses the entries that weren't flushed in time.
+        notification = delivery.notification
+        log.add_log("LUMA", delivery.created_at, delivery.status_code, delivery.message, delivery.channel, delivery.to_user, notification["notification_id"], notification["title"])
+        log.flush_if_running_out(context)
+
+    deliveries, busy = claim_deliveries(deliveries, store)
+    failed.update(busy)
+    channels.dispatch(deliveries, completed)
+    finish_deliveries(deliveries, store)
+
+    deferred = {}
+    for delivery in deliveries:
+        if delivery.succeeded:
+            continue
+        if not delivery.retryable:
+            logger.warning(f'Delivery {delivery_key(delivery.message_id, delivery.channel)} failed with status {delivery.status_code}, not retrying it')
+            continue
+
+        failed.add(delivery.message_id)
+        delay = channels.retry_delay(delivery)
+        if delay is not None:
+            deferred[delivery.message_id] = max(deferred.get(delivery.message_id, 0), delay)
+
+    defer_records(event['Records'], deferred)
+    return [record['messageId'] for record in event['Records'] if record['messageId'] in failed]
+
+
+def record_queue_age(record):
+    """
+    Records how long a record waited in its lane's queue, counted from the
+    time it was due.
+    """
+    sent_at = int(record.get('attributes', {}).get('SentTimestamp', 0)) / 1000
+    if not sent_at:
+        return
+
+    attributes = record.get('messageAttributes', {})
+    due_at = sent_at
+    if 'send_at' in attributes:
+        due_at = max(due_at, int(attributes['send_at']['stringValue']))
+    lane = attributes.get('lane', {}).get('stringValue', HIGH)
+    metrics.record('queue_age', max(0, time.time() - due_at), Lane=lane)
+
+
+def claim_deliveries(deliveries, store):
+    """
+    Claims the deliveries of a batch before they are sent, so two invocations
+    that received the same message don't both send it.
+    :return: The deliveries to send, and the message ids of the records with
+             a delivery another invocation is sending, to be retried later.
+    """
+    if store is None or not deliveries:
+        return deliveries, set()
+
+    with metrics.timer('idempotency_claim') as stage:
+        stage.count = len(deliveries)
+        states = store.claim([(delivery.message_id, delivery.channel) for delivery in deliveries])
+        busy = sum(1 for state in states.values() if state == BUSY)
+        if busy:
+            stage.error, stage.failed = 'InProgress', busy
+
+    claimed, retried = [], set()
+    for delivery in deliveries:
+        key = delivery_key(delivery.message_id, delivery.channel)
+        if states[key] == CLAIMED:
+            claimed.append(delivery)
+        elif states[key] == BUSY:
+            logger.info(f'Delivery {key} is being sent by another invocation, retrying it later')
+            retried.add(delivery.message_id)
+        else:
+            logger.info(f'Delivery {key} was already done, skipping it')
+    return claimed, retried
+
+
+def finish_deliveries(deliveries, store):
+    """
+    Records the finished deliveries, so a redelivery of their record skips
+    them, and releases the claims of the ones to retry. A delivery that
+    failed for good is finished too, so it isn't sent again when another
+    channel of its record is retried.
+    """
+    if store is None or not deliveries:
+        return
+
+    done = [(delivery.message_id, delivery.channel) for delivery in deliveries if not delivery.retryable]
+    released = [(delivery.message_id, delivery.channel) for delivery in deliveries if delivery.retryable]
+    with metrics.timer('idempotency_write') as stage:
+        stage.count = len(deliveries)
+        failed = store.finish(done, released)
+        if failed:
+            stage.error, stage.failed = 'UnprocessedItems', failed
+
+
+def defer_records(records, delays):
+    """
+    Pushes records back to their queue with a visibility delay, so a record
+    throttled by a provider, or failed fast by its circuit breaker, is retried
+    once the provider has budget again or the breaker probes it, instead of
+    after the queue's visibility timeout.
+    :param records: The records of the batch.
+    :param delays: A dict that maps message ids to the delay in seconds.
+    """
+    by_queue = {}
+    for record in records:
+        if record['messageId'] in delays and record.get('eventSourceARN'):
+            # Records of the standalone worker carry the URL of their queue.
+            url = record.get('queueUrl') or queue_url_from_arn(record['eventSourceARN'])
+            by_queue.setdefault(url, []).append((record['receiptHandle'], delays[record['messageId']]))
+
+    for url, entries in by_queue.items():
+        logger.info(f'Deferring {len(entries)} messages of {url}')
+        with metrics.timer('sqs_defer') as stage:
+            stage.count = len(entries)
+            failed = Queue(aws.sqs(), url).change_visibility(entries)
+            if failed:
+                stage.error, stage.failed = 'BatchEntryFailed', failed
+
+
+def read_record(record, notifications):
+    """
+    :return: The notification, body and reception time of a record. The
+             notification is None when it can't be loaded.
+    """
+    now = datetime.now()
+    body = codec.loads(record["body"])
+    notification_id = record["messageAttributes"]["notification_id"]["stringValue"]
+
+    notification = record_snapshot(record)
+    if notification is not None:
+        cached = notification_cache.peek(notification_id)
+        if cached is not None and is_newer(cached, notification):
+            return cached, body, now
+        return notification, body, now
+
+    with metrics.timer('notification_lookup', Template=notification_id) as stage:
+        status_code, message, notification = notifications.get_notification_by_id(notification_id, use_cache=True)
+        if status_code != 200:
+            stage.error = f'HTTP{status_code}'
+    if status_code != 200:
+        logger.error(f"Couldn't find the notification {notification_id} to send. Here is the error message: {message}")
+        return None, body, now
+
+    return notification, body, now
+
+
+def record_snapshot(record):
+    """
+    :return: The notification snapshot the producer sent with a record, or
+             None when there is none or the record is older than
+             SNAPSHOT_MAX_AGE, so the notification must be read again.
+    """
+    attribute = record["messageAttributes"].get("notification_snapshot")
+    if not attribute:
+        return None
+
+    sent_at = int(record.get("attributes", {}).get("SentTimestamp", 0)) / 1000
+    if sent_at and time.time() - sent_at > SNAPSHOT_MAX_AGE:
+        return None
+
+    return from_snapshot(attribute.get("stringValue"))
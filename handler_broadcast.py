@@ -0,0 +1,176 @@
+import base64
+import logging
+import os
+import uuid
+from datetime import datetime
+from botocore.exceptions import ClientError
+from services import aws, codec
+from services.broadcast import (
+  CHUNK_SIZE, COMPLETED, FAILED, RUNNING, Broadcasts, parse_lines, progress, read_lines, send_entries, windows
+)
+from services.handlers import lookup_notification, message_attributes, request_priority, table_exists
+from services.lanes import BULK, queue_url, resolve_lane
+from services.log import LogBuffer
+from services.metrics import metrics
+from services.queue import Queue
+from services.validation import definition_errors, validator_for
+
+logger = logging.getLogger(__name__)
+
+LOG_TABLE = os.environ['LOG_TABLE']
+BROADCAST_TABLE = os.environ.get('BROADCAST_TABLE')
+BROADCAST_BUCKET = os.environ.get('BROADCAST_BUCKET')
+BROADCAST_FUNCTION = os.environ.get('BROADCAST_FUNCTION')
+# The run stops and hands the job over to a new invocation below this
+# remaining time, enough to finish a window and save its checkpoint.
+MIN_REMAINING_MS = int(os.environ.get('BROADCAST_MIN_REMAINING_MS', 30000))
+
+
+@metrics.flush_after
+def start(event, context):
+  """
+  Starts sending a notification to a recipient list: one message body per
+  line, either as the NDJSON request body or in an object uploaded to the
+  broadcast bucket, given by the key query parameter.
+  """
+  log = LogBuffer(aws.dynamodb())
+  if not table_exists(log, LOG_TABLE):
+    logger.info('500 table log does not exists')
+    return
+
+  try:
+    return start_broadcast(event, log)
+  finally:
+    log.flush()
+
+
+def start_broadcast(event, log):
+  now = datetime.now()
+  params = event.get('queryStringParameters') or {}
+  pathParameters = event.get('pathParameters')
+  if not pathParameters:
+    log.add_log("LUMA", now, 400, "No notification Id was provided", "api_call", "", "", "")
+    return {'statusCode': 400, 'body': codec.dumps({'detail': 'No notification Id was provided'})}
+
+  broadcasts = Broadcasts(aws.dynamodb())
+  if not BROADCAST_TABLE or not BROADCAST_BUCKET or not broadcasts.exists(BROADCAST_TABLE):
+    return {'statusCode': 500, 'body': codec.dumps({'detail': 'Broadcasts are not available'})}
+
+  notification_id = pathParameters['id']
+  found, message, notification = lookup_notification(notification_id)
+  if found:
+    errors = definition_errors(notification)
+    found, message = not errors, '; '.join(errors)
+  if not found:
+    log.add_log("LUMA", now, 400, message, "api_call", "", "", "")
+    return {'statusCode': 400, 'body': codec.dumps({'detail': message})}
+
+  try:
+    lane = resolve_lane(request_priority(event), notification, BULK)
+  except ValueError as e:
+    log.add_log("LUMA", now, 400, str(e), "api_call", "", "", "")
+    return {'statusCode': 400, 'body': codec.dumps({'detail': str(e)})}
+
+  broadcast_id, key = str(uuid.uuid4()), params.get('key')
+  try:
+    if key:
+      size = aws.s3().head_object(Bucket=BROADCAST_BUCKET, Key=key)['ContentLength']
+    else:
+      body = event.get('body')
+      if not body:
+        log.add_log("LUMA", now, 400, "No body was found", "api_call", "", "", "")
+        return {'statusCode': 400, 'body': codec.dumps({'detail': 'No body was found'})}
+      data = base64.b64decode(body) if event.get('isBase64Encoded') else body.encode('utf-8')
+      # The inline list is stored like an uploaded one, so every run, and
+      # every resumed run, streams it from S3.
+      key, size = f'inline/{broadcast_id}.ndjson', len(data)
+      aws.s3().put_object(Bucket=BROADCAST_BUCKET, Key=key, Body=data, ContentType='application/x-ndjson')
+  except ClientError as err:
+    message = f"Couldn't read the recipient list {key}. Here's why: {err.response['Error']['Code']}: {err.response['Error']['Message']}"
+    logger.error(message)
+    status_code = 400 if err.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound') else 500
+    log.add_log("LUMA", now, status_code, message, "api_call", "", notification_id, notification["title"])
+    return {'statusCode': status_code, 'body': codec.dumps({'detail': message})}
+
+  job = broadcasts.create(notification_id, lane, BROADCAST_BUCKET, key, size, broadcast_id)
+  invoke_run(job['broadcast_id'], BROADCAST_FUNCTION)
+
+  message = f"Broadcast {job['broadcast_id']} of {notification_id} started"
+  log.add_log("LUMA", now, 202, message, "api_call", "", notification_id, notification["title"])
+  return {'statusCode': 202, 'body': codec.dumps({'detail': message, 'result': progress(job)})}
+
+
+def status(event, context):
+  """
+  Reports the progress of a broadcast.
+  """
+  broadcast_id = (event.get('pathParameters') or {}).get('id')
+  broadcasts = Broadcasts(aws.dynamodb())
+  if not BROADCAST_TABLE or not broadcasts.exists(BROADCAST_TABLE):
+    return {'statusCode': 500, 'body': codec.dumps({'detail': 'Broadcasts are not available', 'result': {}})}
+
+  job = broadcasts.get(broadcast_id) if broadcast_id else None
+  if job is None:
+    return {'statusCode': 404, 'body': codec.dumps({'detail': f'Broadcast {broadcast_id} was not found', 'result': {}})}
+  return {'statusCode': 200, 'body': codec.dumps({'detail': job['status'], 'result': progress(job)})}
+
+
+def invoke_run(broadcast_id, function_name):
+  aws.lambda_().invoke(
+    FunctionName=function_name,
+    InvocationType='Event',
+    Payload=codec.dumps({'broadcast_id': broadcast_id}).encode('utf-8')
+  )
+
+
+@metrics.flush_after
+def run(event, context):
+  """
+  Streams the recipient list of a broadcast from its last checkpoint and
+  enqueues a message per valid line. When the invocation runs out of time,
+  it saves its checkpoint and invokes itself again to resume from it.
+  """
+  broadcasts = Broadcasts(aws.dynamodb())
+  if not broadcasts.exists(BROADCAST_TABLE):
+    logger.info('500 table broadcast does not exists')
+    return
+
+  job = broadcasts.get(event['broadcast_id'])
+  if job is None or job['status'] != RUNNING:
+    logger.info(f"Broadcast {event['broadcast_id']} is not running, nothing to do")
+    return
+
+  found, message, notification = lookup_notification(job['notification_id'])
+  if not found:
+    broadcasts.checkpoint(job, job['offset'], status=FAILED, detail=message)
+    return
+
+  validator = validator_for(notification)
+  attributes = message_attributes(notification, job['lane'])
+  queue = Queue(aws.sqs(), queue_url(job['lane']))
+
+  offset = int(job['offset'])
+  if offset < int(job['size']):
+    params = {'Bucket': job['bucket'], 'Key': job['key']}
+    if offset:
+      params['Range'] = f'bytes={offset}-'
+    stream = aws.s3().get_object(**params)['Body']
+
+    for window in windows(read_lines(stream.iter_chunks(CHUNK_SIZE), offset)):
+      with metrics.timer('broadcast_enqueue', Template=job['notification_id']) as stage:
+        entries, rejected = parse_lines(window, validator, attributes, int(job['lines']) + 1)
+        failed = send_entries(queue, entries)
+        stage.count = len(entries)
+        if failed:
+          stage.error, stage.failed = 'BatchEntryFailed', failed
+
+      if not broadcasts.checkpoint(job, window[-1][1], len(window), len(entries) - failed, rejected, failed):
+        return
+
+      if context is not None and context.get_remaining_time_in_millis() < MIN_REMAINING_MS:
+        logger.info(f"Broadcast {job['broadcast_id']} stopped at offset {job['offset']}, resuming in a new invocation")
+        invoke_run(job['broadcast_id'], context.function_name)
+        return
+
+  broadcasts.checkpoint(job, int(job['size']), status=COMPLETED)
+  logger.info(f"Broadcast {job['broadcast_id']} completed: {progress(job)}")
@@ -1,41 +1,65 @@
-import json
 import os
-import boto3
+from services import aws, codec
+from datetime import datetime, timedelta
 from services.log import Log
+from services.pagination import decode_cursor, encode_cursor
 
 
 LOG_TABLE = os.environ['LOG_TABLE']
-IS_OFFLINE = os.environ.get('IS_OFFLINE')
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 1000
 
-if IS_OFFLINE:
-  client = boto3.resource(
-    'dynamodb',
-    region_name='localhost',
-    endpoint_url='http://localhost:8000'
-  )
-else:
-  client = boto3.resource('dynamodb')
 
+def parse_datetime(value, end_of_day=False):
+  """
+  Parses a date ("2022-09-01") or a datetime ("2022-09-01T10:00:00") query
+  parameter. A date used as the end of a range covers the whole day.
+  """
+  if len(value) == 10:
+    dt = datetime.strptime(value, "%Y-%m-%d")
+    return dt + timedelta(days=1, seconds=-1) if end_of_day else dt
+  return datetime.strptime(value, "%Y-%m-%dT%H:%M:%S")
 
 def listLog(event, context):
 
-  logs = Log(client)
+  params = event.get("queryStringParameters") or {}
+  try:
+    end = parse_datetime(params["to"], end_of_day=True) if params.get("to") else datetime.now()
+    start = parse_datetime(params["from"]) if params.get("from") else end - timedelta(days=7)
+    limit = int(params.get("limit", DEFAULT_LIMIT))
+    cursor = decode_cursor(params.get("cursor"))
+  except ValueError as e:
+    return {"statusCode": 400, "body": codec.dumps({"detail": str(e), "result": []})}
+
+  if limit <= 0 or limit > MAX_LIMIT:
+    return {"statusCode": 400, "body": codec.dumps({"detail": f"limit must be between 1 and {MAX_LIMIT}", "result": []})}
+
+  logs = Log(aws.dynamodb())
   logs_exists = logs.exists(LOG_TABLE)
   if not logs_exists:
     return {
       "statusCode": 500,
-      "body": json.dumps({
+      "body": codec.dumps({
         "detail": "Table log does not exists",
         "result": {}
       })
     }
 
-  status_code, message, results = logs.scan_log()
+  status_code, message, results, next_page = logs.query_logs(
+    start,
+    end,
+    notification_id=params.get("notification_id"),
+    type_message=params.get("type"),
+    status=params.get("status"),
+    limit=limit,
+    cursor=cursor
+  )
 
   return {
     "statusCode": status_code,
-    "body": json.dumps({
+    "body": codec.dumps({
       "detail": message,
-      "result": results
+      "result": results,
+      "cursor": encode_cursor(next_page)
     })
   }
@@ -1,34 +1,26 @@
-import json
 import os
-import boto3
+from services import aws, codec
 from services.notification import Notifications
+from services.pagination import decode_cursor, encode_cursor
 
 
 NOTIFICATION_TABLE = os.environ['NOTIFICATION_TABLE']
-IS_OFFLINE = os.environ.get('IS_OFFLINE')
-
-if IS_OFFLINE:
-  client = boto3.resource(
-    'dynamodb',
-    region_name='localhost',
-    endpoint_url='http://localhost:8000'
-  )
-else:
-  client = boto3.resource('dynamodb')
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
 
 def createNotification(event, context):
 
   if not event.get("body"):
-    return {"statusCode": 400, "body": json.dumps({"detail": "No body was found"})}
+    return {"statusCode": 400, "body": codec.dumps({"detail": "No body was found"})}
 
-  body = json.loads(event["body"])
+  body = codec.loads(event["body"])
 
-  notifications = Notifications(client)
+  notifications = Notifications(aws.dynamodb())
   notifications_exists = notifications.exists(NOTIFICATION_TABLE)
   if not notifications_exists:
     return {
       "statusCode": 500,
-      "body": json.dumps({
+      "body": codec.dumps({
         "detail": "Table does not exists"
       })
     }
@@ -37,7 +29,7 @@ def createNotification(event, context):
 
   return {
     "statusCode": status_code,
-    "body": json.dumps({
+    "body": codec.dumps({
       "detail": message,
       "result": result
     })
@@ -47,14 +39,14 @@ def getNotification(event, context):
 
   pathParameters = event.get("pathParameters")
   if not pathParameters:
-    return {"statusCode": 400, "body": json.dumps({"detail": "No pathParameters was found"})}
+    return {"statusCode": 400, "body": codec.dumps({"detail": "No pathParameters was found"})}
 
-  notifications = Notifications(client)
+  notifications = Notifications(aws.dynamodb())
   notifications_exists = notifications.exists(NOTIFICATION_TABLE)
   if not notifications_exists:
     return {
       "statusCode": 500,
-      "body": json.dumps({
+      "body": codec.dumps({
         "detail": "Table does not exists",
         "result": {}
       })
@@ -63,7 +55,7 @@ def getNotification(event, context):
   status_code, message, result = notifications.get_notification_by_id(pathParameters["id"])
   return {
     "statusCode": status_code,
-    "body": json.dumps({
+    "body": codec.dumps({
       "detail": message,
       "result": result
     })
@@ -71,24 +63,37 @@ def getNotification(event, context):
 
 def listNotification(event, context):
 
-  notifications = Notifications(client)
+  params = event.get("queryStringParameters") or {}
+  try:
+    limit = int(params.get("limit", DEFAULT_LIMIT))
+    cursor = decode_cursor(params.get("cursor"))
+  except ValueError as e:
+    return {"statusCode": 400, "body": codec.dumps({"detail": str(e), "result": []})}
+
+  if limit <= 0 or limit > MAX_LIMIT:
+    return {"statusCode": 400, "body": codec.dumps({"detail": f"limit must be between 1 and {MAX_LIMIT}", "result": []})}
+
+  fields = [field.strip() for field in params["fields"].split(",") if field.strip()] if params.get("fields") else None
+
+  notifications = Notifications(aws.dynamodb())
   notifications_exists = notifications.exists(NOTIFICATION_TABLE)
   if not notifications_exists:
     return {
       "statusCode": 500,
-      "body": json.dumps({
+      "body": codec.dumps({
         "detail": "Table does not exists",
         "result": {}
       })
     }
 
-  status_code, message, results = notifications.scan_notifications()
+  status_code, message, results, next_page = notifications.scan_notifications(limit=limit, cursor=cursor, fields=fields)
 
   return {
     "statusCode": status_code,
-    "body": json.dumps({
+    "body": codec.dumps({
       "detail": message,
-      "result": results
+      "result": results,
+      "cursor": encode_cursor(next_page)
     })
   }
 
@@ -96,15 +101,15 @@ def deleteNotification(event, context):
 
   pathParameters = event.get("pathParameters")
   if not pathParameters:
-    return {"statusCode": 400, "body": json.dumps({"detail": "No pathParameters was found"})}
+    return {"statusCode": 400, "body": codec.dumps({"detail": "No pathParameters was found"})}
 
 
-  notifications = Notifications(client)
+  notifications = Notifications(aws.dynamodb())
   notifications_exists = notifications.exists(NOTIFICATION_TABLE)
   if not notifications_exists:
     return {
       "statusCode": 500,
-      "body": json.dumps({
+      "body": codec.dumps({
         "detail": "Table does not exists",
       })
     }
@@ -113,7 +118,7 @@ def deleteNotification(event, context):
 
   return {
     "statusCode": status_code,
-    "body": json.dumps({
+    "body": codec.dumps({
       "detail": message,
       "result": notification
     })
@@ -124,19 +129,19 @@ def updateNotification(event, context):
   body = event.get("body")
 
   if not body:
-    return {"statusCode": 400, "body": json.dumps({"detail": "No body was found"})}
+    return {"statusCode": 400, "body": codec.dumps({"detail": "No body was found"})}
 
   if not pathParameters:
-    return {"statusCode": 400, "body": json.dumps({"detail": "No pathParameters was found"})}
+    return {"statusCode": 400, "body": codec.dumps({"detail": "No pathParameters was found"})}
 
-  body = json.loads(body)
+  body = codec.loads(body)
 
-  notifications = Notifications(client)
+  notifications = Notifications(aws.dynamodb())
   notifications_exists = notifications.exists(NOTIFICATION_TABLE)
   if not notifications_exists:
     return {
       "statusCode": 500,
-      "body": json.dumps({
+      "body": codec.dumps({
         "detail": "Table does not exists",
         "result": {}
       })
@@ -147,7 +152,7 @@ def updateNotification(event, context):
 
   return {
     "statusCode": status_code,
-    "body": json.dumps({
+    "body": codec.dumps({
       "detail": message,
       "result": notification
     })
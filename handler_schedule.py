@@ -0,0 +1,83 @@
+import logging
+import os
+from datetime import timedelta
+from services import aws
+from services.lanes import HIGH, queue_url
+from services.metrics import metrics
+from services.queue import Queue
+from services.schedule import Schedule, bucket_of, buckets_between, release_entries, utcnow
+
+logger = logging.getLogger(__name__)
+
+SCHEDULE_TABLE = os.environ['SCHEDULE_TABLE']
+
+# Buckets starting this many seconds ahead are released too, delayed with
+# DelaySeconds, so a message isn't late by up to one sweep interval.
+LOOKAHEAD = min(int(os.environ.get('SCHEDULE_LOOKAHEAD', 60)), 600)
+# Where the first sweep starts, when no cursor was saved yet.
+FIRST_SWEEP_LOOKBACK = int(os.environ.get('SCHEDULE_FIRST_SWEEP_LOOKBACK', 900))
+MIN_REMAINING_MS = int(os.environ.get('SCHEDULE_MIN_REMAINING_MS', 5000))
+
+
+@metrics.flush_after
+def sweep(event, context):
+  """
+  Releases the scheduled messages that are due into the queue. Runs every
+  minute and reads only the buckets between the last swept one and now.
+  """
+  schedule = Schedule(aws.dynamodb())
+  if not schedule.exists(SCHEDULE_TABLE):
+    logger.info('500 table schedule does not exists')
+    return {'released': 0}
+
+  now = utcnow()
+  cursor = schedule.cursor() or bucket_of(now - timedelta(seconds=FIRST_SWEEP_LOOKBACK))
+
+  released, swept = 0, cursor
+  for bucket in buckets_between(cursor, now + timedelta(seconds=LOOKAHEAD)):
+    if context is not None and context.get_remaining_time_in_millis() < MIN_REMAINING_MS:
+      logger.warning(f'Sweep stopped before bucket {bucket}, the next one resumes it')
+      break
+
+    with metrics.timer('schedule_release') as stage:
+      count, complete = release_bucket(schedule, bucket)
+      stage.count = count
+      if not complete:
+        stage.error = 'Incomplete'
+    released += count
+    if not complete:
+      logger.error(f'Bucket {bucket} was not fully released, the next sweep retries it')
+      break
+    swept = bucket
+
+  if swept != cursor:
+    schedule.save_cursor(swept)
+
+  logger.info(f'Released {released} scheduled messages, swept up to {swept}')
+  return {'released': released, 'swept': swept}
+
+
+def release_bucket(schedule, bucket):
+  """
+  Enqueues every job of a bucket to its lane's queue and deletes the ones
+  that were enqueued.
+  :return: The number of jobs released and whether the whole bucket was.
+  """
+  released, complete = 0, True
+  for page in schedule.jobs(bucket):
+    by_lane = {}
+    for job in page:
+      by_lane.setdefault(job.get('lane', HIGH), []).append(job)
+
+    done, jobs = [], []
+    for lane, lane_jobs in by_lane.items():
+      sent = Queue(aws.sqs(), queue_url(lane)).send_messages(release_entries(lane_jobs))
+      done.extend(job for index, job in enumerate(lane_jobs) if sent.get(str(index), (False, None))[0])
+      jobs.extend(lane_jobs)
+    not_removed = schedule.remove(done)
+    if not_removed or len(done) < len(jobs):
+      # Jobs that weren't enqueued, or were but couldn't be deleted, are
+      # released by a later sweep.
+      complete = False
+    released += len(done)
+  return released, complete
@@ -0,0 +1,123 @@
+"""
+Backfills the log items written before the log table had its indexes.
+
+Those items have no log_date attribute, so the date index leaves them out of
+GET /log without a notification_id, and the ones logged without a
+notification hold an empty notification_id, which an index key can't hold.
+The script scans the table once, sets log_date from created_at and removes
+the empty notification_id. Items that are already up to date are skipped, so
+it can be run again, for example after a partial run.
+
+  LOG_TABLE=log-table-production python scripts/backfill_log_dates.py --segments 4
+  LOG_TABLE=log-table-production python scripts/backfill_log_dates.py --dry-run
+"""
+import argparse
+import logging
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+logger = logging.getLogger(__name__)
+
+
+def outdated(item):
+  return 'log_date' not in item or item.get('notification_id') == ''
+
+
+def update_params(item):
+  """
+  :return: The update_item parameters that bring an item in line with
+           Log.build_item, or None when it has no created_at to date it by.
+  """
+  assignments, removals, values = [], [], {}
+  if 'log_date' not in item:
+    if not item.get('created_at'):
+      return None
+    assignments.append('log_date = :log_date')
+    values[':log_date'] = item['created_at'][:10]
+  if item.get('notification_id') == '':
+    removals.append('notification_id')
+
+  expression = ''
+  if assignments:
+    expression += f"SET {', '.join(assignments)} "
+  if removals:
+    expression += f"REMOVE {', '.join(removals)}"
+
+  params = {
+    'Key': {'log_id': item['log_id']},
+    'UpdateExpression': expression.strip(),
+    # An item deleted since the scan isn't written back.
+    'ConditionExpression': 'attribute_exists(log_id)',
+  }
+  if values:
+    params['ExpressionAttributeValues'] = values
+  return params
+
+
+def backfill_segment(table, segment, segments, dry_run=False):
+  """
+  Scans one segment of the table and updates its outdated items.
+  :return: The number of items scanned, updated and skipped.
+  """
+  from botocore.exceptions import ClientError
+
+  scanned, updated, skipped = 0, 0, 0
+  params = {
+    'ProjectionExpression': 'log_id, created_at, log_date, notification_id',
+    'Segment': segment,
+    'TotalSegments': segments,
+  }
+  while True:
+    response = table.scan(**params)
+    for item in response.get('Items', []):
+      scanned += 1
+      if not outdated(item):
+        continue
+
+      update = update_params(item)
+      if update is None:
+        logger.warning(f"Log {item['log_id']} has no created_at, skipped")
+        skipped += 1
+        continue
+
+      if not dry_run:
+        try:
+          table.update_item(**update)
+        except ClientError as err:
+          if err.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+          continue
+      updated += 1
+
+    if not response.get('LastEvaluatedKey'):
+      return scanned, updated, skipped
+    params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--table', default=os.environ.get('LOG_TABLE'), help='Log table, LOG_TABLE by default')
+  parser.add_argument('--segments', type=int, default=1, help='Segments scanned in parallel')
+  parser.add_argument('--dry-run', action='store_true', help='Count the outdated items without updating them')
+  args = parser.parse_args()
+  if not args.table:
+    parser.error('--table or LOG_TABLE is required')
+
+  logging.basicConfig(level=logging.INFO)
+  from services import aws
+
+  table = aws.dynamodb().Table(args.table)
+  with ThreadPoolExecutor(max_workers=args.segments) as executor:
+    results = list(executor.map(lambda segment: backfill_segment(table, segment, args.segments, args.dry_run), range(args.segments)))
+
+  scanned, updated, skipped = (sum(counts) for counts in zip(*results))
+  action = 'would update' if args.dry_run else 'updated'
+  logger.info(f'{args.table}: {scanned} logs scanned, {updated} {action}, {skipped} skipped')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,66 @@
+import os
+import threading
+
+IS_OFFLINE = os.environ.get('IS_OFFLINE')
+
+_clients = {}
+_lock = threading.Lock()
+
+
+def _get(name, factory):
+  client = _clients.get(name)
+  if client is not None:
+    return client
+
+  with _lock:
+    client = _clients.get(name)
+    if client is None:
+      import boto3
+      client = factory(boto3)
+      _clients[name] = client
+
+  return client
+
+
+def dynamodb():
+  """
+  Gets the DynamoDB resource of this container, building it on first use.
+  Offline, it points to the local DynamoDB started by serverless-dynamodb-local.
+  """
+  if IS_OFFLINE:
+    return _get('dynamodb', lambda boto3: boto3.resource(
+      'dynamodb',
+      region_name='localhost',
+      endpoint_url='http://localhost:8000'
+    ))
+  return _get('dynamodb', lambda boto3: boto3.resource('dynamodb'))
+
+
+def sqs():
+  """
+  Gets the SQS client of this container, building it on first use.
+  """
+  return _get('sqs', lambda boto3: boto3.client('sqs'))
+
+
+def s3():
+  """
+  Gets the S3 client of this container, building it on first use.
+  """
+  return _get('s3', lambda boto3: boto3.client('s3'))
+
+
+def lambda_():
+  """
+  Gets the Lambda client of this container, building it on first use.
+  """
+  return _get('lambda', lambda boto3: boto3.client('lambda'))
+
+
+def set_client(name, client):
+  """
+  Replaces a client, such as "dynamodb" or "sqs", with another object. Used
+  to run the handlers against local stand-ins.
+  """
+  with _lock:
+    _clients[name] = client
@@ -0,0 +1,163 @@
+import logging
+import math
+import os
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# Sends rejected by an open breaker fail with this status, without reaching
+# the provider.
+OPEN_STATUS = 503
+OPEN_MESSAGE = 'Circuit breaker open, the message will be retried later'
+
+FAILURE_RATE = float(os.environ.get('BREAKER_FAILURE_RATE', 0.5))
+MIN_REQUESTS = int(os.environ.get('BREAKER_MIN_REQUESTS', 10))
+WINDOW = float(os.environ.get('BREAKER_WINDOW', 30))
+COOLDOWN = float(os.environ.get('BREAKER_COOLDOWN', 30))
+PROBES = int(os.environ.get('BREAKER_PROBES', 3))
+
+
+def is_failure(status_code):
+  """
+  Only answers showing the provider itself is unhealthy count as failures:
+  5xx, timeouts and connection errors. A rejected request (4xx) means the
+  provider is up, and throttling (429) is left to the rate limiter.
+  """
+  return not isinstance(status_code, int) or status_code >= 500
+
+
+class CircuitBreaker:
+  def __init__(self, name, failure_rate=FAILURE_RATE, min_requests=MIN_REQUESTS, window=WINDOW, cooldown=COOLDOWN, probes=PROBES):
+    """
+    Stops sending to a provider whose recent requests mostly failed. The
+    breaker opens when at least min_requests requests were made in the last
+    window seconds and failure_rate of them failed. Once open, every send
+    fails fast for cooldown seconds; then up to probes requests go through,
+    half-open, and the breaker closes when they all succeed or opens again
+    on the first failure.
+    :param name: The provider name, used in the logs.
+    :param failure_rate: The share of failed requests, from 0 to 1, that opens
+                         the breaker.
+    :param min_requests: The requests needed in the window before the rate
+                         is trusted.
+    :param window: The seconds of requests the failure rate is computed on.
+    :param cooldown: The seconds the breaker stays open before probing.
+    :param probes: The requests let through while half-open.
+    """
+    self.name = name
+    self.failure_rate = failure_rate
+    self.min_requests = min_requests
+    self.window = window
+    self.cooldown = cooldown
+    self.probes = probes
+    self.state = CLOSED
+    self._outcomes = deque()
+    self._failures = 0
+    self._opened_at = 0.0
+    self._probing = 0
+    self._probed = 0
+    self._lock = threading.Lock()
+
+  def allow(self):
+    """
+    Takes the permission to send one request.
+    :return: False when the request must fail fast.
+    """
+    with self._lock:
+      if self.state == OPEN:
+        if time.monotonic() - self._opened_at < self.cooldown:
+          return False
+        self._transition(HALF_OPEN)
+
+      if self.state == HALF_OPEN:
+        if self._probing + self._probed >= self.probes:
+          return False
+        self._probing += 1
+      return True
+
+  def record(self, status_code):
+    """
+    Records the outcome of a request allowed by allow.
+    :param status_code: The status code the provider client returned.
+    """
+    with self._lock:
+      now = time.monotonic()
+      if self.state == HALF_OPEN:
+        self._probing = max(0, self._probing - 1)
+        if status_code == 429:
+          return
+        if is_failure(status_code):
+          self._open(now)
+        else:
+          self._probed += 1
+          if self._probed >= self.probes:
+            self._transition(CLOSED)
+        return
+
+      if self.state == OPEN or status_code == 429:
+        # Requests that were already running when the breaker opened don't
+        # change it.
+        return
+
+      failed = is_failure(status_code)
+      self._outcomes.append((now, failed))
+      self._failures += failed
+      while self._outcomes and now - self._outcomes[0][0] > self.window:
+        self._failures -= self._outcomes.popleft()[1]
+
+      requests = len(self._outcomes)
+      if requests >= self.min_requests and self._failures >= self.failure_rate * requests:
+        logger.warning(f'{self.name}: {self._failures} of the last {requests} requests failed')
+        self._open(now)
+
+  def delay(self):
+    """
+    :return: The whole number of seconds a message rejected by the breaker
+             should wait: the rest of the cool-down while open, a whole
+             cool-down while the probes run, at least 1.
+    """
+    with self._lock:
+      if self.state == OPEN:
+        wait = self.cooldown - (time.monotonic() - self._opened_at)
+      else:
+        wait = self.cooldown
+    return max(1, math.ceil(wait))
+
+  @property
+  def closed(self):
+    return self.state == CLOSED
+
+  def _open(self, now):
+    self._opened_at = now
+    self._transition(OPEN)
+
+  def _transition(self, state):
+    logger.warning(f'{self.name} circuit breaker is now {state}')
+    self.state = state
+    self._outcomes.clear()
+    self._failures = 0
+    self._probing = 0
+    self._probed = 0
+
+
+_breakers = {}
+_lock = threading.Lock()
+
+
+def get_breaker(name):
+  """
+  Gets the circuit breaker shared by every client of a provider in this
+  container. BREAKER_FAILURE_RATE=0 disables the breakers.
+  :param name: The provider name, such as "sendgrid" or "botmaker".
+  :return: A CircuitBreaker, or None when breakers are disabled.
+  """
+  with _lock:
+    if name not in _breakers:
+      _breakers[name] = CircuitBreaker(name) if FAILURE_RATE > 0 else None
+    return _breakers[name]
@@ -0,0 +1,231 @@
+import logging
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from botocore.exceptions import ClientError
+from services import codec
+from services.tables import TableStore
+
+logger = logging.getLogger(__name__)
+
+RUNNING = 'running'
+COMPLETED = 'completed'
+FAILED = 'failed'
+
+# Bytes read from the recipient list per S3 chunk.
+CHUNK_SIZE = 64 * 1024
+# Lines enqueued between two checkpoints. A timeout or a crash sends again
+# at most the lines read since the last checkpoint.
+CHECKPOINT_LINES = int(os.environ.get('BROADCAST_CHECKPOINT_LINES', 1000))
+# SendMessageBatch requests in flight at once.
+MAX_WORKERS = int(os.environ.get('BROADCAST_MAX_WORKERS', 8))
+# Rejected lines kept in the job with their reason, for the progress report.
+MAX_ERRORS = 20
+# How many times the entries a SendMessageBatch request failed are sent again.
+MAX_SEND_RETRIES = int(os.environ.get('BROADCAST_SEND_RETRIES', 4))
+
+_executor = None
+
+
+def read_lines(chunks, offset=0):
+  """
+  Splits a byte stream into lines, holding at most one chunk and one line in
+  memory.
+  :param chunks: An iterable of bytes, such as StreamingBody.iter_chunks().
+  :param offset: The offset of the first chunk in the object.
+  :return: A generator of (line, end) tuples, where end is the offset just
+           past the line, the one reading resumes from.
+  """
+  pending = b''
+  for chunk in chunks:
+    pending += chunk
+    *lines, pending = pending.split(b'\n')
+    for line in lines:
+      offset += len(line) + 1
+      yield line, offset
+
+  if pending:
+    yield pending, offset + len(pending)
+
+
+def windows(lines, size=CHECKPOINT_LINES):
+  """
+  :return: A generator of lists of at most size lines.
+  """
+  window = []
+  for line in lines:
+    window.append(line)
+    if len(window) == size:
+      yield window
+      window = []
+
+  if window:
+    yield window
+
+
+def parse_lines(lines, validator, attributes, first_line):
+  """
+  Validates the recipients of a window of lines.
+  :param lines: A list of (line, end) tuples.
+  :param validator: The compiled validator of the notification.
+  :param attributes: The message attributes shared by every message.
+  :param first_line: The number of the first line, counted from 1.
+  :return: The SendMessageBatch entries of the valid lines and a list of
+           (line_number, reason) tuples for the others. Blank lines are
+           skipped.
+  """
+  entries, rejected = [], []
+  for number, (line, _) in enumerate(lines, first_line):
+    line = line.strip()
+    if not line:
+      continue
+
+    try:
+      body = line.decode('utf-8')
+      item = codec.loads(body)
+    except ValueError:
+      rejected.append((number, 'Line is not valid JSON'))
+      continue
+
+    is_valid, message = validator.validate(item)
+    if not is_valid:
+      rejected.append((number, message))
+      continue
+
+    entries.append({'Id': str(len(entries)), 'MessageBody': body, 'MessageAttributes': attributes})
+  return entries, rejected
+
+
+def send_chunk(queue, entries, max_retries=MAX_SEND_RETRIES):
+  """
+  Sends up to 10 entries with SendMessageBatch, sending the failed ones again
+  with exponential backoff.
+  :return: The number of entries that could not be sent.
+  """
+  for attempt in range(max_retries + 1):
+    if attempt:
+      time.sleep(min(0.05 * (2 ** (attempt - 1)), 1.0))
+
+    results = queue.send_messages(entries)
+    entries = [entry for entry in entries if not results.get(entry['Id'], (False, 'No result'))[0]]
+    if not entries:
+      return 0
+
+  reason = results.get(entries[0]['Id'], (False, 'No result'))[1]
+  logger.error(f"{len(entries)} messages could not be sent to queue {queue.queue_url}. Here's why: {reason}")
+  return len(entries)
+
+
+def send_entries(queue, entries):
+  """
+  Sends entries with SendMessageBatch, MAX_WORKERS requests at a time.
+  :return: The number of entries the queue kept rejecting after
+           MAX_SEND_RETRIES retries.
+  """
+  global _executor
+  chunks = list(queue.chunk_entries(entries))
+  if len(chunks) <= 1 or MAX_WORKERS <= 1:
+    return sum(send_chunk(queue, chunk) for chunk in chunks)
+
+  if _executor is None:
+    _executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+  return sum(_executor.map(lambda chunk: send_chunk(queue, chunk), chunks))
+
+
+def progress(job):
+  """
+  :return: The progress report of a job, as returned by the status endpoint.
+  """
+  fields = ('broadcast_id', 'notification_id', 'lane', 'status', 'detail', 'created_at', 'updated_at')
+  report = {field: job[field] for field in fields if field in job}
+  for counter in ('size', 'offset', 'lines', 'accepted', 'rejected', 'failed'):
+    report[counter] = int(job.get(counter, 0))
+  report['errors'] = [{'line': int(error['line']), 'detail': error['detail']} for error in job.get('errors', [])]
+  return report
+
+
+class Broadcasts(TableStore):
+  def __init__(self, dyn_resource):
+    """
+    Stores the broadcast jobs and their checkpoints.
+    :param dyn_resource: A Boto3 DynamoDB resource.
+    """
+    super(Broadcasts, self).__init__(dyn_resource)
+
+  def create(self, notification_id, lane, bucket, key, size, broadcast_id=None):
+    """
+    Adds a job that sends a notification to every line of an S3 object.
+    :param size: The size of the object, in bytes.
+    :return: The job.
+    """
+    now = datetime.now(timezone.utc).isoformat()
+    job = {
+      'broadcast_id': broadcast_id or str(uuid.uuid4()),
+      'notification_id': notification_id,
+      'lane': lane,
+      'bucket': bucket,
+      'key': key,
+      'size': size,
+      'status': RUNNING,
+      'offset': 0,
+      'lines': 0,
+      'accepted': 0,
+      'rejected': 0,
+      'failed': 0,
+      'errors': [],
+      'created_at': now,
+      'updated_at': now,
+    }
+    self.table.put_item(Item=job)
+    return job
+
+  def get(self, broadcast_id):
+    return self.table.get_item(Key={'broadcast_id': broadcast_id}).get('Item')
+
+  def checkpoint(self, job, offset, lines=0, accepted=0, rejected=(), failed=0, status=RUNNING, detail=None):
+    """
+    Saves the progress of a job. The write is conditional on the offset the
+    job was read at, so when two invocations run the same job only one of
+    them moves it forward.
+    :param job: The job, as read by get. It is updated in place.
+    :param offset: The offset of the object up to which every line was handled.
+    :param rejected: The (line_number, reason) tuples of the rejected lines.
+    :return: False when another invocation moved the job first.
+    """
+    errors = list(job.get('errors', []))
+    errors.extend({'line': number, 'detail': reason} for number, reason in rejected[:MAX_ERRORS - len(errors)])
+    values = {
+      ':offset': offset,
+      ':previous': job['offset'],
+      ':lines': lines,
+      ':accepted': accepted,
+      ':rejected': len(rejected),
+      ':failed': failed,
+      ':errors': errors,
+      ':status': status,
+      ':updated_at': datetime.now(timezone.utc).isoformat(),
+    }
+    assignments = ['#offset = :offset', '#status = :status', 'errors = :errors', 'updated_at = :updated_at']
+    if detail is not None:
+      assignments.append('detail = :detail')
+      values[':detail'] = detail
+
+    try:
+      response = self.table.update_item(
+        Key={'broadcast_id': job['broadcast_id']},
+        UpdateExpression=f"SET {', '.join(assignments)} ADD #lines :lines, accepted :accepted, rejected :rejected, failed :failed",
+        ConditionExpression='#offset = :previous',
+        ExpressionAttributeNames={'#offset': 'offset', '#status': 'status', '#lines': 'lines'},
+        ExpressionAttributeValues=values,
+        ReturnValues='ALL_NEW'
+      )
+    except ClientError as err:
+      if err.response['Error']['Code'] == 'ConditionalCheckFailedException':
+        logger.warning(f"Broadcast {job['broadcast_id']} was moved past offset {job['offset']} by another invocation")
+        return False
+      raise
+
+    job.update(response['Attributes'])
+    return True
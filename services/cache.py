@@ -0,0 +1,87 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+  def __init__(self, max_size=128, ttl=60):
+    """
+    A bounded, thread-safe cache with LRU eviction and per-entry expiry. It is
+    meant to live at module level so its contents survive warm invocations.
+    :param max_size: The maximum number of entries kept before evicting the
+                     least recently used one.
+    :param ttl: The number of seconds an entry stays valid.
+    """
+    self.max_size = max_size
+    self.ttl = ttl
+    self.hits = 0
+    self.misses = 0
+    self._entries = OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, key):
+    """
+    Gets a value from the cache, counting the lookup as a hit or a miss.
+    :param key: The key to look up.
+    :return: The cached value, or None when it is missing or expired.
+    """
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is not None:
+        expires_at, value = entry
+        if expires_at > time.monotonic():
+          self._entries.move_to_end(key)
+          self.hits += 1
+          return value
+        del self._entries[key]
+
+      self.misses += 1
+      return None
+
+  def peek(self, key):
+    """
+    Gets a value from the cache without counting the lookup or refreshing its
+    position, for callers that only compare it with another copy.
+    :param key: The key to look up.
+    :return: The cached value, or None when it is missing or expired.
+    """
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is not None and entry[0] > time.monotonic():
+        return entry[1]
+      return None
+
+  def set(self, key, value):
+    """
+    Stores a value in the cache, evicting the least recently used entries
+    when the cache is full.
+    :param key: The key to store.
+    :param value: The value to store.
+    """
+    if self.max_size <= 0 or self.ttl <= 0:
+      return
+
+    with self._lock:
+      self._entries[key] = (time.monotonic() + self.ttl, value)
+      self._entries.move_to_end(key)
+      while len(self._entries) > self.max_size:
+        self._entries.popitem(last=False)
+
+  def invalidate(self, key):
+    """
+    Removes a key from the cache, if present.
+    :param key: The key to remove.
+    """
+    with self._lock:
+      self._entries.pop(key, None)
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+
+  def stats(self):
+    """
+    :return: The hit/miss counters and the current size of the cache.
+    """
+    with self._lock:
+      return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
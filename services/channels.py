@@ -0,0 +1,189 @@
+import logging
+import os
+import importlib.util
+from services.mail import AsyncSendgrid, Sendgrid, MAX_PERSONALIZATIONS
+from services.whatsapp import AsyncBotmaker, Botmaker
+from services.dispatch import AsyncDispatcher, Delivery, DeliveryGroup, Dispatcher
+from services.breaker import get_breaker
+from services.ratelimit import get_limiter
+
+logger = logging.getLogger(__name__)
+
+# This module holds the provider clients of the consumer. It is imported the
+# first time a batch is consumed, so the producer and the HTTP handlers never
+# load the SendGrid SDK, requests or aiohttp.
+
+SENDGRID_COALESCE = os.environ.get('SENDGRID_COALESCE', 'true').lower() == 'true'
+
+DISPATCH_MODE = os.environ.get('DISPATCH_MODE', 'threads')
+if DISPATCH_MODE == 'async' and importlib.util.find_spec('aiohttp') is None:
+  logger.warning('DISPATCH_MODE is async but aiohttp is not installed, using threads')
+  DISPATCH_MODE = 'threads'
+
+CHANNEL_PROVIDERS = {
+  'email': 'sendgrid',
+  'whatsapp': 'botmaker',
+}
+
+CHANNEL_LIMITS = {
+  'email': int(os.environ.get('SENDGRID_MAX_CONCURRENCY', 5)),
+  'whatsapp': int(os.environ.get('BOTMAKER_MAX_CONCURRENCY', 5)),
+}
+
+sendgrid = Sendgrid()
+whatsapp = Botmaker()
+
+if DISPATCH_MODE == 'async':
+  async_sendgrid = AsyncSendgrid()
+  async_whatsapp = AsyncBotmaker()
+  dispatcher = AsyncDispatcher(channel_limits=CHANNEL_LIMITS)
+else:
+  dispatcher = Dispatcher(
+    max_workers=int(os.environ.get('CONSUMER_MAX_WORKERS', 1)),
+    channel_limits=CHANNEL_LIMITS
+  )
+
+
+def build_deliveries(record, notification, body, now):
+  """
+  :return: One delivery per channel enabled in the notification.
+  """
+  deliveries = []
+  use_async = DISPATCH_MODE == 'async'
+  if notification["send_email"]:
+    send_async = (lambda: send_email_async(notification, body)) if use_async else None
+    deliveries.append(Delivery(record, notification, "email", notification["email_id"], lambda: send_email(notification, body), now, body, send_async))
+
+  if notification["send_whatsapp"]:
+    send_async = (lambda: send_whatsapp_async(notification, body)) if use_async else None
+    deliveries.append(Delivery(record, notification, "whatsapp", body.get("cellphone", ""), lambda: send_whatsapp(notification, body), now, body, send_async))
+
+  return deliveries
+
+
+def dispatch(deliveries, on_complete=None):
+  """
+  Sends the deliveries of a batch, coalescing the emails that share a template.
+  :param on_complete: A callable called with every delivery as soon as it was
+                      sent, off the event loop in async mode.
+  """
+  def each_delivery(task):
+    for delivery in task.deliveries if isinstance(task, DeliveryGroup) else (task,):
+      on_complete(delivery)
+
+  dispatcher.run(coalesce_emails(deliveries), each_delivery if on_complete is not None else None)
+  return deliveries
+
+
+def retry_delay(delivery):
+  """
+  :return: The seconds to wait before retrying a failed delivery: the
+           breaker's cool-down while its provider's breaker isn't closed, the
+           limiter's backlog when it was throttled, else None to leave it to
+           the queue's visibility timeout.
+  """
+  provider = CHANNEL_PROVIDERS[delivery.channel]
+  breaker = get_breaker(provider)
+  if breaker is not None and not breaker.closed:
+    return breaker.delay()
+
+  if delivery.status_code == 429:
+    limiter = get_limiter(provider)
+    return limiter.delay() if limiter is not None else 1
+  return None
+
+
+def send_email(notification, body):
+  to_emails = [(body["email"], "full_name"),]
+
+  return sendgrid.send_template_email(notification["email_id"], to_emails, body["email_fields"])
+
+
+async def send_email_async(notification, body):
+  to_emails = [(body["email"], "full_name"),]
+
+  return await async_sendgrid.send_template_email(notification["email_id"], to_emails, body["email_fields"])
+
+
+def coalesce_emails(deliveries):
+  """
+  Groups the email deliveries of a batch by template, so each group is sent
+  with one SendGrid request holding a personalization per recipient.
+  :return: The tasks to dispatch: the groups and the remaining deliveries.
+  """
+  if not SENDGRID_COALESCE:
+    return deliveries
+
+  tasks = []
+  groups = {}
+  for delivery in deliveries:
+    if delivery.channel == "email":
+      groups.setdefault(delivery.notification["email_id"], []).append(delivery)
+    else:
+      tasks.append(delivery)
+
+  send_async = send_email_group_async if DISPATCH_MODE == 'async' else None
+  for members in groups.values():
+    for start in range(0, len(members), MAX_PERSONALIZATIONS):
+      chunk = members[start:start + MAX_PERSONALIZATIONS]
+      if len(chunk) == 1:
+        tasks.append(chunk[0])
+      else:
+        tasks.append(DeliveryGroup("email", chunk, send_email_group, send_async))
+
+  return tasks
+
+
+def email_recipients(deliveries):
+  """
+  :return: The (to_emails, dynamic_template_data) tuples of a group, or None
+           when a body is missing its email fields.
+  """
+  try:
+    return [([(delivery.body["email"], "full_name"),], delivery.body["email_fields"]) for delivery in deliveries]
+  except (KeyError, TypeError):
+    return None
+
+
+def send_email_group(deliveries):
+  """
+  Sends a group of email deliveries that share one template. When SendGrid
+  rejects the request, every delivery is sent on its own so one invalid
+  recipient doesn't fail the others.
+  :return: One (status_code, message) tuple per delivery.
+  """
+  recipients = email_recipients(deliveries)
+  if recipients is not None:
+    status_code, message = sendgrid.send_bulk_template_email(deliveries[0].notification["email_id"], recipients)
+    if status_code != 400:
+      return [(status_code, message)] * len(deliveries)
+
+  return [send_email(delivery.notification, delivery.body) for delivery in deliveries]
+
+
+async def send_email_group_async(deliveries):
+  recipients = email_recipients(deliveries)
+  if recipients is not None:
+    status_code, message = await async_sendgrid.send_bulk_template_email(deliveries[0].notification["email_id"], recipients)
+    if status_code != 400:
+      return [(status_code, message)] * len(deliveries)
+
+  return [await send_email_async(delivery.notification, delivery.body) for delivery in deliveries]
+
+
+def whatsapp_payload(notification, body):
+  return {
+    "chatPlatform": "whatsapp",
+    "chatChannelNumber": "5527996989507",
+    "platformContactId": body["cellphone"],
+    "ruleNameOrId": notification["template_name"],
+    "params": body["whatsapp_fields"]
+  }
+
+
+def send_whatsapp(notification, body):
+  return whatsapp.send_message(whatsapp_payload(notification, body))
+
+
+async def send_whatsapp_async(notification, body):
+  return await async_whatsapp.send_message(whatsapp_payload(notification, body))
@@ -0,0 +1,99 @@
+import json
+import logging
+import os
+import uuid
+from datetime import date, datetime, time
+from decimal import Decimal
+
+logger = logging.getLogger(__name__)
+
+# The JSON backend of every handler: "auto" uses orjson when it is installed
+# and the standard library otherwise; "orjson" and "stdlib" force one.
+BACKEND = os.environ.get('JSON_CODEC', 'auto').lower()
+
+orjson = None
+if BACKEND in ('auto', 'orjson'):
+  try:
+    import orjson
+  except ImportError:
+    if BACKEND == 'orjson':
+      logger.warning('JSON_CODEC is orjson but orjson is not installed, using the standard library')
+
+BACKEND = 'orjson' if orjson is not None else 'stdlib'
+
+# Exposed so callers catch one exception type whatever the backend. orjson's
+# own error is a subclass of it.
+DecodeError = json.JSONDecodeError
+
+
+def default(value):
+  """
+  Serializes the types DynamoDB returns that JSON doesn't have: numbers come
+  back as Decimal and string and number sets as set. Dates, times and UUIDs
+  are written as their ISO 8601 and canonical strings.
+  """
+  if isinstance(value, Decimal):
+    return int(value) if value == value.to_integral_value() else float(value)
+  if isinstance(value, (set, frozenset)):
+    return sorted(value)
+  if isinstance(value, (datetime, date, time)):
+    return value.isoformat()
+  if isinstance(value, uuid.UUID):
+    return str(value)
+  raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+_encoder = json.JSONEncoder(default=default, ensure_ascii=False, separators=(',', ':'))
+_sorted_encoder = json.JSONEncoder(default=default, ensure_ascii=False, separators=(',', ':'), sort_keys=True)
+_decoder = json.JSONDecoder()
+
+
+def _stdlib_dumps(value, sort_keys=False):
+  return (_sorted_encoder if sort_keys else _encoder).encode(value)
+
+
+def _stdlib_loads(data):
+  if isinstance(data, (bytes, bytearray)):
+    data = data.decode('utf-8')
+  return _decoder.decode(data)
+
+
+if orjson is not None:
+  # Dates, times and dataclasses go through default, as they do with the
+  # standard library, instead of orjson's own formats.
+  _OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+
+  def dumps(value, sort_keys=False):
+    """
+    :return: The compact JSON text of a value, as a str.
+    """
+    options = _OPTIONS | orjson.OPT_SORT_KEYS if sort_keys else _OPTIONS
+    try:
+      return orjson.dumps(value, default=default, option=options).decode('utf-8')
+    except orjson.JSONEncodeError:
+      # orjson only writes integers that fit in 64 bits, and DynamoDB numbers
+      # have up to 38 digits. The standard library writes them, and raises
+      # the same TypeError for a value neither can serialize.
+      return _stdlib_dumps(value, sort_keys)
+
+  def loads(data):
+    """
+    Parses JSON text given as str or bytes. Raises DecodeError when it isn't
+    valid JSON. Unlike the standard library, orjson reads integers beyond 64
+    bits as floats.
+    """
+    return orjson.loads(data)
+
+else:
+  def dumps(value, sort_keys=False):
+    """
+    :return: The compact JSON text of a value, as a str.
+    """
+    return _stdlib_dumps(value, sort_keys)
+
+  def loads(data):
+    """
+    Parses JSON text given as str or bytes. Raises DecodeError when it isn't
+    valid JSON.
+    """
+    return _stdlib_loads(data)
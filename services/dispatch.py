@@ -0,0 +1,263 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from services.metrics import metrics, status_error
+
+logger = logging.getLogger(__name__)
+
+# Client errors worth sending again: a request timeout and throttling.
+RETRYABLE_CLIENT_ERRORS = (408, 429)
+
+
+def is_retryable(status_code):
+  """
+  A failed send is retried when a later attempt can succeed: 5xx answers,
+  timeouts and connection errors, throttling and an open circuit breaker.
+  Other client errors, such as an invalid recipient or template, fail the
+  same way every time.
+  """
+  return not isinstance(status_code, int) or status_code >= 500 or status_code in RETRYABLE_CLIENT_ERRORS
+
+
+class Delivery:
+  def __init__(self, record, notification, channel, to_user, send, created_at, body=None, send_async=None):
+    """
+    One send of an SQS record through one channel.
+    :param record: The SQS record the send belongs to.
+    :param notification: The notification definition used by the send.
+    :param channel: The channel name, "email" or "whatsapp".
+    :param to_user: The recipient written to the log entry.
+    :param send: A callable that performs the send and returns a
+                 (status_code, message) tuple.
+    :param created_at: The datetime written to the log entry.
+    :param body: The parsed message body of the record.
+    :param send_async: A callable that returns a coroutine performing the
+                       send, used by AsyncDispatcher.
+    """
+    self.record = record
+    self.body = body
+    self.send_async = send_async
+    self.message_id = record.get('messageId')
+    self.notification = notification
+    self.channel = channel
+    self.to_user = to_user
+    self.send = send
+    self.created_at = created_at
+    self.status_code = None
+    self.message = None
+
+  @property
+  def succeeded(self):
+    return isinstance(self.status_code, int) and 200 <= self.status_code < 300
+
+  @property
+  def retryable(self):
+    return not self.succeeded and is_retryable(self.status_code)
+
+  @property
+  def size(self):
+    return 1
+
+  @property
+  def template(self):
+    return self.notification["notification_id"]
+
+  @property
+  def outcome(self):
+    return self.status_code
+
+  def complete(self, result):
+    self.status_code, self.message = result
+
+  def fail(self, status_code, message):
+    self.status_code, self.message = status_code, message
+
+
+class DeliveryGroup:
+  def __init__(self, channel, deliveries, send, send_async=None):
+    """
+    Several deliveries of one channel sent with a single provider request.
+    :param channel: The channel name shared by the deliveries.
+    :param deliveries: The deliveries sent together.
+    :param send: A callable that receives the deliveries and returns one
+                 (status_code, message) tuple per delivery, in order.
+    :param send_async: The coroutine function equivalent of send, used by
+                       AsyncDispatcher.
+    """
+    self.channel = channel
+    self.deliveries = deliveries
+    self.message_id = ','.join(delivery.message_id for delivery in deliveries)
+    self._send = send
+    self._send_async = send_async
+    self.send_async = self._group_send_async if send_async is not None else None
+
+  @property
+  def size(self):
+    return len(self.deliveries)
+
+  @property
+  def template(self):
+    templates = {delivery.template for delivery in self.deliveries}
+    return templates.pop() if len(templates) == 1 else None
+
+  @property
+  def outcome(self):
+    return self.deliveries[0].status_code
+
+  def send(self):
+    return self._send(self.deliveries)
+
+  def _group_send_async(self):
+    return self._send_async(self.deliveries)
+
+  def complete(self, results):
+    for delivery, result in zip(self.deliveries, results):
+      delivery.complete(result)
+
+  def fail(self, status_code, message):
+    for delivery in self.deliveries:
+      delivery.fail(status_code, message)
+
+
+class Dispatcher:
+  def __init__(self, max_workers=1, channel_limits=None):
+    """
+    Runs deliveries on thread pools. Each channel with a concurrency limit has
+    its own pool of that size, so the sends waiting on a slow provider queue
+    in its pool and never hold a worker another channel could use.
+    :param max_workers: The size of the pool of the channels without a limit,
+                        and the cap of every channel's pool. With 1,
+                        deliveries run one after the other on the calling
+                        thread.
+    :param channel_limits: A dict with the maximum number of concurrent sends
+                           per channel.
+    """
+    self.max_workers = max_workers
+    self._executor = None
+    self._channel_executors = {}
+    if max_workers > 1:
+      self._executor = ThreadPoolExecutor(max_workers=max_workers)
+      self._channel_executors = {
+        channel: ThreadPoolExecutor(max_workers=max(1, min(limit, max_workers)))
+        for channel, limit in (channel_limits or {}).items()
+      }
+
+  def run(self, deliveries, on_complete=None):
+    """
+    Sends every delivery and stores its status code and message on it.
+    :param deliveries: The list of deliveries or delivery groups to send.
+    :param on_complete: A callable called with every delivery or group once
+                        it was sent, on the thread that sent it.
+    :return: The same list of deliveries.
+    """
+    if self._executor is None or len(deliveries) <= 1:
+      for delivery in deliveries:
+        self._send(delivery, on_complete)
+    else:
+      futures = [
+        self._channel_executors.get(delivery.channel, self._executor).submit(self._send, delivery, on_complete)
+        for delivery in deliveries
+      ]
+      for future in futures:
+        future.result()
+
+    return deliveries
+
+  def _send(self, delivery, on_complete=None):
+    started = time.perf_counter()
+    error = None
+    try:
+      delivery.complete(delivery.send())
+      error = status_error(delivery.outcome)
+    except Exception as e:
+      logger.exception(f'Sending {delivery.channel} of message {delivery.message_id} failed!')
+      delivery.fail(500, str(e))
+      error = type(e).__name__
+    finally:
+      record_send(delivery, time.perf_counter() - started, error)
+      completed(delivery, on_complete)
+
+
+class AsyncDispatcher:
+  def __init__(self, channel_limits=None):
+    """
+    Runs deliveries as coroutines on one event loop, with a semaphore per
+    channel bounding the sends in flight. The loop is kept across warm
+    invocations so the aiohttp sessions bound to it keep their connections.
+    :param channel_limits: A dict with the maximum number of concurrent sends
+                           per channel.
+    """
+    self._channel_limits = channel_limits or {}
+    self._loop = asyncio.new_event_loop()
+    self._semaphores = None
+
+  def run(self, deliveries, on_complete=None):
+    """
+    Sends every delivery and stores its status code and message on it.
+    Deliveries without send_async run on the loop's default thread pool.
+    :param deliveries: The list of deliveries or delivery groups to send.
+    :param on_complete: A callable called with every delivery or group once
+                        it was sent, on the loop's default thread pool.
+    :return: The same list of deliveries.
+    """
+    if deliveries:
+      self._loop.run_until_complete(self._run(deliveries, on_complete))
+    return deliveries
+
+  async def _run(self, deliveries, on_complete):
+    if self._semaphores is None:
+      self._semaphores = {
+        channel: asyncio.Semaphore(limit)
+        for channel, limit in self._channel_limits.items()
+      }
+    await asyncio.gather(*(self._send(delivery, on_complete) for delivery in deliveries))
+
+  async def _send(self, delivery, on_complete=None):
+    semaphore = self._semaphores.get(delivery.channel)
+    if semaphore is not None:
+      await semaphore.acquire()
+
+    started = time.perf_counter()
+    error = None
+    try:
+      if delivery.send_async is not None:
+        result = await delivery.send_async()
+      else:
+        result = await self._loop.run_in_executor(None, delivery.send)
+      delivery.complete(result)
+      error = status_error(delivery.outcome)
+    except Exception as e:
+      logger.exception(f'Sending {delivery.channel} of message {delivery.message_id} failed!')
+      delivery.fail(500, str(e))
+      error = type(e).__name__
+    finally:
+      if semaphore is not None:
+        semaphore.release()
+      record_send(delivery, time.perf_counter() - started, error)
+
+    if on_complete is not None:
+      # The callback may block, as a log flush writing to DynamoDB does, so it
+      # runs on the loop's thread pool instead of stalling the other sends.
+      await self._loop.run_in_executor(None, completed, delivery, on_complete)
+
+
+def record_send(delivery, seconds, error):
+  """
+  Records a provider send of a delivery or delivery group, timed from the
+  moment its channel let it start.
+  """
+  metrics.record('provider_send', seconds, delivery.size, error, Channel=delivery.channel, Template=delivery.template)
+
+
+def completed(delivery, on_complete):
+  """
+  Calls the completion callback of a run. A failing callback is logged, so it
+  can't fail the send it follows.
+  """
+  if on_complete is None:
+    return
+  try:
+    on_complete(delivery)
+  except Exception:
+    logger.exception(f'Completing {delivery.channel} of message {delivery.message_id} failed!')
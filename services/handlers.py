@@ -0,0 +1,68 @@
+import os
+from services import aws
+from services.lanes import HIGH
+from services.metrics import metrics
+from services.notification import Notifications, snapshot
+
+# Helpers shared by the Lambda entry modules. They live here so an entry
+# module never imports another one, with its environment and imports, on its
+# cold start.
+
+NOTIFICATION_TABLE = os.environ.get('NOTIFICATION_TABLE')
+
+
+def request_priority(event):
+  return (event.get('queryStringParameters') or {}).get('priority')
+
+
+def table_exists(store, table_name):
+  """
+  Checks a table of a Notifications or Log instance, timing the check.
+  """
+  with metrics.timer('table_resolution', Table=table_name) as stage:
+    exists = store.exists(table_name)
+    if not exists:
+      stage.error = 'TableNotFound'
+  return exists
+
+
+def get_notification(notification_id):
+  """
+  Gets a notification definition for the produce endpoints.
+  :return: A tuple with a success flag, a message and the notification.
+  """
+  notifications = Notifications(aws.dynamodb())
+  notifications_exists = notifications.exists(NOTIFICATION_TABLE)
+  if not notifications_exists:
+    return False, "Table not exists", {}
+
+  status_code, message, notification = notifications.get_notification_by_id(notification_id, use_cache=True)
+  return status_code == 200, message, notification
+
+
+def lookup_notification(notification_id):
+  """
+  Gets a notification definition, timing the lookup.
+  :return: A tuple with a success flag, a message and the notification.
+  """
+  with metrics.timer('notification_lookup', Template=notification_id) as stage:
+    found, message, notification = get_notification(notification_id)
+    if not found:
+      stage.error = 'NotFound'
+  return found, message, notification
+
+
+def message_attributes(notification, lane=HIGH, send_at=None):
+  """
+  :return: The SQS message attributes of a message: the notification id,
+           the snapshot of the notification used by the consumer, the lane
+           and, for a delayed message, the time it is due.
+  """
+  attributes = {
+    'notification_id': {'StringValue': notification['notification_id'], 'DataType': 'String'},
+    'notification_snapshot': {'StringValue': snapshot(notification), 'DataType': 'String'},
+    'lane': {'StringValue': lane, 'DataType': 'String'},
+  }
+  if send_at is not None:
+    attributes['send_at'] = {'StringValue': str(int(send_at.timestamp())), 'DataType': 'Number'}
+  return attributes
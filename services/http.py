@@ -0,0 +1,65 @@
+import os
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+
+POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 10))
+# A send takes at most RATE_LIMIT_MAX_WAIT plus these two timeouts, 9 seconds
+# with the defaults. A batch of 10 records runs at most two rounds of sends
+# per provider (10 sends over a concurrency limit of 5), so they must stay
+# under half the consumer's timeout, 30 seconds in serverless.yml, leaving the
+# rest for DynamoDB and the log writes. A hung provider then times out, and
+# counts towards its circuit breaker, before Lambda stops the invocation.
+TIMEOUT = (
+  float(os.environ.get('HTTP_CONNECT_TIMEOUT', 2)),
+  float(os.environ.get('HTTP_READ_TIMEOUT', 5))
+)
+
+_sessions = {}
+_async_sessions = {}
+_lock = threading.Lock()
+
+
+def get_session(name):
+  """
+  Gets the pooled session of a provider. Sessions live at module level, so
+  their keep-alive connections are reused across records and warm
+  invocations.
+  :param name: The provider name, used to keep one connection pool per provider.
+  :return: A requests Session.
+  """
+  session = _sessions.get(name)
+  if session is not None:
+    return session
+
+  with _lock:
+    session = _sessions.get(name)
+    if session is None:
+      session = requests.Session()
+      adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE, max_retries=0)
+      session.mount('https://', adapter)
+      session.mount('http://', adapter)
+      _sessions[name] = session
+
+  return session
+
+
+def get_async_session(name):
+  """
+  Gets the pooled aiohttp session of a provider. It must be called from the
+  event loop that uses the session, and that loop must outlive the session,
+  as the one kept by AsyncDispatcher does.
+  :param name: The provider name, used to keep one connection pool per provider.
+  :return: An aiohttp ClientSession.
+  """
+  import aiohttp
+
+  session = _async_sessions.get(name)
+  if session is None or session.closed:
+    session = aiohttp.ClientSession(
+      connector=aiohttp.TCPConnector(limit=POOL_SIZE),
+      timeout=aiohttp.ClientTimeout(connect=TIMEOUT[0], sock_read=TIMEOUT[1])
+    )
+    _async_sessions[name] = session
+
+  return session
@@ -0,0 +1,181 @@
+import logging
+import os
+import time
+from botocore.exceptions import ClientError
+from services.cache import TTLCache
+from services.tables import MAX_BATCH_WRITES, TableStore, registry as tables, write_batch
+
+logger = logging.getLogger(__name__)
+
+# Deliveries are remembered for as long as SQS can hold a message, so a
+# redelivered record always finds its deliveries.
+DELIVERY_TTL = int(os.environ.get('DELIVERY_TTL', 14 * 24 * 3600))
+# Seconds a claim blocks other invocations from sending the same delivery. It
+# must outlast the consumer's timeout, so a running send is never claimed
+# again, and stay below the queue's visibility timeout, so the record of a
+# crashed invocation can be claimed when it comes back.
+CLAIM_TTL = int(os.environ.get('DELIVERY_CLAIM_TTL', 60))
+
+# TransactWriteItems accepts at most 100 actions.
+MAX_TRANSACT_ITEMS = 100
+MAX_ATTEMPTS = 4
+# Errors of the whole request that are retried like a cancelled transaction.
+RETRYABLE_ERRORS = ('ProvisionedThroughputExceededException', 'ThrottlingException', 'RequestLimitExceeded')
+
+# The states of a delivery: claimed by this invocation, done before, or being
+# sent by another invocation.
+CLAIMED = 'claimed'
+DONE = 'done'
+BUSY = 'busy'
+
+# The state stored while a delivery is being sent. Done items hold 'done';
+# items written before claims existed have no state and are done too.
+SENDING = 'sending'
+
+# The deliveries done by this container, checked before the table so a record
+# redelivered to the same container costs no write.
+delivered = TTLCache(
+  max_size=int(os.environ.get('DELIVERY_CACHE_SIZE', 10000)),
+  ttl=DELIVERY_TTL
+)
+
+
+def delivery_key(message_id, channel):
+  return f'{message_id}#{channel}'
+
+
+class DeliveryStore(TableStore):
+  def __init__(self, dyn_resource):
+    """
+    Records the channels already delivered for each SQS message, so a message
+    delivered again by SQS doesn't reach the recipient twice.
+    :param dyn_resource: A Boto3 DynamoDB resource.
+    """
+    super(DeliveryStore, self).__init__(dyn_resource)
+
+  def claim(self, deliveries):
+    """
+    Claims deliveries before they are sent, with one conditional write per
+    delivery batched in TransactWriteItems. A delivery can be claimed when it
+    has no item yet or when the claim of another invocation expired.
+    :param deliveries: A list of (message_id, channel) tuples.
+    :return: A dict that maps every delivery key to CLAIMED, DONE or BUSY. A
+             key that can't be written is reported as CLAIMED, so the message
+             is sent rather than lost.
+    """
+    states = {}
+    pending = {}
+    for message_id, channel in deliveries:
+      key = delivery_key(message_id, channel)
+      if delivered.get(key):
+        states[key] = DONE
+      elif key not in states:
+        states[key] = CLAIMED
+        pending[key] = (message_id, channel)
+
+    keys = list(pending)
+    for start in range(0, len(keys), MAX_TRANSACT_ITEMS):
+      chunk = {key: pending[key] for key in keys[start:start + MAX_TRANSACT_ITEMS]}
+      states.update(self._claim_chunk(chunk))
+    return states
+
+  def _claim_chunk(self, pending):
+    """
+    Claims up to 100 deliveries. A cancelled transaction writes nothing, so it
+    is sent again without the deliveries that failed their condition, with
+    backoff when it was throttled.
+    :return: The state of every delivery of the chunk.
+    """
+    states = {}
+    for attempt in range(MAX_ATTEMPTS):
+      if attempt:
+        time.sleep(min(0.05 * (2 ** (attempt - 1)), 1.0))
+
+      now = int(time.time())
+      keys = list(pending)
+      try:
+        self.dyn_resource.meta.client.transact_write_items(
+          TransactItems=[self._claim_item(key, *pending[key], now) for key in keys]
+        )
+      except ClientError as err:
+        if err.response['Error']['Code'] in RETRYABLE_ERRORS:
+          continue
+        if err.response['Error']['Code'] != 'TransactionCanceledException':
+          tables.discard_if_missing(err, self.table.name)
+          logger.error(f"Couldn't claim {len(keys)} deliveries in table {self.table.name}. Here's why: {err.response['Error']['Code']}: {err.response['Error']['Message']}")
+          break
+
+        for key, reason in zip(keys, err.response.get('CancellationReasons', [])):
+          code = reason.get('Code')
+          if code == 'ConditionalCheckFailed':
+            state = reason.get('Item', {}).get('state', {}).get('S', DONE)
+            states[key] = BUSY if state == SENDING else DONE
+            if state != SENDING:
+              delivered.set(key, True)
+            del pending[key]
+          elif code == 'TransactionConflict':
+            # Another invocation is claiming the same delivery right now.
+            states[key] = BUSY
+            del pending[key]
+        if not pending:
+          break
+        continue
+
+      states.update({key: CLAIMED for key in pending})
+      pending = {}
+      break
+
+    if pending:
+      logger.warning(f'Sending {len(pending)} deliveries unclaimed')
+    states.update({key: CLAIMED for key in pending})
+    return states
+
+  def _claim_item(self, key, message_id, channel, now):
+    return {
+      'Put': {
+        'TableName': self.table.name,
+        'Item': {
+          'delivery_id': {'S': key},
+          'message_id': {'S': message_id},
+          'channel': {'S': channel},
+          'state': {'S': SENDING},
+          'expires_at': {'N': str(now + CLAIM_TTL)},
+        },
+        'ConditionExpression': 'attribute_not_exists(delivery_id) OR (#state = :sending AND expires_at < :now)',
+        'ExpressionAttributeNames': {'#state': 'state'},
+        'ExpressionAttributeValues': {':sending': {'S': SENDING}, ':now': {'N': str(now)}},
+        'ReturnValuesOnConditionCheckFailure': 'ALL_OLD',
+      }
+    }
+
+  def finish(self, done, released=()):
+    """
+    Settles the claims of a batch once it was sent, 25 writes per
+    BatchWriteItem: the deliveries done are kept for DELIVERY_TTL, and the
+    claims of the failed ones are deleted so a retry can claim them again
+    right away.
+    :param done: The (message_id, channel) tuples of the successful deliveries.
+    :param released: The (message_id, channel) tuples of the failed ones.
+    :return: The number of writes that failed. A failed release expires after
+             CLAIM_TTL; a failed done write leaves the delivery to be sent
+             again if its record comes back.
+    """
+    expires_at = int(time.time()) + DELIVERY_TTL
+    write_requests = []
+    for message_id, channel in done:
+      key = delivery_key(message_id, channel)
+      delivered.set(key, True)
+      write_requests.append({'PutRequest': {'Item': {
+        'delivery_id': key,
+        'message_id': message_id,
+        'channel': channel,
+        'state': DONE,
+        'expires_at': expires_at,
+      }}})
+    for message_id, channel in released:
+      write_requests.append({'DeleteRequest': {'Key': {'delivery_id': delivery_key(message_id, channel)}}})
+
+    failed = 0
+    for start in range(0, len(write_requests), MAX_BATCH_WRITES):
+      failed += write_batch(self.dyn_resource, self.table.name, write_requests[start:start + MAX_BATCH_WRITES])
+    return failed
@@ -0,0 +1,97 @@
+import os
+import threading
+
+# Transactional traffic goes to the high lane, campaigns to the bulk lane.
+# Each lane is its own queue, so a large campaign never sits in front of a
+# password reset.
+HIGH = 'high'
+BULK = 'bulk'
+LANES = (HIGH, BULK)
+
+QUEUE_URLS = {
+  HIGH: os.getenv('QUEUE_URL'),
+  BULK: os.getenv('BULK_QUEUE_URL') or os.getenv('QUEUE_URL'),
+}
+
+WEIGHTS = {
+  HIGH: int(os.environ.get('HIGH_LANE_WEIGHT', 4)),
+  BULK: int(os.environ.get('BULK_LANE_WEIGHT', 1)),
+}
+
+
+def resolve_lane(requested, notification, default=HIGH):
+  """
+  Picks the lane of a message: the priority of the request, else the one of
+  the notification, else the default of the endpoint.
+  :return: The lane name. Raises ValueError for an unknown priority.
+  """
+  lane = requested or notification.get('priority') or default
+  if lane not in LANES:
+    raise ValueError(f'priority must be one of {", ".join(LANES)}, got {lane}')
+  return lane
+
+
+def queue_url(lane):
+  return QUEUE_URLS[lane]
+
+
+class LaneScheduler:
+  def __init__(self, capacity, weights=None, reserved=None):
+    """
+    Shares the processing slots of a worker between lanes. Lanes are drained
+    by smooth weighted round robin, and the slots reserved for a lane are
+    never taken by the others, so the high lane keeps capacity while a bulk
+    backlog is processed.
+    :param capacity: The number of messages the worker processes at once.
+    :param weights: A dict with the share of each lane. Defaults to WEIGHTS.
+    :param reserved: A dict with the slots kept free for a lane.
+    """
+    self.capacity = capacity
+    self.weights = dict(weights or WEIGHTS)
+    self.reserved = dict(reserved or {})
+    self._in_flight = {lane: 0 for lane in self.weights}
+    self._current = {lane: 0 for lane in self.weights}
+    self._lock = threading.Lock()
+
+  def available(self, lane):
+    """
+    :return: The slots a lane can take now: the free slots, minus the ones
+             reserved for the other lanes and not used by them.
+    """
+    with self._lock:
+      return self._available(lane)
+
+  def _available(self, lane):
+    free = self.capacity - sum(self._in_flight.values())
+    held = sum(
+      max(0, slots - self._in_flight[other])
+      for other, slots in self.reserved.items()
+      if other != lane
+    )
+    return max(0, free - held)
+
+  def next_lane(self, skip=()):
+    """
+    Picks the lane to receive from next, among the lanes with available
+    slots that aren't skipped, such as lanes found empty.
+    :return: The lane name, or None when no lane can receive.
+    """
+    with self._lock:
+      candidates = [lane for lane in self.weights if lane not in skip and self._available(lane) > 0]
+      if not candidates:
+        return None
+
+      total = sum(self.weights[lane] for lane in candidates)
+      for lane in candidates:
+        self._current[lane] += self.weights[lane]
+      lane = max(candidates, key=lambda candidate: self._current[candidate])
+      self._current[lane] -= total
+      return lane
+
+  def acquire(self, lane, count):
+    with self._lock:
+      self._in_flight[lane] += count
+
+  def release(self, lane, count):
+    with self._lock:
+      self._in_flight[lane] = max(0, self._in_flight[lane] - count)
@@ -1,62 +1,50 @@
 import logging
-from datetime import datetime, timedelta
+import os
+import threading
+from datetime import timedelta
 from botocore.exceptions import ClientError
+from services.metrics import metrics
+from services.tables import MAX_BATCH_WRITES, TableStore, registry as tables, write_batch
 import uuid
-from boto3.dynamodb.conditions import Key
+from boto3.dynamodb.conditions import Attr, Key
 
 logger = logging.getLogger(__name__)
 
-class Log:
-  def __init__(self, dyn_resource):
-    """
-    :param dyn_resource: A Boto3 DynamoDB resource.
-    """
-    self.dyn_resource = dyn_resource
-    self.table = None
+NOTIFICATION_INDEX = 'notification_id-created_at-index'
+DATE_INDEX = 'log_date-created_at-index'
+MAX_QUERY_DAYS = int(os.environ.get('LOG_MAX_QUERY_DAYS', 90))
 
-  def exists(self, table_name):
+class Log(TableStore):
+  def build_item(self, username, dt, status_code, message, type_message, to_user, notification_id, notification_title):
     """
-    Determines whether a table exists. As a side effect, stores the table in
-    a member variable.
-    :param table_name: The name of the table to check.
-    :return: True when the table exists; otherwise, False.
+    Builds the item stored for a log entry. The log_date attribute partitions
+    the date index, and notification_id is left out when empty because index
+    key attributes can't hold empty strings.
     """
-    try:
-      table = self.dyn_resource.Table(table_name)
-      table.load()
-      exists = True
-    except ClientError as err:
-      if err.response['Error']['Code'] == 'ResourceNotFoundException':
-        exists = False
-      else:
-        logger.error(
-          "Couldn't check for existence of %s. Here's why: %s: %s",
-          table_name,
-          err.response['Error']['Code'], err.response['Error']['Message']
-        )
-        raise
-    else:
-      self.table = table
-    return exists
+    item = {
+      'log_id': str(uuid.uuid4()),
+      'user': username,
+      'created_at': dt.strftime("%FT%T"),
+      'log_date': dt.strftime("%F"),
+      'status': str(status_code),
+      'notification_title': notification_title,
+      'message': message,
+      'type': type_message,
+      'to_user': to_user
+    }
+    if notification_id:
+      item['notification_id'] = notification_id
+    return item
 
   def add_log(self, username, dt, status_code, message, type_message, to_user, notification_id, notification_title):
     try:
 
       self.table.put_item(
-        Item={
-          'log_id': str(uuid.uuid4()),
-          'user': username,
-          'created_at': dt.strftime("%FT%T"),
-          'status': str(status_code),
-          'notification_id': notification_id,
-          'notification_title': notification_title,
-          'message': message,
-          'type': type_message,
-          'to_user': to_user
-        }
+        Item=self.build_item(username, dt, status_code, message, type_message, to_user, notification_id, notification_title)
       )
 
     except ClientError as err:
+      tables.discard_if_missing(err, self.table.name)
       status_code = err.response['ResponseMetadata']['HTTPStatusCode']
       message = f"Couldn't add log {type_message} to {to_user} to table {self.table.name}. Here's why: {err.response['Error']['Code']}: {err.response['Error']['Message']}"
       logger.error(f'{status_code}: {message}')
@@ -65,20 +53,154 @@ class Log:
     else:
       return 200, f'Log {type_message} {self.table.name} created successfully to {to_user}'
 
-  def scan_log(self):
-    logs = []
-    now = datetime.now()
-    seven_days_ago = now - timedelta(days=7)
+  def query_logs(self, start, end, notification_id=None, type_message=None, status=None, limit=50, cursor=None):
+    """
+    Queries the logs created in a time range, newest first. Logs of one
+    notification are read from the notification index; otherwise each day of
+    the range is read from the date index.
+    :param start: The datetime the range starts at.
+    :param end: The datetime the range ends at.
+    :param notification_id: Only returns logs of this notification.
+    :param type_message: Only returns logs of this type.
+    :param status: Only returns logs with this status.
+    :param limit: The maximum number of logs returned.
+    :param cursor: The state returned by a previous call, to read the next page.
+    :return: The status code, message, logs and the state of the next page,
+             which is None on the last page.
+    """
+    if start > end:
+      return 400, "The start of the range must be before its end", [], None
+    if (end.date() - start.date()).days >= MAX_QUERY_DAYS:
+      return 400, f"The range can't be longer than {MAX_QUERY_DAYS} days", [], None
 
-    filterDate = Key('created_at').between(seven_days_ago.strftime("%FT%T"), now.strftime("%FT%T"))
+    between = Key('created_at').between(start.strftime("%FT%T"), end.strftime("%FT%T"))
+    filters = None
+    if type_message:
+      filters = Attr('type').eq(type_message)
+    if status:
+      filters = Attr('status').eq(str(status)) if filters is None else filters & Attr('status').eq(str(status))
 
+    if notification_id:
+      partitions = [(NOTIFICATION_INDEX, Key('notification_id').eq(notification_id) & between, None)]
+    else:
+      days = (end.date() - start.date()).days
+      partitions = []
+      for offset in range(days + 1):
+        day = (end - timedelta(days=offset)).strftime("%F")
+        partitions.append((DATE_INDEX, Key('log_date').eq(day) & between, day))
+
+    state = cursor or {}
+    if state.get('day'):
+      partitions = [partition for partition in partitions if partition[2] is None or partition[2] <= state['day']]
+    start_key = state.get('key')
+
+    logs = []
     try:
-      response = self.table.scan()
-      logs = response.get('Items', [])
+      for position, (index, condition, day) in enumerate(partitions):
+        while len(logs) < limit:
+          params = {
+            'IndexName': index,
+            'KeyConditionExpression': condition,
+            'ScanIndexForward': False,
+            'Limit': limit - len(logs),
+          }
+          if filters is not None:
+            params['FilterExpression'] = filters
+          if start_key:
+            params['ExclusiveStartKey'] = start_key
+
+          response = self.table.query(**params)
+          logs.extend(response.get('Items', []))
+          start_key = response.get('LastEvaluatedKey')
+          if not start_key:
+            break
+
+        if len(logs) >= limit:
+          if start_key:
+            return 200, "Logs retrieved successfully", logs, {'day': day, 'key': start_key}
+          if position + 1 < len(partitions):
+            return 200, "Logs retrieved successfully", logs, {'day': partitions[position + 1][2], 'key': None}
+          return 200, "Logs retrieved successfully", logs, None
     except ClientError as err:
+      tables.discard_if_missing(err, self.table.name)
       status_code = err.response['ResponseMetadata']['HTTPStatusCode']
       message = f"Couldn't retrieves logs of table {self.table.name}. Here's why: {err.response['Error']['Code']}: {err.response['Error']['Message']}"
       logger.error(f'{status_code}: {message}')
-      return status_code, message, []
+      return status_code, message, [], None
+
+    return 200, "Logs retrieved successfully", logs, None
+
+
+class LogBuffer(Log):
+  BATCH_SIZE = MAX_BATCH_WRITES
 
-    return 200, "Logs retrieved successfully", logs
+  def __init__(self, dyn_resource, max_retries=None, min_remaining_ms=None):
+    """
+    A Log that queues entries in memory and writes them with BatchWriteItem,
+    25 items per request, instead of one PutItem per entry.
+    :param dyn_resource: A Boto3 DynamoDB resource.
+    :param max_retries: How many times unprocessed items are retried, with
+                        exponential backoff, before they are dropped.
+    :param min_remaining_ms: The remaining Lambda time below which
+                             flush_if_running_out writes the queued entries.
+    """
+    super(LogBuffer, self).__init__(dyn_resource)
+    if max_retries is None:
+      max_retries = int(os.environ.get('LOG_FLUSH_MAX_RETRIES', 5))
+    if min_remaining_ms is None:
+      min_remaining_ms = int(os.environ.get('LOG_FLUSH_MIN_REMAINING_MS', 2000))
+    self.max_retries = max_retries
+    self.min_remaining_ms = min_remaining_ms
+    self._items = []
+    self._lock = threading.Lock()
+
+  def add_log(self, username, dt, status_code, message, type_message, to_user, notification_id, notification_title):
+    item = self.build_item(username, dt, status_code, message, type_message, to_user, notification_id, notification_title)
+    with self._lock:
+      self._items.append(item)
+    return 200, f'Log {type_message} {self.table.name} queued to {to_user}'
+
+  def flush_if_running_out(self, context):
+    """
+    Flushes the queued entries when the invocation is close to its timeout.
+    :param context: The Lambda context object, or None outside Lambda.
+    """
+    if context is None or not hasattr(context, 'get_remaining_time_in_millis'):
+      return
+    if context.get_remaining_time_in_millis() < self.min_remaining_ms:
+      self.flush()
+
+  def flush(self):
+    """
+    Writes every queued entry to the table.
+    :return: The number of entries written and the number of entries dropped.
+    """
+    with self._lock:
+      items, self._items = self._items, []
+
+    if not items:
+      return 0, 0
+
+    written, dropped = 0, 0
+    with metrics.timer('log_write') as stage:
+      for start in range(0, len(items), self.BATCH_SIZE):
+        chunk = items[start:start + self.BATCH_SIZE]
+        failed = self._write_batch(chunk)
+        written += len(chunk) - failed
+        dropped += failed
+
+      stage.count = len(items)
+      if dropped:
+        stage.error, stage.failed = 'UnprocessedItems', dropped
+
+    if dropped:
+      logger.error(f'{dropped} log entries could not be written to table {self.table.name}')
+    return written, dropped
+
+  def _write_batch(self, items):
+    """
+    Writes up to 25 items, retrying the unprocessed ones with backoff.
+    :return: The number of items that could not be written.
+    """
+    write_requests = [{'PutRequest': {'Item': item}} for item in items]
+    return write_batch(self.dyn_resource, self.table.name, write_requests, self.max_retries)
@@ -1,27 +1,59 @@
+import asyncio
 import os
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail, Subject
+import requests
+from sendgrid.helpers.mail import Mail, Personalization, To
 import logging
 from dotenv import load_dotenv
-
-load_dotenv()
+from services.breaker import get_breaker, OPEN_MESSAGE, OPEN_STATUS
+from services.http import get_async_session, get_session, TIMEOUT
+from services.ratelimit import get_limiter, THROTTLED_MESSAGE
 
 logger = logging.getLogger(__name__)
 IS_OFFLINE = os.environ.get('IS_OFFLINE')
 FROM_EMAIL = 'no-reply@lumaensino.com.br'
+MAX_PERSONALIZATIONS = 1000
+SENDGRID_URL = 'https://api.sendgrid.com/v3/mail/send'
 
 class Sendgrid(object):
 
     def __init__(self):
         super(Sendgrid, self).__init__()
+        load_dotenv()
         api_key = os.environ.get('SENDGRID_API_KEY', None)
         self._token = api_key
+        self._session = self.new_session()
+        self._limiter = get_limiter('sendgrid')
+        self._breaker = get_breaker('sendgrid')
 
         if IS_OFFLINE:
             logger.setLevel(logging.DEBUG)
 
 
     def send_template_email(self, email_id, to_emails, dynamic_template_data):
+        if self._token:
+            status_code, error = self.send(self.template_email(email_id, to_emails, dynamic_template_data))
+            return self.result(status_code, error, email_id, ",".join("(%s,%s)" % tup for tup in to_emails))
+
+        logger.error(f'SendGrid API error: {403}. Here is the error message: No API Key was provided')
+        return 403, str("No API Key was provided")
+
+    def send_bulk_template_email(self, email_id, recipients):
+        """
+        Sends one template to several recipients with a single request, one
+        personalization per recipient.
+        :param email_id: The SendGrid dynamic template id.
+        :param recipients: A list of (to_emails, dynamic_template_data) tuples,
+                           at most MAX_PERSONALIZATIONS long.
+        :return: The status code and message of the request, shared by every recipient.
+        """
+        if self._token:
+            status_code, error = self.send(self.bulk_template_email(email_id, recipients))
+            return self.result(status_code, error, email_id, f'{len(recipients)} recipients')
+
+        logger.error(f'SendGrid API error: {403}. Here is the error message: No API Key was provided')
+        return 403, str("No API Key was provided")
+
+    def template_email(self, email_id, to_emails, dynamic_template_data):
         message = Mail(
             from_email=FROM_EMAIL,
             to_emails=to_emails
@@ -29,24 +61,131 @@ class Sendgrid(object):
 
         message.dynamic_template_data = dynamic_template_data
         message.template_id = email_id
+        return message
+
+    def bulk_template_email(self, email_id, recipients):
+        message = Mail(from_email=FROM_EMAIL)
+        message.template_id = email_id
+
+        for to_emails, dynamic_template_data in recipients:
+            personalization = Personalization()
+            for email, name in to_emails:
+                personalization.add_to(To(email, name))
+            personalization.dynamic_template_data = dynamic_template_data
+            message.add_personalization(personalization)
+
+        return message
+
+    def new_session(self):
+        return get_session('sendgrid')
+
+    def headers(self):
+        return {
+            'Authorization': f'Bearer {self._token}',
+            'Content-Type': 'application/json'
+        }
+
+    def result(self, status_code, error, email_id, recipients):
+        if error:
+            logger.error(f'SendGrid API error: {status_code}. Here is the error message: {error}')
+            return status_code, error
+
+        message = f'Message {email_id} sent to {recipients}'
+        logger.info(message)
+        return status_code, message
 
+    def observe(self, status_code, headers):
+        if self._limiter is not None:
+            self._limiter.observe(status_code, headers.get('Retry-After'))
+
+    def send(self, message):
+        """
+        Sends a Mail unless the provider's circuit breaker is open, and reports
+        the outcome to the breaker.
+        :return: The status code and, when the request failed, the error message.
+        """
+        if self._breaker is None:
+            return self.post(message)
+        if not self._breaker.allow():
+            return OPEN_STATUS, OPEN_MESSAGE
+
+        status_code, error = self.post(message)
+        self._breaker.record(status_code)
+        return status_code, error
+
+    def post(self, message):
+        """
+        Posts a Mail to the v3 mail/send endpoint through the pooled session,
+        once the provider's rate limiter has a token for it.
+        :return: The status code and, when the request failed, the error message.
+        """
+        if self._limiter is not None and not self._limiter.acquire():
+            return 429, THROTTLED_MESSAGE
+
+        try:
+            response = self._session.post(SENDGRID_URL, headers=self.headers(), json=message.get(), timeout=TIMEOUT)
+            self.observe(response.status_code, response.headers)
+            response.raise_for_status()
+        except requests.exceptions.Timeout:
+            return 504, 'Timeout Error ocurred'
+        except requests.exceptions.HTTPError:
+            return response.status_code, response.text or str(response.reason)
+        except requests.exceptions.RequestException as e:
+            return 502, str(e)
+
+        return response.status_code, None
+
+
+class AsyncSendgrid(Sendgrid):
+    """
+    Sendgrid client whose sends are coroutines running on the aiohttp session
+    of the current event loop.
+    """
+
+    def new_session(self):
+        # Sends go through get_async_session, the requests session is never used.
+        return None
+
+    async def send_template_email(self, email_id, to_emails, dynamic_template_data):
         if self._token:
-            try:
-                sg = SendGridAPIClient(self._token)
-                response = sg.send(message)
-            except Exception as e:
-                status_code = type(e).__name__
-                message = f'{str(e)}'
-
-                logger.error(f'SendGrid API error: {status_code}. Here is the error message: {message}')
-
-                return status_code, message
-            else:
-                status_code = response.status_code
-                formatted_emails = ",".join("(%s,%s)" % tup for tup in to_emails)
-                message = f'Message {email_id} sent to {formatted_emails}'
-                logger.info(message)
-                return response.status_code, message
+            status_code, error = await self.send(self.template_email(email_id, to_emails, dynamic_template_data))
+            return self.result(status_code, error, email_id, ",".join("(%s,%s)" % tup for tup in to_emails))
 
         logger.error(f'SendGrid API error: {403}. Here is the error message: No API Key was provided')
         return 403, str("No API Key was provided")
+
+    async def send_bulk_template_email(self, email_id, recipients):
+        if self._token:
+            status_code, error = await self.send(self.bulk_template_email(email_id, recipients))
+            return self.result(status_code, error, email_id, f'{len(recipients)} recipients')
+
+        logger.error(f'SendGrid API error: {403}. Here is the error message: No API Key was provided')
+        return 403, str("No API Key was provided")
+
+    async def send(self, message):
+        if self._breaker is None:
+            return await self.post(message)
+        if not self._breaker.allow():
+            return OPEN_STATUS, OPEN_MESSAGE
+
+        status_code, error = await self.post(message)
+        self._breaker.record(status_code)
+        return status_code, error
+
+    async def post(self, message):
+        import aiohttp
+
+        if self._limiter is not None and not await self._limiter.acquire_async():
+            return 429, THROTTLED_MESSAGE
+
+        session = get_async_session('sendgrid')
+        try:
+            async with session.post(SENDGRID_URL, headers=self.headers(), json=message.get()) as response:
+                self.observe(response.status, response.headers)
+                if response.status >= 400:
+                    return response.status, (await response.text()) or str(response.reason)
+                return response.status, None
+        except asyncio.TimeoutError:
+            return 504, 'Timeout Error ocurred'
+        except aiohttp.ClientError as e:
+            return 502, str(e)
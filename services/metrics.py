@@ -0,0 +1,162 @@
+import functools
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from services import codec
+
+NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'aws-python-sqs-worker')
+ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() == 'true'
+
+# CloudWatch accepts at most 100 values per metric in one EMF document.
+MAX_VALUES = 100
+
+
+class Stage:
+  def __init__(self):
+    """
+    The outcome of a timed stage.
+    """
+    self.count = 1
+    self.error = None
+    self.failed = None
+
+
+class Metrics:
+  def __init__(self, namespace=NAMESPACE, enabled=ENABLED, stream=None):
+    """
+    Collects per-stage timings, counts and error classes during an invocation
+    and writes them as CloudWatch Embedded Metric Format JSON lines on flush.
+    :param namespace: The CloudWatch namespace of the metrics.
+    :param enabled: When False, nothing is recorded or written.
+    :param stream: Where the JSON lines are written. Defaults to stdout, which
+                   Lambda forwards to CloudWatch Logs.
+    """
+    self.namespace = namespace
+    self.enabled = enabled
+    self._stream = stream
+    self._stages = {}
+    self._errors = {}
+    self._lock = threading.Lock()
+
+  @contextmanager
+  def timer(self, stage, **dimensions):
+    """
+    Times the block as one occurrence of a stage. The block receives a Stage
+    where it can set the number of items handled and an error class. An
+    exception raised by the block is recorded with its class name and raised
+    again.
+    """
+    timing = Stage()
+    started = time.perf_counter()
+    try:
+      yield timing
+    except Exception as e:
+      timing.error = type(e).__name__
+      raise
+    finally:
+      self.record(stage, time.perf_counter() - started, timing.count, timing.error, timing.failed, **dimensions)
+
+  def record(self, stage, seconds, count=1, error=None, failed=None, **dimensions):
+    """
+    Records one occurrence of a stage.
+    :param stage: The stage name, such as "provider_send".
+    :param seconds: How long the stage took.
+    :param count: How many items the stage handled, such as the recipients of
+                  a coalesced send.
+    :param error: The error class when the stage failed.
+    :param failed: How many of the items failed. Defaults to all of them when
+                   an error class is given.
+    :param dimensions: Extra dimensions, such as Template or Channel.
+    """
+    if not self.enabled:
+      return
+
+    key = (stage, tuple(sorted((name, str(value)) for name, value in dimensions.items() if value)))
+    with self._lock:
+      entry = self._stages.setdefault(key, {'Duration': [], 'Count': 0, 'Errors': 0})
+      entry['Duration'].append(seconds * 1000)
+      entry['Count'] += count
+      if error:
+        failed = count if failed is None else failed
+        entry['Errors'] += failed
+        error_key = key + (str(error),)
+        self._errors[error_key] = self._errors.get(error_key, 0) + failed
+
+  def flush_after(self, function):
+    """
+    Decorates a handler so the metrics it collected are written when it
+    returns or raises.
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+      try:
+        return function(*args, **kwargs)
+      finally:
+        self.flush()
+
+    return wrapper
+
+  def flush(self):
+    """
+    Writes the collected metrics and starts a new collection.
+    """
+    if not self.enabled:
+      return
+
+    with self._lock:
+      stages, self._stages = self._stages, {}
+      errors, self._errors = self._errors, {}
+
+    stream = self._stream or sys.stdout
+    timestamp = int(time.time() * 1000)
+    for (stage, dimensions), entry in stages.items():
+      for start in range(0, max(len(entry['Duration']), 1), MAX_VALUES):
+        first = start == 0
+        document = self._document(timestamp, stage, dimensions, [
+          {'Name': 'Duration', 'Unit': 'Milliseconds'},
+          {'Name': 'Count', 'Unit': 'Count'},
+          {'Name': 'Errors', 'Unit': 'Count'},
+        ])
+        document['Duration'] = entry['Duration'][start:start + MAX_VALUES]
+        document['Count'] = entry['Count'] if first else 0
+        document['Errors'] = entry['Errors'] if first else 0
+        stream.write(codec.dumps(document) + '\n')
+
+    for (stage, dimensions, error), count in errors.items():
+      document = self._document(timestamp, stage, dimensions + (('ErrorClass', error),), [
+        {'Name': 'Errors', 'Unit': 'Count'},
+      ])
+      document['Errors'] = count
+      stream.write(codec.dumps(document) + '\n')
+
+    stream.flush()
+
+  def _document(self, timestamp, stage, dimensions, definitions):
+    names = ['Stage'] + [name for name, _ in dimensions]
+    document = {
+      '_aws': {
+        'Timestamp': timestamp,
+        'CloudWatchMetrics': [{
+          'Namespace': self.namespace,
+          'Dimensions': [names],
+          'Metrics': definitions,
+        }],
+      },
+      'Stage': stage,
+    }
+    document.update(dict(dimensions))
+    return document
+
+
+def status_error(status_code):
+  """
+  :return: The error class of a provider status code, or None on success.
+  """
+  if isinstance(status_code, int) and 200 <= status_code < 300:
+    return None
+  return f'HTTP{status_code}' if isinstance(status_code, int) else str(status_code)
+
+
+metrics = Metrics()
@@ -1,43 +1,68 @@
+import os
 import uuid
 import logging
+from datetime import datetime
 from botocore.exceptions import ClientError
+from services import codec
+from services.tables import TableStore, registry as tables
+from services.cache import TTLCache
+from services.validation import definition_errors
 
 logger = logging.getLogger(__name__)
 
-class Notifications:
-  _all_fields = [ 'title', 'send_email', 'send_whatsapp', 'email_id', 'email_fields', 'template_name', 'whatsapp_fields' ]
+# Notification definitions cached per container, shared by every Notifications
+# instance so warm invocations of the producer and consumer skip the GetItem.
+cache = TTLCache(
+  max_size=int(os.environ.get('NOTIFICATION_CACHE_SIZE', 128)),
+  ttl=float(os.environ.get('NOTIFICATION_CACHE_TTL', 60))
+)
 
-  def __init__(self, dyn_resource):
-    """
-    :param dyn_resource: A Boto3 DynamoDB resource.
-    """
-    self.dyn_resource = dyn_resource
-    self.table = None
+# The fields the consumer needs to send a message, embedded in every queued
+# message so the consumer doesn't read the notification again.
+SNAPSHOT_FIELDS = ('notification_id', 'updated_at', 'title', 'send_email', 'send_whatsapp', 'email_id', 'template_name')
+
+
+def version():
+  """
+  :return: A version stamp for a notification write. Stamps sort in the
+           order they were written.
+  """
+  return datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+def snapshot(notification):
+  """
+  :return: The compact JSON snapshot of a notification sent along its messages.
+  """
+  return codec.dumps({field: notification.get(field) for field in SNAPSHOT_FIELDS})
+
+
+def from_snapshot(value):
+  """
+  :return: The notification of a snapshot, or None when it is missing or
+           malformed.
+  """
+  if not value:
+    return None
+  try:
+    notification = codec.loads(value)
+  except ValueError:
+    return None
+  if not isinstance(notification, dict) or any(field not in notification for field in SNAPSHOT_FIELDS):
+    return None
+  return notification
+
+
+def is_newer(notification, other):
+  """
+  :return: True when a notification was written after another one. Items
+           written before versions were stamped are the oldest.
+  """
+  return (notification.get('updated_at') or '') > (other.get('updated_at') or '')
 
-  def exists(self, table_name):
-    """
-    Determines whether a table exists. As a side effect, stores the table in
-    a member variable.
-    :param table_name: The name of the table to check.
-    :return: True when the table exists; otherwise, False.
-    """
-    try:
-      table = self.dyn_resource.Table(table_name)
-      table.load()
-      exists = True
-    except ClientError as err:
-      if err.response['Error']['Code'] == 'ResourceNotFoundException':
-        exists = False
-      else:
-        logger.error(
-          "Couldn't check for existence of %s. Here's why: %s: %s",
-          table_name,
-          err.response['Error']['Code'], err.response['Error']['Message']
-        )
-        raise
-    else:
-      self.table = table
-    return exists
+
+class Notifications(TableStore):
+  _all_fields = [ 'title', 'send_email', 'send_whatsapp', 'email_id', 'email_fields', 'template_name', 'whatsapp_fields', 'updated_at', 'priority' ]
 
   def add_notification(self, data):
     """
@@ -47,6 +72,7 @@ class Notifications:
     try:
       notification_id = str(uuid.uuid4())
       data['notification_id'] =  notification_id
+      data['updated_at'] = version()
 
       is_valid, message = self.is_valid(data)
       if not is_valid:
@@ -55,6 +81,7 @@ class Notifications:
       self.table.put_item(Item=data)
 
     except ClientError as err:
+      tables.discard_if_missing(err, self.table.name)
       status_code = err.response['ResponseMetadata']['HTTPStatusCode']
       message = f"Couldn't add notification {data['title']} to table {self.table.name}. Here's why: {err.response['Error']['Code']}: {err.response['Error']['Message']}"
       logger.error(f'{status_code}: {message}')
@@ -63,15 +90,23 @@ class Notifications:
     else:
       return 200, f'Notification {data["title"]} created successfully', data
 
-  def get_notification_by_id(self, notification_id):
+  def get_notification_by_id(self, notification_id, use_cache=False):
     """
     Gets notification data from the table for a specific notification identifier.
     :param notification_id: The notification hash identifier.
+    :param use_cache: When True, serves the notification from the container
+                      cache and stores it there after a successful read.
     :return: The data about the requested notification.
     """
+    if use_cache:
+      item = cache.get(notification_id)
+      if item is not None:
+        return 200, 'Notification was successfully retrieved', item
+
     try:
       response = self.table.get_item(Key={'notification_id': notification_id})
     except ClientError as err:
+      tables.discard_if_missing(err, self.table.name)
       status_code = err.response['ResponseMetadata']['HTTPStatusCode']
       message = f"Couldn't get notification {notification_id} to table {self.table.name}. Here's why: {err.response['Error']['Code']}: {err.response['Error']['Message']}"
       logger.error(f'{status_code}: {message}')
@@ -79,26 +114,54 @@ class Notifications:
     else:
       item = response.get("Item")
       if item is not None:
+        if use_cache:
+          cache.set(notification_id, item)
         return 200, f'Notification was successfully retrieved', item
       else:
         return 404, f'Notification not found', {}
 
-  def scan_notifications(self):
+  def scan_notifications(self, limit=100, cursor=None, fields=None):
     """
-    Scans for all notifications.
-    :return: The list of notifications.
+    Scans one page of notifications.
+    :param limit: The maximum number of notifications returned.
+    :param cursor: The state returned by a previous call, to read the next page.
+    :param fields: The attributes to read. notification_id is always read.
+                   When None, every attribute is read.
+    :return: The status code, message, list of notifications and the state of
+             the next page, which is None on the last page.
     """
+    params = {}
+    if fields:
+      unknown = [field for field in fields if field not in self._all_fields and field != 'notification_id']
+      if unknown:
+        return 400, f"Unknown fields: {', '.join(unknown)}", [], None
+
+      names = ['notification_id'] + [field for field in fields if field != 'notification_id']
+      params['ProjectionExpression'] = ', '.join(f'#f{i}' for i in range(len(names)))
+      params['ExpressionAttributeNames'] = {f'#f{i}': name for i, name in enumerate(names)}
+
+    start_key = (cursor or {}).get('key')
     notifications = []
     try:
-      response = self.table.scan()
-      notifications = response.get('Items', [])
+      while len(notifications) < limit:
+        params['Limit'] = limit - len(notifications)
+        if start_key:
+          params['ExclusiveStartKey'] = start_key
+
+        response = self.table.scan(**params)
+        notifications.extend(response.get('Items', []))
+        start_key = response.get('LastEvaluatedKey')
+        if not start_key:
+          break
     except ClientError as err:
+      tables.discard_if_missing(err, self.table.name)
       status_code = err.response['ResponseMetadata']['HTTPStatusCode']
       message = f"Couldn't retrieves notification of table {self.table.name}. Here's why: {err.response['Error']['Code']}: {err.response['Error']['Message']}"
       logger.error(f'{status_code}: {message}')
-      return status_code, message, []
+      return status_code, message, [], None
 
-    return 200, "Notifications retrieved successfully", notifications
+    next_page = {'key': start_key} if start_key else None
+    return 200, "Notifications retrieved successfully", notifications, next_page
 
   def delete_notification(self, notification_id):
     """
@@ -112,7 +175,9 @@ class Notifications:
           'notification_id': notification_id
         }
       )
+      cache.invalidate(notification_id)
     except ClientError as err:
+      tables.discard_if_missing(err, self.table.name)
       status_code = err.response['ResponseMetadata']['HTTPStatusCode']
       message = f"Couldn't delete notification {notification_id} of table {self.table.name}. Here's why: {err.response['Error']['Code']}: {err.response['Error']['Message']}"
       return status_code, message, notification
@@ -131,22 +196,31 @@ class Notifications:
     if not is_valid:
       return 400, message, notification
 
+    update = "set title=:t, send_email=:se, send_whatsapp=:sw, email_id=:e, email_fields=:ef, template_name=:tn, whatsapp_fields=:wf, updated_at=:u"
+    values = {
+      ':u': version(),
+      ':t': str(payload["title"]),
+      ':se': payload["send_email"],
+      ':sw': payload["send_whatsapp"],
+      ':e': str(payload["email_id"]),
+      ':ef': payload["email_fields"],
+      ':tn': str(payload["template_name"]),
+      ':wf': payload["whatsapp_fields"],
+    }
+    if payload.get("priority") is not None:
+      update += ", priority=:p"
+      values[':p'] = payload["priority"]
+
     try:
       response = self.table.update_item(
         Key={'notification_id': notification_id},
-        UpdateExpression="set title=:t, send_email=:se, send_whatsapp=:sw, email_id=:e, email_fields=:ef, template_name=:tn, whatsapp_fields=:wf",
-        ExpressionAttributeValues={
-          ':t': str(payload["title"]),
-          ':se': payload["send_email"],
-          ':sw': payload["send_whatsapp"],
-          ':e': str(payload["email_id"]),
-          ':ef': payload["email_fields"],
-          ':tn': str(payload["template_name"]),
-          ':wf': payload["whatsapp_fields"],
-        },
+        UpdateExpression=update,
+        ExpressionAttributeValues=values,
         ReturnValues="UPDATED_NEW"
       )
+      cache.invalidate(notification_id)
     except ClientError as err:
+      tables.discard_if_missing(err, self.table.name)
       status_code = err.response['ResponseMetadata']['HTTPStatusCode']
       message = f"Couldn't update notification {notification_id} of table {self.table.name}. Here's why: {err.response['Error']['Code']}: {err.response['Error']['Message']}"
       return status_code, message, notification
@@ -154,26 +228,13 @@ class Notifications:
       return 200, f'Notification {payload["title"]} updated successfully', payload
 
   def is_valid(self, body):
-    if not "title" in body:
-      return False, "No title was provided"
-
-    if not "send_email" in body or not "send_whatsapp" in body:
-      return False, "Please, toggle the send_email or whatsapp"
-
-    # Validacao de email
-    if body["send_email"] and (not "email_id" in body or len(body["email_id"]) <= 0):
-      return False, "No email template id was provided"
-
-    if body["send_email"] and (("email_fields" in body and len(body["email_fields"]) <= 0) or (not "email_fields" in body)):
-      return False, "No email fields were provided"
-
-    # Validacao de whatsapp
-    if body["send_whatsapp"] and (not "template_name" in body or len(body["template_name"]) <= 0):
-      return False, "No template name was provided"
-
-    if body["send_whatsapp"] and (("whatsapp_fields" in body and len(body["whatsapp_fields"]) <= 0) or (not "whatsapp_fields" in body)):
-      return False, "No whatsapp fields were provided"
-
+    """
+    Checks a notification definition.
+    :return: A tuple with a success flag and a message listing every problem.
+    """
+    errors = definition_errors(body)
+    if errors:
+      return False, '; '.join(errors)
     return True, "OK"
 
   def format_notification(item):
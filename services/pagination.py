@@ -0,0 +1,46 @@
+import base64
+from services import codec
+
+
+def encode_cursor(state):
+  """
+  Turns the state needed to resume a query into an opaque token.
+  :param state: A JSON serializable dict, or None when there are no more pages.
+  :return: The cursor token, or None.
+  """
+  if state is None:
+    return None
+  data = codec.dumps(state, sort_keys=True).encode('utf-8')
+  return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+  """
+  Reads a token built by encode_cursor. The key of the state is passed to
+  DynamoDB as ExclusiveStartKey, so it must be a dict of key attributes, and
+  every other value a string or a number.
+  :param cursor: The cursor token received from the client, or None.
+  :return: The state dict, or None when no cursor was given. Raises ValueError
+           when the cursor is malformed.
+  """
+  if not cursor:
+    return None
+  try:
+    data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+    state = codec.loads(data)
+  except (ValueError, TypeError) as e:
+    raise ValueError(f'Invalid cursor: {e}')
+  if not isinstance(state, dict):
+    raise ValueError('Invalid cursor')
+
+  key = state.get('key')
+  if key is not None and not (isinstance(key, dict) and key and all(is_key_value(value) for value in key.values())):
+    raise ValueError('Invalid cursor: malformed key')
+  if not all(value is None or is_key_value(value) for name, value in state.items() if name != 'key'):
+    raise ValueError('Invalid cursor: malformed state')
+  return state
+
+
+def is_key_value(value):
+  # Key attributes are strings or integers; bool is an int but not a key type.
+  return isinstance(value, (str, int)) and not isinstance(value, bool)
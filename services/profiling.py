@@ -0,0 +1,156 @@
+import cProfile
+import functools
+import io
+import logging
+import os
+import pstats
+import random
+import threading
+import time
+import tracemalloc
+from services import codec
+
+logger = logging.getLogger(__name__)
+
+# Fraction of invocations profiled, from 0 to 1.
+SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+# Also profiles the invocations that ask for it, see requested.
+ON_REQUEST = os.environ.get('PROFILE_ON_REQUEST', 'false').lower() == 'true'
+TOP = int(os.environ.get('PROFILE_TOP', 15))
+TRACEMALLOC = os.environ.get('PROFILE_TRACEMALLOC', 'true').lower() == 'true'
+# Directory the full cProfile stats are written to, such as /tmp. Unset, only
+# the summary is logged.
+DUMP_DIR = os.environ.get('PROFILE_DUMP_DIR')
+
+# cProfile can't run twice at once, so a handler called by another profiled
+# one isn't profiled again.
+_active = threading.Lock()
+
+
+def requested(event):
+  """
+  Whether an invocation asks to be profiled: a direct invocation with
+  "profile": true, an HTTP request with the X-Profile: 1 header, or an SQS
+  batch with a record carrying a "profile" message attribute.
+  """
+  if not isinstance(event, dict):
+    return False
+  if event.get('profile') is True:
+    return True
+  headers = event.get('headers') or {}
+  if headers.get('x-profile') == '1' or headers.get('X-Profile') == '1':
+    return True
+  return any('profile' in record.get('messageAttributes', {}) for record in event.get('Records', ()))
+
+
+def profiled(function=None, sample_rate=None, on_request=None):
+  """
+  Decorates a handler so a sampled fraction of its invocations, and the ones
+  that ask for it when on_request is set, run under cProfile and tracemalloc.
+  The top functions by cumulative time and the top allocation sites are
+  logged as one JSON line. When neither is enabled, the handler is returned
+  as is and costs nothing.
+  :param sample_rate: Defaults to PROFILE_SAMPLE_RATE.
+  :param on_request: Defaults to PROFILE_ON_REQUEST.
+  """
+  if function is None:
+    return functools.partial(profiled, sample_rate=sample_rate, on_request=on_request)
+
+  sample_rate = SAMPLE_RATE if sample_rate is None else sample_rate
+  on_request = ON_REQUEST if on_request is None else on_request
+  if sample_rate <= 0 and not on_request:
+    return function
+
+  @functools.wraps(function)
+  def wrapper(event, context, *args, **kwargs):
+    wanted = random.random() < sample_rate or (on_request and requested(event))
+    if not wanted or not _active.acquire(blocking=False):
+      return function(event, context, *args, **kwargs)
+    try:
+      return profile_call(function.__name__, function, event, context, *args, **kwargs)
+    finally:
+      _active.release()
+
+  return wrapper
+
+
+def profile_call(name, function, *args, **kwargs):
+  """
+  Runs a function under cProfile, and tracemalloc when PROFILE_TRACEMALLOC is
+  set, then logs the summary.
+  """
+  tracing = TRACEMALLOC and not tracemalloc.is_tracing()
+  if tracing:
+    tracemalloc.start()
+  profiler = cProfile.Profile()
+  started = time.perf_counter()
+  profiler.enable()
+  try:
+    return function(*args, **kwargs)
+  finally:
+    profiler.disable()
+    elapsed = time.perf_counter() - started
+    allocations, peak = None, None
+    if tracing:
+      snapshot = tracemalloc.take_snapshot()
+      peak = tracemalloc.get_traced_memory()[1]
+      tracemalloc.stop()
+      allocations = top_allocations(snapshot, TOP)
+    report(name, profiler, elapsed, allocations, peak)
+
+
+def top_functions(profiler, limit):
+  """
+  :return: The functions with the most cumulative time, as
+           [cumulative_ms, own_ms, calls, "file:line(function)"] lists.
+  """
+  stats = pstats.Stats(profiler, stream=io.StringIO())
+  rows = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:limit]
+  return [
+    [round(cumulative * 1000, 2), round(own * 1000, 2), calls, f'{short_path(path)}:{line}({function})']
+    for (path, line, function), (_, calls, own, cumulative, _) in rows
+  ]
+
+
+def top_allocations(snapshot, limit):
+  """
+  :return: The source lines that hold the most memory, as
+           [kib, blocks, "file:line"] lists.
+  """
+  stats = snapshot.filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),)).statistics('lineno')[:limit]
+  return [
+    [round(stat.size / 1024, 1), stat.count, f'{short_path(stat.traceback[0].filename)}:{stat.traceback[0].lineno}']
+    for stat in stats
+  ]
+
+
+def short_path(path):
+  """
+  Keeps the part of a path after site-packages or the task root, so the
+  summary stays short.
+  """
+  for marker in ('site-packages/', '/var/task/', 'lib/python'):
+    if marker in path:
+      return path.split(marker, 1)[1]
+  return path
+
+
+def report(name, profiler, elapsed, allocations, peak):
+  summary = {
+    'profile': name,
+    'ms': round(elapsed * 1000, 2),
+    'top_cumulative': top_functions(profiler, TOP),
+  }
+  if allocations is not None:
+    summary['peak_kib'] = round(peak / 1024, 1)
+    summary['top_allocations'] = allocations
+
+  if DUMP_DIR:
+    path = os.path.join(DUMP_DIR, f'{name}-{int(time.time() * 1000)}.prof')
+    try:
+      profiler.dump_stats(path)
+      summary['dump'] = path
+    except OSError as e:
+      logger.warning(f"Couldn't write the profile to {path}: {e}")
+
+  logger.info(codec.dumps(summary))
@@ -0,0 +1,157 @@
+import logging
+import os
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger(__name__)
+
+MAX_BATCH_ENTRIES = 10
+MAX_BATCH_BYTES = 256 * 1024
+MAX_VISIBILITY_TIMEOUT = 12 * 60 * 60
+
+
+def queue_url_from_arn(arn):
+  """
+  Builds the URL of a queue from its ARN, as found in the eventSourceARN of
+  the records delivered to Lambda.
+  """
+  _, partition, _, region, account_id, name = arn.split(':', 5)
+  domain = 'amazonaws.com.cn' if partition == 'aws-cn' else 'amazonaws.com'
+  return f'https://sqs.{region}.{domain}/{account_id}/{name}'
+
+
+def queue_arn_from_url(url):
+  """
+  Builds the ARN of a queue from its URL, the inverse of queue_url_from_arn.
+  """
+  host, *path = url.split('://', 1)[-1].split('/')
+  name = path[-1]
+  account_id = path[-2] if len(path) > 1 and path[-2].isdigit() else '000000000000'
+  # Local stand-ins such as ElasticMQ don't have the region in their host.
+  region = host.split('.')[1] if host.startswith('sqs.') else os.environ.get('AWS_REGION', 'us-east-1')
+  partition = 'aws-cn' if host.endswith('.cn') else 'aws'
+  return f'arn:{partition}:sqs:{region}:{account_id}:{name}'
+
+
+class Queue:
+  def __init__(self, sqs_client, queue_url):
+    """
+    :param sqs_client: A Boto3 SQS client.
+    :param queue_url: The URL of the queue messages are sent to.
+    """
+    self.sqs_client = sqs_client
+    self.queue_url = queue_url
+
+  def send_messages(self, entries):
+    """
+    Sends messages with SendMessageBatch, at most 10 entries and 256 KiB per
+    request.
+    :param entries: A list of SendMessageBatch entries. Each one must have a
+                    unique Id within the list.
+    :return: A dict that maps every entry Id to a (sent, message) tuple.
+    """
+    results = {}
+    for chunk in self.chunk_entries(entries):
+      results.update(self._send_batch(chunk))
+    return results
+
+  def chunk_entries(self, entries):
+    chunk, chunk_size = [], 0
+    for entry in entries:
+      entry_size = self.entry_size(entry)
+      if chunk and (len(chunk) == MAX_BATCH_ENTRIES or chunk_size + entry_size > MAX_BATCH_BYTES):
+        yield chunk
+        chunk, chunk_size = [], 0
+      chunk.append(entry)
+      chunk_size += entry_size
+
+    if chunk:
+      yield chunk
+
+  @staticmethod
+  def entry_size(entry):
+    """
+    The size SQS counts for an entry: the body plus every attribute name,
+    type and value.
+    """
+    size = len(entry['MessageBody'].encode('utf-8'))
+    for name, attr in entry.get('MessageAttributes', {}).items():
+      size += len(name.encode('utf-8')) + len(attr['DataType'].encode('utf-8'))
+      size += len(attr.get('StringValue', '').encode('utf-8'))
+    return size
+
+  def _send_batch(self, entries):
+    try:
+      response = self.sqs_client.send_message_batch(QueueUrl=self.queue_url, Entries=entries)
+    except ClientError as err:
+      message = f"Couldn't send {len(entries)} messages to queue {self.queue_url}. Here's why: {err.response['Error']['Code']}: {err.response['Error']['Message']}"
+      logger.error(message)
+      return {entry['Id']: (False, message) for entry in entries}
+
+    results = {}
+    for success in response.get('Successful', []):
+      results[success['Id']] = (True, f'Message {success["MessageId"]} accepted!')
+    for failure in response.get('Failed', []):
+      results[failure['Id']] = (False, f"{failure['Code']}: {failure.get('Message', '')}")
+    return results
+
+  def change_visibility(self, entries):
+    """
+    Changes the visibility timeout of received messages, so they are
+    delivered again only after the given delay.
+    :param entries: A list of (receipt_handle, seconds) tuples.
+    :return: The number of messages whose visibility couldn't be changed.
+    """
+    failed = 0
+    for start in range(0, len(entries), MAX_BATCH_ENTRIES):
+      chunk = entries[start:start + MAX_BATCH_ENTRIES]
+      batch = [
+        {'Id': str(i), 'ReceiptHandle': receipt_handle, 'VisibilityTimeout': min(int(seconds), MAX_VISIBILITY_TIMEOUT)}
+        for i, (receipt_handle, seconds) in enumerate(chunk)
+      ]
+      try:
+        response = self.sqs_client.change_message_visibility_batch(QueueUrl=self.queue_url, Entries=batch)
+      except ClientError as err:
+        logger.error(f"Couldn't change the visibility of {len(batch)} messages of queue {self.queue_url}. Here's why: {err.response['Error']['Code']}: {err.response['Error']['Message']}")
+        failed += len(batch)
+      else:
+        failed += len(response.get('Failed', []))
+    return failed
+
+  def receive(self, max_messages=MAX_BATCH_ENTRIES, wait_seconds=20):
+    """
+    Long-polls the queue for messages, with their system and message
+    attributes.
+    :return: The list of messages received, empty when the poll timed out.
+    """
+    try:
+      response = self.sqs_client.receive_message(
+        QueueUrl=self.queue_url,
+        MaxNumberOfMessages=max(1, min(max_messages, MAX_BATCH_ENTRIES)),
+        WaitTimeSeconds=wait_seconds,
+        AttributeNames=['All'],
+        MessageAttributeNames=['All'],
+      )
+    except ClientError as err:
+      logger.error(f"Couldn't receive messages from queue {self.queue_url}. Here's why: {err.response['Error']['Code']}: {err.response['Error']['Message']}")
+      return []
+    return response.get('Messages', [])
+
+  def delete_messages(self, receipt_handles):
+    """
+    Deletes processed messages with DeleteMessageBatch, 10 per request.
+    :return: The number of messages that couldn't be deleted.
+    """
+    failed = 0
+    for start in range(0, len(receipt_handles), MAX_BATCH_ENTRIES):
+      batch = [
+        {'Id': str(i), 'ReceiptHandle': receipt_handle}
+        for i, receipt_handle in enumerate(receipt_handles[start:start + MAX_BATCH_ENTRIES])
+      ]
+      try:
+        response = self.sqs_client.delete_message_batch(QueueUrl=self.queue_url, Entries=batch)
+      except ClientError as err:
+        logger.error(f"Couldn't delete {len(batch)} messages of queue {self.queue_url}. Here's why: {err.response['Error']['Code']}: {err.response['Error']['Message']}")
+        failed += len(batch)
+      else:
+        failed += len(response.get('Failed', []))
+    return failed
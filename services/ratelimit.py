@@ -0,0 +1,145 @@
+import asyncio
+import logging
+import math
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+logger = logging.getLogger(__name__)
+
+MAX_WAIT = float(os.environ.get('RATE_LIMIT_MAX_WAIT', 2))
+THROTTLED_MESSAGE = 'Rate limit budget exhausted, the message will be retried later'
+DEFAULT_RATES = {
+  'sendgrid': 50,
+  'botmaker': 10,
+}
+
+
+class TokenBucket:
+  def __init__(self, rate, burst=None, min_rate=None):
+    """
+    A token bucket whose rate adapts to the provider: it is halved on every
+    429/503 answer and grows back slowly on successful sends.
+    :param rate: The maximum number of requests per second.
+    :param burst: The number of tokens the bucket holds. Defaults to one
+                  second worth of tokens.
+    :param min_rate: The rate the bucket never slows down below. Defaults to
+                     a tenth of the maximum rate.
+    """
+    self.max_rate = float(rate)
+    self.rate = float(rate)
+    self.burst = burst or max(1.0, self.max_rate)
+    self.min_rate = min_rate or self.max_rate / 10
+    self._tokens = self.burst
+    self._updated = time.monotonic()
+    self._blocked_until = 0.0
+    self._lock = threading.Lock()
+
+  def _refill(self, now):
+    self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+    self._updated = now
+
+  def reserve(self, max_wait):
+    """
+    Takes a token, possibly one that will only be available in the future.
+    :param max_wait: The longest wait, in seconds, the caller accepts.
+    :return: The seconds to wait before sending, or None when no token is
+             available within max_wait. In that case nothing is taken.
+    """
+    with self._lock:
+      now = time.monotonic()
+      self._refill(now)
+      wait = max(0.0, self._blocked_until - now)
+      if self._tokens < 1:
+        wait = max(wait, (1 - self._tokens) / self.rate)
+      if wait > max_wait:
+        return None
+      self._tokens -= 1
+      return wait
+
+  def acquire(self, max_wait=MAX_WAIT):
+    """
+    Blocks until a token is available.
+    :return: False when no token is available within max_wait.
+    """
+    wait = self.reserve(max_wait)
+    if wait is None:
+      return False
+    if wait > 0:
+      time.sleep(wait)
+    return True
+
+  async def acquire_async(self, max_wait=MAX_WAIT):
+    wait = self.reserve(max_wait)
+    if wait is None:
+      return False
+    if wait > 0:
+      await asyncio.sleep(wait)
+    return True
+
+  def delay(self):
+    """
+    :return: The whole number of seconds until a token is available, at least 1.
+    """
+    with self._lock:
+      now = time.monotonic()
+      self._refill(now)
+      wait = max(self._blocked_until - now, (1 - self._tokens) / self.rate, 0)
+    return max(1, math.ceil(wait))
+
+  def observe(self, status_code, retry_after=None):
+    """
+    Adapts the rate to a provider answer.
+    :param status_code: The HTTP status code returned by the provider.
+    :param retry_after: The value of the Retry-After header, if any.
+    """
+    with self._lock:
+      if status_code in (429, 503):
+        self.rate = max(self.min_rate, self.rate / 2)
+        seconds = parse_retry_after(retry_after)
+        if seconds:
+          self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+        logger.warning(f'Rate limited with {status_code}, slowing down to {self.rate:.2f} requests per second')
+      elif isinstance(status_code, int) and 200 <= status_code < 300 and self.rate < self.max_rate:
+        self.rate = min(self.max_rate, self.rate + self.max_rate * 0.05)
+
+
+def parse_retry_after(value):
+  """
+  Reads a Retry-After header, given in seconds or as an HTTP date.
+  :return: The number of seconds to wait, or None.
+  """
+  if not value:
+    return None
+  try:
+    return max(0.0, float(value))
+  except ValueError:
+    pass
+  try:
+    retry_at = parsedate_to_datetime(value)
+  except (TypeError, ValueError):
+    return None
+  if retry_at.tzinfo is None:
+    retry_at = retry_at.replace(tzinfo=timezone.utc)
+  return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+_limiters = {}
+_lock = threading.Lock()
+
+
+def get_limiter(name):
+  """
+  Gets the token bucket shared by every client of a provider in this
+  container. Its rate is read from <NAME>_RATE_LIMIT, in requests per second;
+  0 disables the limiter.
+  :param name: The provider name, such as "sendgrid" or "botmaker".
+  :return: A TokenBucket, or None when the provider is not rate limited.
+  """
+  with _lock:
+    if name not in _limiters:
+      rate = float(os.environ.get(f'{name.upper()}_RATE_LIMIT', DEFAULT_RATES.get(name, 0)))
+      _limiters[name] = TokenBucket(rate) if rate > 0 else None
+    return _limiters[name]
@@ -0,0 +1,168 @@
+import logging
+import math
+import os
+import uuid
+from datetime import datetime, timedelta, timezone
+from boto3.dynamodb.conditions import Key
+from services import codec
+from services.tables import MAX_BATCH_WRITES, TableStore, write_batch
+
+logger = logging.getLogger(__name__)
+
+# SQS delays a message at most 15 minutes. Later sends wait in the schedule
+# table until the sweeper releases them.
+MAX_DELAY_SECONDS = 900
+MAX_SCHEDULE_DAYS = int(os.environ.get('SCHEDULE_MAX_DAYS', 365))
+
+# Jobs are stored in one partition per minute, so the sweeper reads only the
+# partitions that are due.
+BUCKET_FORMAT = '%Y-%m-%dT%H:%M'
+BUCKET_SECONDS = 60
+
+CURSOR_KEY = {'bucket': 'cursor', 'job_id': 'cursor'}
+
+
+def utcnow():
+  return datetime.now(timezone.utc)
+
+
+def parse_send_at(value, now=None):
+  """
+  Parses a send_at parameter, either epoch seconds or an ISO 8601 datetime.
+  A datetime without an offset is taken as UTC.
+  :return: The aware UTC datetime. Raises ValueError when the value can't be
+           parsed or is too far ahead.
+  """
+  now = now or utcnow()
+  try:
+    if value.isdigit():
+      send_at = datetime.fromtimestamp(int(value), timezone.utc)
+    else:
+      send_at = datetime.fromisoformat(value.replace('Z', '+00:00'))
+  except (ValueError, OverflowError):
+    raise ValueError(f'send_at must be epoch seconds or an ISO 8601 datetime, got {value}')
+
+  if send_at.tzinfo is None:
+    send_at = send_at.replace(tzinfo=timezone.utc)
+  send_at = send_at.astimezone(timezone.utc)
+  if send_at - now > timedelta(days=MAX_SCHEDULE_DAYS):
+    raise ValueError(f"send_at can't be more than {MAX_SCHEDULE_DAYS} days ahead")
+  return send_at
+
+
+def delay_seconds(send_at, now=None):
+  """
+  :return: The seconds until send_at, rounded up and never negative.
+  """
+  return max(0, math.ceil((send_at - (now or utcnow())).total_seconds()))
+
+
+def bucket_of(dt):
+  return dt.strftime(BUCKET_FORMAT)
+
+
+def buckets_between(after, until):
+  """
+  :return: The buckets after the bucket "after", up to the one holding
+           "until", oldest first.
+  """
+  current = datetime.strptime(after, BUCKET_FORMAT).replace(tzinfo=timezone.utc) + timedelta(seconds=BUCKET_SECONDS)
+  while current <= until:
+    yield bucket_of(current)
+    current += timedelta(seconds=BUCKET_SECONDS)
+
+
+class Schedule(TableStore):
+  def __init__(self, dyn_resource):
+    """
+    Stores messages to be enqueued at a later time, in one partition per
+    minute of their send time.
+    :param dyn_resource: A Boto3 DynamoDB resource.
+    """
+    super(Schedule, self).__init__(dyn_resource)
+
+  def add_jobs(self, send_at, messages, lane):
+    """
+    Stores messages to be enqueued at send_at.
+    :param send_at: The aware datetime the messages are due.
+    :param messages: A list of (message_body, message_attributes) tuples, in
+                     the format of SendMessage.
+    :param lane: The lane whose queue the messages are released to.
+    :return: The job ids of the stored messages, None for the ones that
+             could not be stored.
+    """
+    bucket = bucket_of(send_at)
+    timestamp = int(send_at.timestamp())
+    job_ids = [f'{send_at.strftime("%Y-%m-%dT%H:%M:%S")}#{uuid.uuid4()}' for _ in messages]
+    write_requests = [
+      {'PutRequest': {'Item': {
+        'bucket': bucket,
+        'job_id': job_id,
+        'send_at': timestamp,
+        'lane': lane,
+        'message_body': message_body,
+        'message_attributes': codec.dumps(message_attributes),
+      }}}
+      for job_id, (message_body, message_attributes) in zip(job_ids, messages)
+    ]
+
+    for start in range(0, len(write_requests), MAX_BATCH_WRITES):
+      chunk = write_requests[start:start + MAX_BATCH_WRITES]
+      if write_batch(self.dyn_resource, self.table.name, chunk):
+        # The unprocessed requests aren't reported one by one, so the whole
+        # chunk is reported as not stored.
+        job_ids[start:start + MAX_BATCH_WRITES] = [None] * len(chunk)
+    return job_ids
+
+  def jobs(self, bucket):
+    """
+    Reads the jobs of one bucket, one page at a time.
+    :return: A generator of lists of job items.
+    """
+    params = {'KeyConditionExpression': Key('bucket').eq(bucket)}
+    while True:
+      response = self.table.query(**params)
+      yield response.get('Items', [])
+      if not response.get('LastEvaluatedKey'):
+        return
+      params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+  def remove(self, jobs):
+    """
+    Deletes released jobs.
+    :return: The number of jobs that could not be deleted.
+    """
+    keys = [{'DeleteRequest': {'Key': {'bucket': job['bucket'], 'job_id': job['job_id']}}} for job in jobs]
+    return sum(
+      write_batch(self.dyn_resource, self.table.name, keys[start:start + MAX_BATCH_WRITES])
+      for start in range(0, len(keys), MAX_BATCH_WRITES)
+    )
+
+  def cursor(self):
+    """
+    :return: The last bucket the sweeper released, or None before the first
+             sweep.
+    """
+    item = self.table.get_item(Key=CURSOR_KEY).get('Item')
+    return item['swept'] if item else None
+
+  def save_cursor(self, bucket):
+    self.table.put_item(Item=dict(CURSOR_KEY, swept=bucket))
+
+
+def release_entries(jobs, now=None):
+  """
+  :return: The SendMessageBatch entries of due jobs, delayed until their
+           send time when it is still ahead.
+  """
+  now = now or utcnow()
+  entries = []
+  for index, job in enumerate(jobs):
+    send_at = datetime.fromtimestamp(int(job['send_at']), timezone.utc)
+    entries.append({
+      'Id': str(index),
+      'MessageBody': job['message_body'],
+      'MessageAttributes': codec.loads(job['message_attributes']),
+      'DelaySeconds': min(delay_seconds(send_at, now), MAX_DELAY_SECONDS),
+    })
+  return entries
@@ -0,0 +1,128 @@
+import logging
+import threading
+import time
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger(__name__)
+
+
+class TableRegistry:
+  def __init__(self):
+    """
+    Keeps the DynamoDB table handles that were already validated with a
+    DescribeTable call, so warm invocations reuse them instead of loading the
+    tables again on every request.
+    """
+    self._tables = {}
+    self._lock = threading.Lock()
+
+  def resolve(self, dyn_resource, table_name):
+    """
+    Gets a validated handle for a table, loading it only the first time it is
+    requested in this container.
+    :param dyn_resource: A Boto3 DynamoDB resource.
+    :param table_name: The name of the table to resolve.
+    :return: The table handle. Raises ClientError when the table can't be loaded.
+    """
+    table = self._tables.get(table_name)
+    if table is not None:
+      return table
+
+    with self._lock:
+      table = self._tables.get(table_name)
+      if table is None:
+        table = dyn_resource.Table(table_name)
+        table.load()
+        self._tables[table_name] = table
+        logger.debug(f'Table {table_name} resolved')
+
+    return table
+
+  def invalidate(self, table_name):
+    """
+    Forgets a table handle so the next resolve checks the table again.
+    :param table_name: The name of the table to forget.
+    """
+    with self._lock:
+      self._tables.pop(table_name, None)
+
+  def discard_if_missing(self, err, table_name):
+    """
+    Invalidates a table handle when a data-plane call reports that the table
+    no longer exists.
+    :param err: The ClientError raised by the call.
+    :param table_name: The name of the table that was called.
+    """
+    if err.response['Error']['Code'] == 'ResourceNotFoundException':
+      logger.warning(f'Table {table_name} was not found, it will be checked again')
+      self.invalidate(table_name)
+
+
+# BatchWriteItem accepts at most 25 requests.
+MAX_BATCH_WRITES = 25
+
+
+def write_batch(dyn_resource, table_name, write_requests, max_retries=5):
+  """
+  Sends up to 25 put or delete requests with BatchWriteItem, retrying the
+  unprocessed ones with exponential backoff.
+  :param dyn_resource: A Boto3 DynamoDB resource.
+  :param table_name: The name of the table written to.
+  :param write_requests: The PutRequest/DeleteRequest dicts.
+  :param max_retries: How many times unprocessed requests are retried.
+  :return: The number of requests that could not be written.
+  """
+  for attempt in range(max_retries + 1):
+    if attempt:
+      time.sleep(min(0.05 * (2 ** (attempt - 1)), 1.0))
+
+    try:
+      response = dyn_resource.batch_write_item(RequestItems={table_name: write_requests})
+    except ClientError as err:
+      registry.discard_if_missing(err, table_name)
+      logger.error(f"Couldn't write {len(write_requests)} items to table {table_name}. Here's why: {err.response['Error']['Code']}: {err.response['Error']['Message']}")
+      return len(write_requests)
+
+    write_requests = response.get('UnprocessedItems', {}).get(table_name, [])
+    if not write_requests:
+      return 0
+
+  return len(write_requests)
+
+
+registry = TableRegistry()
+
+
+class TableStore:
+  def __init__(self, dyn_resource):
+    """
+    Base of the classes that keep their items in one DynamoDB table.
+    :param dyn_resource: A Boto3 DynamoDB resource.
+    """
+    self.dyn_resource = dyn_resource
+    self.table = None
+
+  def exists(self, table_name):
+    """
+    Determines whether a table exists. As a side effect, stores the table in
+    a member variable. The check is done once per container; later calls reuse
+    the handle kept by the table registry.
+    :param table_name: The name of the table to check.
+    :return: True when the table exists; otherwise, False.
+    """
+    try:
+      table = registry.resolve(self.dyn_resource, table_name)
+      exists = True
+    except ClientError as err:
+      if err.response['Error']['Code'] == 'ResourceNotFoundException':
+        exists = False
+      else:
+        logger.error(
+          "Couldn't check for existence of %s. Here's why: %s: %s",
+          table_name,
+          err.response['Error']['Code'], err.response['Error']['Message']
+        )
+        raise
+    else:
+      self.table = table
+    return exists
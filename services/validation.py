@@ -0,0 +1,134 @@
+import os
+from services.cache import TTLCache
+from services.lanes import LANES
+
+VALID_MESSAGE = 'Notification body is valid'
+
+# Validators compiled per notification version. A new version gets a new key,
+# so updates never reuse a stale validator.
+validators = TTLCache(
+  max_size=int(os.environ.get('VALIDATOR_CACHE_SIZE', 256)),
+  ttl=float(os.environ.get('VALIDATOR_CACHE_TTL', 3600))
+)
+
+
+class BodyValidator:
+  __slots__ = ('send_email', 'send_whatsapp', 'email_fields', 'whatsapp_fields', '_email_order', '_whatsapp_order')
+
+  def __init__(self, notification):
+    """
+    Checks message bodies against one notification definition. The required
+    fields are kept in frozensets, so a body is checked with one set
+    difference per channel.
+    :param notification: The notification definition.
+    """
+    self.send_email = bool(notification.get("send_email"))
+    self.send_whatsapp = bool(notification.get("send_whatsapp"))
+    self._email_order = tuple(notification.get("email_fields") or ()) if self.send_email else ()
+    self._whatsapp_order = tuple(notification.get("whatsapp_fields") or ()) if self.send_whatsapp else ()
+    self.email_fields = frozenset(self._email_order)
+    self.whatsapp_fields = frozenset(self._whatsapp_order)
+
+  def validate(self, body):
+    """
+    :return: A tuple with a success flag and a message listing every problem
+             found in the body.
+    """
+    errors = self.errors(body)
+    if errors:
+      return False, '; '.join(errors)
+    return True, VALID_MESSAGE
+
+  def errors(self, body):
+    """
+    :return: The list of problems found in a body, empty when it is valid.
+    """
+    if not isinstance(body, dict):
+      return ["Notification body must be an object"]
+
+    errors = []
+    if self.send_email:
+      self._check_channel(body, errors, "email", "Email", self.email_fields, self._email_order, "email_fields", "Email")
+    if self.send_whatsapp:
+      self._check_channel(body, errors, "cellphone", "Cellphone", self.whatsapp_fields, self._whatsapp_order, "whatsapp_fields", "Whatsapp")
+    return errors
+
+  @staticmethod
+  def _check_channel(body, errors, address_key, address_name, required, order, fields_key, fields_name):
+    address = body.get(address_key)
+    if address is None:
+      errors.append(f"{address_name} was not found in body")
+    elif not isinstance(address, str) or not address:
+      errors.append(f"{address_name} must be a non-empty string")
+
+    if not required:
+      return
+
+    fields = body.get(fields_key)
+    if fields is None:
+      fields = {}
+    elif not isinstance(fields, dict):
+      errors.append(f"{fields_name} fields must be an object")
+      return
+
+    missing = required.difference(fields.keys())
+    if missing:
+      names = ', '.join(field for field in order if field in missing)
+      errors.append(f"{fields_name} field {names} was not found" if len(missing) == 1 else f"{fields_name} fields {names} were not found")
+
+
+def validator_for(notification):
+  """
+  :return: The compiled validator of a notification, from the cache when the
+           same version was compiled before.
+  """
+  key = (notification.get("notification_id"), notification.get("updated_at"))
+  validator = validators.get(key)
+  if validator is None:
+    validator = BodyValidator(notification)
+    validators.set(key, validator)
+  return validator
+
+
+def definition_errors(body):
+  """
+  :return: The list of problems found in a notification definition, empty
+           when it is valid.
+  """
+  if not isinstance(body, dict):
+    return ["Notification must be an object"]
+
+  errors = []
+  if "title" not in body:
+    errors.append("No title was provided")
+  elif not isinstance(body["title"], str):
+    errors.append("Title must be a string")
+
+  if "send_email" not in body or "send_whatsapp" not in body:
+    errors.append("Please, toggle the send_email or whatsapp")
+    return errors
+
+  if body.get("priority") is not None and body["priority"] not in LANES:
+    errors.append(f"priority must be one of {', '.join(LANES)}")
+
+  for toggle in ("send_email", "send_whatsapp"):
+    if not isinstance(body[toggle], bool):
+      errors.append(f"{toggle} must be a boolean")
+
+  if body["send_email"]:
+    _check_definition_channel(body, errors, "email_id", "No email template id was provided", "email_fields", "No email fields were provided")
+  if body["send_whatsapp"]:
+    _check_definition_channel(body, errors, "template_name", "No template name was provided", "whatsapp_fields", "No whatsapp fields were provided")
+  return errors
+
+
+def _check_definition_channel(body, errors, template_key, template_error, fields_key, fields_error):
+  template = body.get(template_key)
+  if not isinstance(template, str) or not template:
+    errors.append(template_error)
+
+  fields = body.get(fields_key)
+  if not isinstance(fields, list) or not fields:
+    errors.append(fields_error)
+  elif not all(isinstance(field, str) for field in fields):
+    errors.append(f"{fields_key} must be a list of strings")
@@ -1,47 +1,129 @@
+import asyncio
 import os
 import requests
 import logging
 from dotenv import load_dotenv
+from services.breaker import get_breaker, OPEN_MESSAGE, OPEN_STATUS
+from services.http import get_async_session, get_session, TIMEOUT
+from services.ratelimit import get_limiter, THROTTLED_MESSAGE
 
-load_dotenv()
 logger = logging.getLogger(__name__)
 IS_OFFLINE = os.environ.get('IS_OFFLINE')
+BOTMAKER_URL = 'https://go.botmaker.com/api/v1.0/intent/v2'
 
 class Botmaker(object):
   def __init__(self):
     super(Botmaker, self).__init__()
+    load_dotenv()
     api_key = os.environ.get('BOTMAKER_API_KEY', None)
     self._token = api_key
+    self._session = self.new_session()
+    self._limiter = get_limiter('botmaker')
+    self._breaker = get_breaker('botmaker')
 
     if IS_OFFLINE:
       logger.setLevel(logging.DEBUG)
 
-  def send_message(self, body):
-    headers = {
+  def new_session(self):
+    return get_session('botmaker')
+
+  def headers(self):
+    return {
       'Accept': 'application/json',
       'access-token': f'{self._token}'
     }
 
+  def observe(self, status_code, headers):
+    if self._limiter is not None:
+      self._limiter.observe(status_code, headers.get('Retry-After'))
+
+  def send_message(self, body):
+    if self._breaker is None:
+      return self.post(body)
+    if not self._breaker.allow():
+      logger.warning(f'Botmaker API error: {OPEN_STATUS}. Here is the error message: {OPEN_MESSAGE}')
+      return OPEN_STATUS, OPEN_MESSAGE
+
+    status_code, message = self.post(body)
+    self._breaker.record(status_code)
+    return status_code, message
+
+  def post(self, body):
     if self._token:
-      response = requests.post('https://go.botmaker.com/api/v1.0/intent/v2', headers=headers, json=body)
+      if self._limiter is not None and not self._limiter.acquire():
+        logger.warning(f'Botmaker API error: {429}. Here is the error message: {THROTTLED_MESSAGE}')
+        return 429, THROTTLED_MESSAGE
 
       try:
+        response = self._session.post(BOTMAKER_URL, headers=self.headers(), json=body, timeout=TIMEOUT)
+        self.observe(response.status_code, response.headers)
         response.raise_for_status()
       except requests.exceptions.Timeout:
-        logger.error(f'Botmaker API error: {response.status_code}. Here is the error message: Timeout Error ocurred, program waits and retries again')
-        return response.status_code, "Timeout Error ocurred, program waits and retries again"
+        logger.error(f'Botmaker API error: {504}. Here is the error message: Timeout Error ocurred, program waits and retries again')
+        return 504, "Timeout Error ocurred, program waits and retries again"
       except requests.exceptions.TooManyRedirects:
-        logger.error(f'Botmaker API error: {response.status_code}. Here is the error message: Too many redirects')
-        return response.status_code, "Too many redirects"
+        logger.error(f'Botmaker API error: {502}. Here is the error message: Too many redirects')
+        return 502, "Too many redirects"
       except requests.exceptions.HTTPError as e:
         logger.error(f'Botmaker API error: {response.status_code}. Here is the error message: {str(response.reason)}')
         return response.status_code, str(response.reason)
       except requests.exceptions.RequestException as e:
-        logger.error(f'Botmaker API error: {response.status_code}. Here is the error message: {str(response.reason)}')
-        return response.status_code, str(response.reason)
+        logger.error(f'Botmaker API error: {502}. Here is the error message: {str(e)}')
+        return 502, str(e)
 
       logger.info(f'Message {body["ruleNameOrId"]} sent to {body["platformContactId"]}')
       return response.status_code, f'Message {body["ruleNameOrId"]} sent to {body["platformContactId"]}'
 
     logger.error(f'Botmaker API error: {403}. Here is the error message: No API Key was provided')
     return 403, str("No API Key was provided")
+
+
+class AsyncBotmaker(Botmaker):
+  """
+  Botmaker client whose sends are coroutines running on the aiohttp session
+  of the current event loop.
+  """
+
+  def new_session(self):
+    # Sends go through get_async_session, the requests session is never used.
+    return None
+
+  async def send_message(self, body):
+    if self._breaker is None:
+      return await self.post(body)
+    if not self._breaker.allow():
+      logger.warning(f'Botmaker API error: {OPEN_STATUS}. Here is the error message: {OPEN_MESSAGE}')
+      return OPEN_STATUS, OPEN_MESSAGE
+
+    status_code, message = await self.post(body)
+    self._breaker.record(status_code)
+    return status_code, message
+
+  async def post(self, body):
+    import aiohttp
+
+    if self._token:
+      if self._limiter is not None and not await self._limiter.acquire_async():
+        logger.warning(f'Botmaker API error: {429}. Here is the error message: {THROTTLED_MESSAGE}')
+        return 429, THROTTLED_MESSAGE
+
+      session = get_async_session('botmaker')
+      try:
+        async with session.post(BOTMAKER_URL, headers=self.headers(), json=body) as response:
+          self.observe(response.status, response.headers)
+          if response.status >= 400:
+            logger.error(f'Botmaker API error: {response.status}. Here is the error message: {str(response.reason)}')
+            return response.status, str(response.reason)
+          status_code = response.status
+      except asyncio.TimeoutError:
+        logger.error(f'Botmaker API error: {504}. Here is the error message: Timeout Error ocurred, program waits and retries again')
+        return 504, "Timeout Error ocurred, program waits and retries again"
+      except aiohttp.ClientError as e:
+        logger.error(f'Botmaker API error: {502}. Here is the error message: {str(e)}')
+        return 502, str(e)
+
+      logger.info(f'Message {body["ruleNameOrId"]} sent to {body["platformContactId"]}')
+      return status_code, f'Message {body["ruleNameOrId"]} sent to {body["platformContactId"]}'
+
+    logger.error(f'Botmaker API error: {403}. Here is the error message: No API Key was provided')
+    return 403, str("No API Key was provided")
@@ -0,0 +1,32 @@
+import os
+import sys
+
+import pytest
+
+# The services package is imported from the root of the repository.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class FakeClock:
+  def __init__(self):
+    """
+    Stands in for the time module of a service, so a test moves time forward
+    instead of sleeping.
+    """
+    self.now = 1000.0
+    self.slept = []
+
+  def monotonic(self):
+    return self.now
+
+  def sleep(self, seconds):
+    self.slept.append(seconds)
+    self.now += seconds
+
+  def advance(self, seconds):
+    self.now += seconds
+
+
+@pytest.fixture
+def clock():
+  return FakeClock()
@@ -0,0 +1,98 @@
+import pytest
+
+from services import breaker
+from services.breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker
+
+
+@pytest.fixture
+def circuit(clock, monkeypatch):
+  monkeypatch.setattr(breaker, 'time', clock)
+  return CircuitBreaker('provider', failure_rate=0.5, min_requests=4, window=30, cooldown=10, probes=2)
+
+
+def send(circuit, status_code):
+  assert circuit.allow()
+  circuit.record(status_code)
+
+
+def test_opens_once_enough_requests_failed(circuit):
+  for status_code in (200, 500, 200):
+    send(circuit, status_code)
+  assert circuit.state == CLOSED
+
+  send(circuit, 504)
+  assert circuit.state == OPEN
+  assert not circuit.allow()
+
+
+def test_needs_min_requests(circuit):
+  for _ in range(3):
+    send(circuit, 500)
+  assert circuit.state == CLOSED
+
+
+@pytest.mark.parametrize('status_code', [400, 404, 429])
+def test_client_errors_and_throttling_are_not_failures(circuit, status_code):
+  for _ in range(10):
+    send(circuit, status_code)
+  assert circuit.state == CLOSED
+
+
+def test_old_outcomes_leave_the_window(circuit, clock):
+  for _ in range(3):
+    send(circuit, 500)
+  clock.advance(31)
+
+  send(circuit, 500)
+  assert circuit.state == CLOSED
+
+
+def test_half_opens_after_the_cooldown_and_closes_on_good_probes(circuit, clock):
+  for _ in range(4):
+    send(circuit, 500)
+  assert circuit.delay() == 10
+
+  clock.advance(4)
+  assert not circuit.allow()
+  assert circuit.delay() == 6
+
+  clock.advance(6)
+  assert circuit.allow()
+  assert circuit.state == HALF_OPEN
+  assert circuit.allow()
+  assert not circuit.allow()
+
+  circuit.record(200)
+  assert circuit.state == HALF_OPEN
+  circuit.record(202)
+  assert circuit.state == CLOSED
+  assert circuit.allow()
+
+
+def test_failed_probe_opens_again(circuit, clock):
+  for _ in range(4):
+    send(circuit, 500)
+  clock.advance(10)
+
+  send(circuit, 503)
+  assert circuit.state == OPEN
+  assert circuit.delay() == 10
+
+
+def test_throttled_probe_is_given_back(circuit, clock):
+  for _ in range(4):
+    send(circuit, 500)
+  clock.advance(10)
+
+  send(circuit, 429)
+  assert circuit.state == HALF_OPEN
+  send(circuit, 200)
+  send(circuit, 200)
+  assert circuit.state == CLOSED
+
+
+def test_timeouts_and_connection_errors_are_failures():
+  assert breaker.is_failure(500)
+  assert breaker.is_failure(None)
+  assert not breaker.is_failure(200)
+  assert not breaker.is_failure(429)
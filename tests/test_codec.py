@@ -0,0 +1,90 @@
+import importlib.util
+import os
+import uuid
+from dataclasses import dataclass
+from datetime import date, datetime, time, timedelta, timezone
+from decimal import Decimal
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_codec(backend):
+  """
+  Loads a separate copy of services.codec with JSON_CODEC set to backend.
+  :return: The module, or None when the backend isn't available.
+  """
+  previous = os.environ.get('JSON_CODEC')
+  os.environ['JSON_CODEC'] = backend
+  try:
+    spec = importlib.util.spec_from_file_location(f'codec_{backend}', os.path.join(ROOT, 'services', 'codec.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+  finally:
+    if previous is None:
+      os.environ.pop('JSON_CODEC', None)
+    else:
+      os.environ['JSON_CODEC'] = previous
+  return module if module.BACKEND == backend else None
+
+
+stdlib = load_codec('stdlib')
+orjson = load_codec('orjson')
+
+requires_orjson = pytest.mark.skipif(orjson is None, reason='orjson is not installed')
+
+
+@dataclass
+class Point:
+  x: int
+  y: int
+
+
+PAYLOADS = {
+  'message': {'email': 'user@example.com', 'email_fields': {'name': 'Usuário', 'emoji': '✉️'}},
+  'datetime': {'at': datetime(2022, 9, 1, 13, 0, 0, 123456, tzinfo=timezone.utc)},
+  'naive datetime': {'at': datetime(2022, 9, 1, 13, 0)},
+  'offset datetime': {'at': datetime(2022, 9, 1, 13, 0, tzinfo=timezone(timedelta(hours=-3)))},
+  'date': {'day': date(2022, 9, 1)},
+  'time': {'at': time(13, 0, 5)},
+  'uuid': {'id': uuid.UUID('8f14e45f-ceea-467f-a0e6-1b2b6bb3a3c1')},
+  'decimal': {'count': Decimal('3'), 'ratio': Decimal('0.25')},
+  'big decimal': {'count': Decimal('12345678901234567890123456789012345678')},
+  'big int': {'count': 2 ** 70, 'negative': -(2 ** 64)},
+  'sets': {'tags': {'b', 'a', 'c'}, 'numbers': frozenset({Decimal('2'), Decimal('1')})},
+  'int keys': {1: 'one', 2: 'two'},
+  'nested': [{'b': 1, 'a': [Decimal('1.5'), None, True]}, 'text'],
+}
+
+
+@requires_orjson
+@pytest.mark.parametrize('payload', PAYLOADS.values(), ids=list(PAYLOADS))
+@pytest.mark.parametrize('sort_keys', [False, True])
+def test_backends_write_the_same_text(payload, sort_keys):
+  assert orjson.dumps(payload, sort_keys) == stdlib.dumps(payload, sort_keys)
+
+
+# orjson reads integers beyond 64 bits back as floats.
+WITHIN_64_BITS = {name: payload for name, payload in PAYLOADS.items() if name not in ('big decimal', 'big int')}
+
+
+@requires_orjson
+@pytest.mark.parametrize('payload', WITHIN_64_BITS.values(), ids=list(WITHIN_64_BITS))
+def test_backends_read_back_the_same_value(payload):
+  text = stdlib.dumps(payload)
+  assert orjson.loads(text) == stdlib.loads(text)
+  assert orjson.loads(text.encode('utf-8')) == stdlib.loads(text.encode('utf-8'))
+
+
+@pytest.mark.parametrize('codec', [stdlib, pytest.param(orjson, marks=requires_orjson)], ids=['stdlib', 'orjson'])
+@pytest.mark.parametrize('value', [object(), Point(1, 2), b'bytes'], ids=['object', 'dataclass', 'bytes'])
+def test_backends_reject_the_same_types(codec, value):
+  with pytest.raises(TypeError):
+    codec.dumps({'value': value})
+
+
+@pytest.mark.parametrize('codec', [stdlib, pytest.param(orjson, marks=requires_orjson)], ids=['stdlib', 'orjson'])
+def test_invalid_json_raises_decode_error(codec):
+  with pytest.raises(codec.DecodeError):
+    codec.loads('{"email": ')
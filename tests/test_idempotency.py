@@ -0,0 +1,145 @@
+import time
+
+import pytest
+from botocore.exceptions import ClientError
+
+from benchmarks.fakes import FakeDynamoResource
+from services import idempotency
+from services.idempotency import BUSY, CLAIMED, DONE, SENDING, DeliveryStore, delivery_key
+from services.tables import registry
+
+TABLE = 'delivery-table-test'
+
+
+@pytest.fixture(autouse=True)
+def clear_delivered():
+  idempotency.delivered.clear()
+  yield
+  idempotency.delivered.clear()
+
+
+@pytest.fixture
+def resource():
+  resource = FakeDynamoResource()
+  resource.create_table(TABLE, ['delivery_id'])
+  yield resource
+  registry.invalidate(TABLE)
+
+
+@pytest.fixture
+def store(resource):
+  store = DeliveryStore(resource)
+  assert store.exists(TABLE)
+  return store
+
+
+def test_claim_writes_a_sending_item(store, resource):
+  states = store.claim([('m1', 'email'), ('m1', 'whatsapp')])
+
+  assert states == {'m1#email': CLAIMED, 'm1#whatsapp': CLAIMED}
+  item = resource.Table(TABLE).read({'delivery_id': 'm1#email'})
+  assert item['state'] == SENDING
+  assert item['expires_at'] > time.time()
+
+
+def test_claim_of_a_running_delivery_is_busy(store):
+  store.claim([('m1', 'email')])
+
+  assert store.claim([('m1', 'email'), ('m2', 'email')]) == {'m1#email': BUSY, 'm2#email': CLAIMED}
+
+
+def test_expired_claim_is_claimed_again(store, resource):
+  resource.Table(TABLE).write({'delivery_id': 'm1#email', 'state': SENDING, 'expires_at': int(time.time()) - 1})
+
+  assert store.claim([('m1', 'email')]) == {'m1#email': CLAIMED}
+
+
+def test_finished_delivery_is_done(store, resource):
+  store.claim([('m1', 'email'), ('m1', 'whatsapp')])
+  assert store.finish([('m1', 'email')], [('m1', 'whatsapp')]) == 0
+
+  assert resource.Table(TABLE).read({'delivery_id': 'm1#email'})['state'] == DONE
+  assert resource.Table(TABLE).read({'delivery_id': 'm1#whatsapp'}) is None
+
+  # A redelivery finds the done delivery in the table, not only in memory.
+  idempotency.delivered.clear()
+  assert store.claim([('m1', 'email'), ('m1', 'whatsapp')]) == {'m1#email': DONE, 'm1#whatsapp': CLAIMED}
+
+
+def test_item_without_state_is_done(store, resource):
+  resource.Table(TABLE).write({'delivery_id': 'm1#email', 'expires_at': int(time.time()) + 3600})
+
+  assert store.claim([('m1', 'email')]) == {'m1#email': DONE}
+  assert idempotency.delivered.get('m1#email')
+
+
+def test_delivered_in_memory_costs_no_write(store, resource):
+  idempotency.delivered.set(delivery_key('m1', 'email'), True)
+  resource.counter.reset()
+
+  assert store.claim([('m1', 'email')]) == {'m1#email': DONE}
+  assert resource.counter.total() == 0
+
+
+def test_duplicate_deliveries_are_claimed_once(store, resource):
+  resource.counter.reset()
+
+  assert store.claim([('m1', 'email'), ('m1', 'email')]) == {'m1#email': CLAIMED}
+  assert resource.counter.calls['dynamodb.TransactWriteItems'] == 1
+
+
+def cancelled(*codes):
+  return ClientError({
+    'Error': {'Code': 'TransactionCanceledException', 'Message': 'Transaction cancelled'},
+    'CancellationReasons': [{'Code': code} for code in codes],
+  }, 'TransactWriteItems')
+
+
+class ScriptedClient:
+  def __init__(self, *outcomes):
+    """
+    A low-level client whose transact_write_items raises the given errors in
+    turn, then succeeds.
+    """
+    self.outcomes = list(outcomes)
+    self.calls = []
+
+  def transact_write_items(self, TransactItems):
+    self.calls.append([item['Put']['Item']['delivery_id']['S'] for item in TransactItems])
+    if self.outcomes:
+      raise self.outcomes.pop(0)
+    return {}
+
+
+@pytest.fixture
+def scripted(store, monkeypatch):
+  monkeypatch.setattr(idempotency.time, 'sleep', lambda seconds: None)
+
+  def install(*outcomes):
+    client = ScriptedClient(*outcomes)
+    monkeypatch.setattr(store.dyn_resource, 'meta', type('Meta', (), {'client': client}))
+    return client
+  return install
+
+
+def test_transaction_conflict_is_busy_and_the_rest_is_retried(store, scripted):
+  client = scripted(cancelled('TransactionConflict', 'None'))
+
+  assert store.claim([('m1', 'email'), ('m2', 'email')]) == {'m1#email': BUSY, 'm2#email': CLAIMED}
+  assert client.calls == [['m1#email', 'm2#email'], ['m2#email']]
+
+
+def test_throttled_claim_is_retried(store, scripted):
+  throttled = ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'Slow down'}}, 'TransactWriteItems')
+  client = scripted(throttled, throttled)
+
+  assert store.claim([('m1', 'email')]) == {'m1#email': CLAIMED}
+  assert len(client.calls) == 3
+
+
+def test_unwritable_claim_is_sent_anyway(store, scripted):
+  error = ClientError({'Error': {'Code': 'ValidationException', 'Message': 'Bad request'}}, 'TransactWriteItems')
+  client = scripted(error)
+
+  assert store.claim([('m1', 'email')]) == {'m1#email': CLAIMED}
+  assert len(client.calls) == 1
@@ -0,0 +1,62 @@
+import pytest
+
+from services.lanes import BULK, HIGH, LaneScheduler, resolve_lane
+
+
+def picks(scheduler, count, skip=()):
+  return [scheduler.next_lane(skip) for _ in range(count)]
+
+
+def test_lanes_are_picked_by_weight():
+  scheduler = LaneScheduler(capacity=10, weights={HIGH: 4, BULK: 1})
+
+  lanes = picks(scheduler, 10)
+  assert lanes.count(HIGH) == 8
+  assert lanes.count(BULK) == 2
+  # Smooth round robin spreads the bulk turns instead of bunching them.
+  assert lanes[:5].count(BULK) == 1
+
+
+def test_skipped_lane_is_not_picked():
+  scheduler = LaneScheduler(capacity=10, weights={HIGH: 4, BULK: 1})
+
+  assert picks(scheduler, 3, skip=(HIGH,)) == [BULK] * 3
+  assert scheduler.next_lane(skip=(HIGH, BULK)) is None
+
+
+def test_reserved_slots_are_kept_for_their_lane():
+  scheduler = LaneScheduler(capacity=10, weights={HIGH: 4, BULK: 1}, reserved={HIGH: 3})
+
+  scheduler.acquire(BULK, 7)
+  assert scheduler.available(BULK) == 0
+  assert scheduler.available(HIGH) == 3
+  assert picks(scheduler, 2) == [HIGH, HIGH]
+
+  scheduler.acquire(HIGH, 3)
+  assert scheduler.next_lane() is None
+
+  scheduler.release(BULK, 7)
+  assert scheduler.available(BULK) == 7
+  assert scheduler.available(HIGH) == 7
+
+
+def test_release_never_goes_below_zero():
+  scheduler = LaneScheduler(capacity=4, weights={HIGH: 1, BULK: 1})
+
+  scheduler.release(HIGH, 2)
+  assert scheduler.available(HIGH) == 4
+
+
+@pytest.mark.parametrize('requested, notification, default, lane', [
+  ('bulk', {'priority': 'high'}, HIGH, BULK),
+  (None, {'priority': 'bulk'}, HIGH, BULK),
+  (None, {}, BULK, BULK),
+  (None, {}, HIGH, HIGH),
+])
+def test_resolve_lane(requested, notification, default, lane):
+  assert resolve_lane(requested, notification, default) == lane
+
+
+def test_resolve_lane_rejects_unknown_priorities():
+  with pytest.raises(ValueError):
+    resolve_lane('urgent', {})
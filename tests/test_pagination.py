@@ -0,0 +1,41 @@
+import base64
+
+import pytest
+
+from services import codec
+from services.pagination import decode_cursor, encode_cursor
+
+
+def token(state):
+  return base64.urlsafe_b64encode(codec.dumps(state).encode('utf-8')).decode('ascii').rstrip('=')
+
+
+@pytest.mark.parametrize('state', [
+  {'key': {'notification_id': 'a1'}},
+  {'day': '2022-09-01', 'key': {'log_id': 'x', 'log_date': '2022-09-01', 'created_at': '2022-09-01T13:00:00'}},
+  {'day': '2022-09-01', 'key': None},
+])
+def test_cursor_round_trip(state):
+  assert decode_cursor(encode_cursor(state)) == state
+
+
+def test_no_cursor():
+  assert decode_cursor(None) is None
+  assert decode_cursor('') is None
+  assert encode_cursor(None) is None
+
+
+@pytest.mark.parametrize('cursor', [
+  'not base64!',
+  token([1, 2]),
+  token({'key': 'x'}),
+  token({'key': [1]}),
+  token({'key': {}}),
+  token({'key': {'log_id': 1.5}}),
+  token({'key': {'log_id': {'S': 'x'}}}),
+  token({'key': {'log_id': True}}),
+  token({'day': ['2022-09-01'], 'key': None}),
+])
+def test_malformed_cursor_raises_value_error(cursor):
+  with pytest.raises(ValueError):
+    decode_cursor(cursor)
@@ -0,0 +1,83 @@
+import pytest
+
+from services import ratelimit
+from services.ratelimit import TokenBucket, parse_retry_after
+
+
+@pytest.fixture
+def bucket(clock, monkeypatch):
+  monkeypatch.setattr(ratelimit, 'time', clock)
+  return TokenBucket(rate=10, burst=2)
+
+
+def test_burst_then_waits_for_the_refill(bucket, clock):
+  assert bucket.reserve(max_wait=0) == 0
+  assert bucket.reserve(max_wait=0) == 0
+  assert bucket.reserve(max_wait=0) is None
+
+  assert bucket.reserve(max_wait=1) == pytest.approx(0.1)
+
+
+def test_refills_at_its_rate_up_to_the_burst(bucket, clock):
+  bucket.reserve(0)
+  bucket.reserve(0)
+
+  clock.advance(0.1)
+  assert bucket.reserve(max_wait=0) == 0
+  assert bucket.reserve(max_wait=0) is None
+
+  clock.advance(60)
+  assert bucket.reserve(max_wait=0) == 0
+  assert bucket.reserve(max_wait=0) == 0
+  assert bucket.reserve(max_wait=0) is None
+
+
+def test_acquire_sleeps_within_max_wait(bucket, clock):
+  assert bucket.acquire(max_wait=1)
+  assert bucket.acquire(max_wait=1)
+  assert bucket.acquire(max_wait=1)
+  assert clock.slept == [pytest.approx(0.1)]
+
+
+def test_acquire_fails_past_max_wait_without_taking_a_token(bucket, clock):
+  bucket.reserve(0)
+  bucket.reserve(0)
+
+  assert not bucket.acquire(max_wait=0.05)
+  assert clock.slept == []
+  # The failed acquire left the next token where it was.
+  assert bucket.reserve(max_wait=1) == pytest.approx(0.1)
+
+
+def test_throttling_halves_the_rate_and_success_recovers_it(bucket):
+  bucket.observe(429)
+  assert bucket.rate == 5
+  bucket.observe(503)
+  assert bucket.rate == 2.5
+
+  for _ in range(100):
+    bucket.observe(200)
+  assert bucket.rate == 10
+
+
+def test_rate_never_drops_below_min_rate(bucket):
+  for _ in range(20):
+    bucket.observe(429)
+  assert bucket.rate == 1
+
+
+def test_retry_after_blocks_the_bucket(bucket, clock):
+  bucket.observe(429, '3')
+
+  assert bucket.reserve(max_wait=2) is None
+  assert bucket.reserve(max_wait=5) == pytest.approx(3)
+  assert bucket.delay() == 3
+
+
+@pytest.mark.parametrize('value, seconds', [(None, None), ('', None), ('2.5', 2.5), ('-1', 0.0), ('soon', None)])
+def test_parse_retry_after(value, seconds):
+  assert parse_retry_after(value) == seconds
+
+
+def test_parse_retry_after_date():
+  assert parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT') == 0.0
@@ -0,0 +1,259 @@
+"""
+Standalone SQS worker for running the consumer in a container.
+
+Long-polls the lane queues, runs handler.consumer on each received batch in a
+pool of processes, deletes the records it processed with DeleteMessageBatch,
+extends the visibility of batches that are still running, and stops
+gracefully on SIGTERM or SIGINT.
+
+  QUEUE_URL=... BULK_QUEUE_URL=... python worker.py --processes 4
+"""
+import argparse
+import logging
+import os
+import queue as queue_module
+import signal
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from services.lanes import HIGH, LaneScheduler, QUEUE_URLS, WEIGHTS
+from services.queue import MAX_BATCH_ENTRIES, Queue, queue_arn_from_url
+
+logger = logging.getLogger(__name__)
+
+PROCESSES = int(os.environ.get('WORKER_PROCESSES', os.cpu_count() or 1))
+WAIT_SECONDS = 20
+# A running batch is hidden for this many more seconds every heartbeat. The
+# heartbeat must be shorter than the queue's visibility timeout.
+VISIBILITY_TIMEOUT = int(os.environ.get('WORKER_VISIBILITY_TIMEOUT', 120))
+HEARTBEAT_SECONDS = int(os.environ.get('WORKER_HEARTBEAT_SECONDS', 20))
+SHUTDOWN_TIMEOUT = int(os.environ.get('WORKER_SHUTDOWN_TIMEOUT', 25))
+# Messages in flight kept for the high lane, so a bulk backlog can't take
+# every slot of the worker.
+HIGH_RESERVED = int(os.environ.get('WORKER_HIGH_RESERVED', MAX_BATCH_ENTRIES))
+
+
+def to_record(message, queue_url, queue_arn):
+  """
+  Converts a received message to the record format Lambda passes to the
+  consumer. The queue URL is kept so deferred records reach the right queue.
+  """
+  return {
+    'messageId': message['MessageId'],
+    'receiptHandle': message['ReceiptHandle'],
+    'body': message['Body'],
+    'attributes': message.get('Attributes', {}),
+    'messageAttributes': {
+      name: {'stringValue': attribute.get('StringValue'), 'dataType': attribute['DataType']}
+      for name, attribute in message.get('MessageAttributes', {}).items()
+    },
+    'eventSource': 'aws:sqs',
+    'eventSourceARN': queue_arn,
+    'queueUrl': queue_url,
+  }
+
+
+def process_batch(records):
+  """
+  Runs the consumer on a batch, in a worker process.
+  :return: The message ids of the records that failed.
+  """
+  import handler
+
+  response = handler.consumer({'Records': records}, None)
+  return [failure['itemIdentifier'] for failure in response['batchItemFailures']]
+
+
+def ignore_signals():
+  # Only the parent handles shutdown; the processes finish their batch.
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+
+class Batch:
+  def __init__(self, lane, records):
+    self.lane = lane
+    self.records = records
+    self.extended_at = time.monotonic()
+
+
+class Worker:
+  def __init__(self, sqs_client, queue_urls=None, processes=PROCESSES, weights=None, reserved=None,
+               wait_seconds=WAIT_SECONDS, visibility_timeout=VISIBILITY_TIMEOUT,
+               heartbeat_seconds=HEARTBEAT_SECONDS, shutdown_timeout=SHUTDOWN_TIMEOUT):
+    """
+    :param sqs_client: A Boto3 SQS client.
+    :param queue_urls: A dict with the queue URL of each lane. Defaults to the
+                       lanes of services.lanes; a lane sharing the URL of
+                       another one is polled once.
+    :param processes: The size of the process pool. With 0, batches run one
+                      at a time on a thread of this process.
+    :param weights: The share of each lane, as in LaneScheduler.
+    :param reserved: The in-flight messages reserved per lane.
+    """
+    self.queues = {}
+    for lane, url in (queue_urls or QUEUE_URLS).items():
+      if url and url not in [queue.queue_url for queue in self.queues.values()]:
+        self.queues[lane] = Queue(sqs_client, url)
+    self.arns = {lane: queue_arn_from_url(queue.queue_url) for lane, queue in self.queues.items()}
+
+    weights = {lane: weight for lane, weight in (weights or WEIGHTS).items() if lane in self.queues}
+    reserved = {lane: slots for lane, slots in (reserved or {HIGH: HIGH_RESERVED}).items() if lane in self.queues and len(self.queues) > 1}
+    self.scheduler = LaneScheduler(max(processes, 1) * MAX_BATCH_ENTRIES, weights, reserved)
+
+    if processes > 0:
+      self.executor = ProcessPoolExecutor(max_workers=processes, initializer=ignore_signals)
+      # The processes are forked on the first submit. Forking them now, before
+      # the poller threads start, keeps a lock held by one of those threads
+      # from being copied locked into the children.
+      self.executor.submit(int).result()
+    else:
+      self.executor = ThreadPoolExecutor(max_workers=1)
+
+    self.wait_seconds = wait_seconds
+    self.visibility_timeout = visibility_timeout
+    self.heartbeat_seconds = heartbeat_seconds
+    self.shutdown_timeout = shutdown_timeout
+    self.processed = 0
+    self.failed = 0
+    self._grants = {lane: queue_module.Queue() for lane in self.queues}
+    self._polling = set()
+    self._in_flight = {}
+    self._changed = threading.Condition()
+    self._stopping = threading.Event()
+    self._stopped = threading.Event()
+
+  def stop(self):
+    """
+    Stops receiving. Running batches are given shutdown_timeout seconds to
+    finish.
+    """
+    logger.info('Stopping the worker')
+    self._stopping.set()
+    with self._changed:
+      self._changed.notify_all()
+
+  def run(self):
+    """
+    Receives and processes messages until stop is called.
+    """
+    pollers = [threading.Thread(target=self._poll, args=(lane,), daemon=True) for lane in self.queues]
+    heartbeat = threading.Thread(target=self._heartbeat, daemon=True)
+    for thread in pollers + [heartbeat]:
+      thread.start()
+
+    while not self._stopping.is_set():
+      with self._changed:
+        lane = self.scheduler.next_lane(skip=self._polling)
+        if lane is None:
+          self._changed.wait(1)
+          continue
+        count = min(MAX_BATCH_ENTRIES, self.scheduler.available(lane))
+        self.scheduler.acquire(lane, count)
+        self._polling.add(lane)
+      self._grants[lane].put(count)
+
+    for lane in self.queues:
+      self._grants[lane].put(None)
+    for thread in pollers:
+      thread.join(self.wait_seconds + 5)
+    self._drain()
+
+  def _poll(self, lane):
+    """
+    Long-polls one lane, receiving as many messages as the lane was granted.
+    """
+    queue = self.queues[lane]
+    while True:
+      count = self._grants[lane].get()
+      if count is None:
+        return
+
+      messages = queue.receive(count, self.wait_seconds) if not self._stopping.is_set() else []
+      with self._changed:
+        self.scheduler.release(lane, count - len(messages))
+        self._polling.discard(lane)
+        if messages:
+          self._submit(lane, [to_record(message, queue.queue_url, self.arns[lane]) for message in messages])
+        self._changed.notify_all()
+
+  def _submit(self, lane, records):
+    batch = Batch(lane, records)
+    future = self.executor.submit(process_batch, records)
+    self._in_flight[future] = batch
+    future.add_done_callback(self._done)
+
+  def _done(self, future):
+    with self._changed:
+      batch = self._in_flight.pop(future)
+
+    try:
+      failed = set(future.result())
+    except Exception:
+      logger.exception(f'A batch of {len(batch.records)} messages of lane {batch.lane} failed!')
+      failed = {record['messageId'] for record in batch.records}
+
+    # Failed records are left in the queue, to be received again once their
+    # visibility timeout or deferral expires.
+    processed = [record['receiptHandle'] for record in batch.records if record['messageId'] not in failed]
+    if processed:
+      self.queues[batch.lane].delete_messages(processed)
+
+    with self._changed:
+      self.processed += len(processed)
+      self.failed += len(failed)
+      self.scheduler.release(batch.lane, len(batch.records))
+      self._changed.notify_all()
+
+  def _heartbeat(self):
+    """
+    Extends the visibility of the batches still running, so slow records
+    aren't received again by another worker.
+    """
+    while not self._stopped.wait(min(self.heartbeat_seconds, 1)):
+      now = time.monotonic()
+      with self._changed:
+        due = [batch for batch in self._in_flight.values() if now - batch.extended_at >= self.heartbeat_seconds]
+      for batch in due:
+        batch.extended_at = now
+        entries = [(record['receiptHandle'], self.visibility_timeout) for record in batch.records]
+        self.queues[batch.lane].change_visibility(entries)
+
+  def _drain(self):
+    """
+    Waits for the running batches. The records of the unfinished ones are
+    left invisible: their processes keep sending them, so releasing them
+    would let another worker send them too. They come back once the last
+    heartbeat's visibility expires, and the channels done by then are
+    skipped by the delivery table.
+    """
+    deadline = time.monotonic() + self.shutdown_timeout
+    with self._changed:
+      while self._in_flight and time.monotonic() < deadline:
+        self._changed.wait(max(0, min(1, deadline - time.monotonic())))
+      unfinished = list(self._in_flight.values())
+
+    for batch in unfinished:
+      logger.warning(f'Leaving {len(batch.records)} unfinished messages of lane {batch.lane} to their visibility timeout')
+
+    self._stopped.set()
+    self.executor.shutdown(wait=not unfinished)
+    logger.info(f'Worker stopped: {self.processed} processed, {self.failed} failed')
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--processes', type=int, default=PROCESSES, help='Size of the process pool')
+  args = parser.parse_args()
+
+  logging.basicConfig(level=logging.INFO)
+  from services import aws
+
+  worker = Worker(aws.sqs(), processes=args.processes)
+  signal.signal(signal.SIGTERM, lambda *_: worker.stop())
+  signal.signal(signal.SIGINT, lambda *_: worker.stop())
+  worker.run()
+
+
+if __name__ == '__main__':
+  main()